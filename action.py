@@ -3,6 +3,9 @@ import numpy as np
 
 
 class Action:
+    __slots__ = ("__name", "__most_likely_emotional_vector_PAD", "__most_likely_personality_vector_PAD",
+                 "__received_emotional_change_vector_PAD", "__given_emotional_change_vector_PAD", "__action_type")
+
     def __init__(self, action_name: str, action_type: str, most_likely_emotional_vector_PAD: np.array = np.zeros(
             3), most_likely_personality_vector_OCEAN: np.array = np.zeros(
             5), received_emotional_change_vector_PAD: np.array = np.zeros(
@@ -0,0 +1,71 @@
+from __future__ import annotations
+import csv
+import hashlib
+import os
+import numpy as np
+from action_table import ActionTable
+
+# The action file is parsed once, and the parsed arrays cached as an .npz in a __pycache__ directory next to it.
+# Cache files are keyed by a digest of the action file's contents, so editing the file never reuses a stale cache.
+
+VECTOR_COLUMNS = ("most_likely_emotional_vector_PAD", "most_likely_personality_vector_OCEAN",
+                  "received_emotional_change_vector_PAD", "given_emotional_change_vector_PAD")
+VECTOR_SIZES = (3, 5, 3, 3)
+
+
+def parse_vector_string(vector_string: str, size: int) -> np.array:
+    """Parses a vector in string representation (of form "[x,..,y,z]"). An empty string is a vector of NaNs."""
+    if not vector_string.strip():
+        return np.full(size, np.nan)
+    vector = np.array([float(val) for val in vector_string.strip()[
+                      1:-1].split(",")])
+    assert len(vector) == size, f"{vector_string} is not a {size} dimensional vector"
+    return vector
+
+
+def parse_action_file(action_filepath: str) -> dict:
+    """Parses the action file (with the csv module) into the arrays of an ActionTable"""
+    with open(action_filepath, newline="") as action_file:
+        rows = list(csv.DictReader(action_file))
+    arrays = {
+        "action_names": np.array([row["action_name"] for row in rows]),
+        "action_types": np.array([row["action_type"] for row in rows]),
+    }
+    for column, size in zip(VECTOR_COLUMNS, VECTOR_SIZES):
+        # e.g. most_likely_emotional_vector_PAD -> most_likely_emotional_vectors_PAD
+        arrays[column.replace("_vector_", "_vectors_")] = np.array(
+            [parse_vector_string(row[column] or "", size) for row in rows]).reshape(len(rows), size)
+    return arrays
+
+
+def get_cache_filepath(action_filepath: str, contents: bytes) -> str:
+    """Returns the cache file for the given contents of the action file"""
+    directory, filename = os.path.split(os.path.abspath(action_filepath))
+    digest = hashlib.sha1(contents).hexdigest()[:16]
+    return os.path.join(directory, "__pycache__", f"{os.path.splitext(filename)[0]}.{digest}.npz")
+
+
+def load_action_table(action_filepath: str = "action_values.csv", use_cache: bool = True) -> ActionTable:
+    """Returns the ActionTable of the given action file, from its binary cache if there is an up to date one"""
+    if not use_cache:
+        return ActionTable(**parse_action_file(action_filepath))
+
+    with open(action_filepath, "rb") as action_file:
+        cache_filepath = get_cache_filepath(
+            action_filepath, action_file.read())
+    if os.path.exists(cache_filepath):
+        with np.load(cache_filepath) as arrays:
+            return ActionTable(**{name: arrays[name] for name in arrays.files})
+
+    arrays = parse_action_file(action_filepath)
+    try:
+        os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+        # Written to a temporary file first, so a concurrent reader never sees a partial cache
+        temporary_filepath = f"{cache_filepath}.{os.getpid()}.tmp"
+        with open(temporary_filepath, "wb") as cache_file:
+            np.savez(cache_file, **arrays)
+        os.replace(temporary_filepath, cache_filepath)
+    except OSError:
+        # Caching is only an optimisation (e.g. the directory may be read-only)
+        pass
+    return ActionTable(**arrays)
@@ -0,0 +1,273 @@
+from __future__ import annotations
+import hashlib
+import numpy as np
+from action import Action
+from collections.abc import Mapping
+from typing import Dict, Iterator, List
+
+# metacode_helpers.get_personality_vector() only produces the 32 binary OCEAN vectors (personality_number % 32)
+NUM_PERSONALITY_ARCHETYPES = 32
+
+# Base action probabilities of the personality archetypes, keyed by ActionTable fingerprint.
+# Keying by the table contents means a changed action file never reuses a stale entry.
+_archetype_base_action_probs_cache: Dict[str, np.array] = dict()
+
+
+def normalise_action_probs(likelihoods: np.array) -> np.array:
+    """Normalises the last axis of a (... x A) likelihood array to sum to 1"""
+    return likelihoods / likelihoods.sum(axis=-1, keepdims=True)
+
+
+def get_archetype_personality_vectors() -> np.array:
+    """Returns the (32 x 5) binary personality vectors of the archetypes, where row i is the binary representation of i"""
+    return (np.arange(NUM_PERSONALITY_ARCHETYPES)[:, None] >> np.arange(4, -1, -1)) & 1
+
+
+def get_archetype_indices(personality_vectors: np.array) -> np.array:
+    """Returns the archetype index of each row of a (N x 5) block of personality vectors (-1 if it is not an archetype)"""
+    personality_vectors = np.asarray(personality_vectors)
+    is_archetype = np.all((personality_vectors == 0) |
+                          (personality_vectors == 1), axis=1)
+    archetype_indices = personality_vectors.astype(
+        np.int64) @ (1 << np.arange(4, -1, -1))
+    return np.where(is_archetype, archetype_indices, -1)
+
+
+class ActionTable:
+    """The catalogue of all possible actions, compiled into dense arrays indexed by integer action id.
+
+    Row i of every array belongs to the action with id i. The Action objects are kept for display
+    (and for the object-oriented API), and iterating over the table yields them in id order,
+    so an ActionTable can be used anywhere a list of actions was used before.
+    """
+
+    def __init__(self, action_names: List[str], action_types: List[str], most_likely_emotional_vectors_PAD: np.array, most_likely_personality_vectors_OCEAN: np.array, received_emotional_change_vectors_PAD: np.array, given_emotional_change_vectors_PAD: np.array, actions: List[Action] | None = None):
+        num_actions = len(action_names)
+        self.__names = list(action_names)
+        self.__types = np.array(action_types)
+        self.__ids = {name: i for i, name in enumerate(self.__names)}
+        assert len(self.__ids) == num_actions, "Action names must be unique"
+
+        # (A x 3) PAD centres, (A x 5) OCEAN centres and (A x 3) emotional change vectors.
+        # Actions without an emotional effect (room actions) have NaN in the action file, stored as 0.
+        self.__emotional_vectors = np.array(
+            most_likely_emotional_vectors_PAD, dtype=float).reshape(num_actions, 3)
+        self.__personality_vectors = np.array(
+            most_likely_personality_vectors_OCEAN, dtype=float).reshape(num_actions, 5)
+        self.__received_change_vectors = np.nan_to_num(np.array(
+            received_emotional_change_vectors_PAD, dtype=float).reshape(num_actions, 3))
+        self.__given_change_vectors = np.nan_to_num(np.array(
+            given_emotional_change_vectors_PAD, dtype=float).reshape(num_actions, 3))
+        for array in (self.__emotional_vectors, self.__personality_vectors, self.__received_change_vectors, self.__given_change_vectors):
+            array.flags.writeable = False
+
+        # Boolean masks over action ids for each type of action
+        self.__conversation_action_mask = self.get_type_mask("conversation")
+        self.__room_action_mask = self.get_type_mask("room")
+
+        if actions is None:
+            actions = [Action(action_name=self.__names[i], action_type=str(self.__types[i]),
+                              most_likely_emotional_vector_PAD=self.__emotional_vectors[i],
+                              most_likely_personality_vector_OCEAN=self.__personality_vectors[i],
+                              received_emotional_change_vector_PAD=self.__received_change_vectors[i],
+                              given_emotional_change_vector_PAD=self.__given_change_vectors[i]) for i in range(num_actions)]
+        assert [action.get_name() for action in actions] == self.__names, "Actions must be in id order"
+        self.__actions = list(actions)
+
+        # A digest of the table contents, used as the key for cached derived data
+        fingerprint = hashlib.sha1("\x1f".join(self.__names + list(self.__types)).encode())
+        for array in (self.__emotional_vectors, self.__personality_vectors, self.__received_change_vectors, self.__given_change_vectors):
+            fingerprint.update(array.tobytes())
+        self.__fingerprint = fingerprint.hexdigest()
+
+    @classmethod
+    def from_actions(cls, actions: List[Action]) -> ActionTable:
+        """Compiles a table from a list of Action objects (which are kept for display)"""
+        if isinstance(actions, ActionTable):
+            return actions
+        return cls(action_names=[action.get_name() for action in actions],
+                   action_types=[action.get_action_type()
+                                 for action in actions],
+                   most_likely_emotional_vectors_PAD=[
+                       action.get_most_likely_emotional_vector() for action in actions],
+                   most_likely_personality_vectors_OCEAN=[
+                       action.get_most_likely_personality_vector() for action in actions],
+                   received_emotional_change_vectors_PAD=[np.broadcast_to(
+                       action.get_received_emotional_change_vector(), 3) for action in actions],
+                   given_emotional_change_vectors_PAD=[np.broadcast_to(
+                       action.get_given_emotional_change_vector(), 3) for action in actions],
+                   actions=actions)
+
+    def __len__(self) -> int:
+        return len(self.__names)
+
+    def __iter__(self) -> Iterator[Action]:
+        return iter(self.__actions)
+
+    def __getitem__(self, action_id: int) -> Action:
+        return self.__actions[action_id]
+
+    def __contains__(self, action: Action | str) -> bool:
+        return (action.get_name() if isinstance(action, Action) else action) in self.__ids
+
+    def __repr__(self) -> str:
+        return repr(self.__actions)
+
+    def get_fingerprint(self) -> str:
+        """Returns a digest of the table contents (equal tables have equal fingerprints)"""
+        return self.__fingerprint
+
+    def get_actions(self) -> List[Action]:
+        """Returns the Action objects, in id order"""
+        return self.__actions
+
+    def get_action(self, action_id: int) -> Action:
+        """Returns the Action with the given id"""
+        return self.__actions[action_id]
+
+    def get_names(self) -> List[str]:
+        """Returns the action names, in id order"""
+        return self.__names
+
+    def get_action_id(self, action: Action | str) -> int:
+        """Returns the id of the given Action (or action name)"""
+        return self.__ids[action.get_name() if isinstance(action, Action) else action]
+
+    def get_action_ids(self, actions: List[Action | str]) -> np.array:
+        """Returns the ids of the given Actions (or action names)"""
+        return np.array([self.get_action_id(action) for action in actions], dtype=np.int64)
+
+    def get_types(self) -> np.array:
+        """Returns the action types, in id order"""
+        return self.__types
+
+    def get_type_mask(self, action_type: str) -> np.array:
+        """Returns a boolean mask over action ids that is True for actions of the given type"""
+        return self.__types == action_type
+
+    def get_conversation_action_mask(self) -> np.array:
+        """Returns a boolean mask over action ids that is True for conversation actions"""
+        return self.__conversation_action_mask
+
+    def get_room_action_mask(self) -> np.array:
+        """Returns a boolean mask over action ids that is True for room actions"""
+        return self.__room_action_mask
+
+    def get_action_mask(self, actions: List[Action | str]) -> np.array:
+        """Returns a boolean mask over action ids that is True for the given Actions (or action names)"""
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self.get_action_ids(actions)] = True
+        return mask
+
+    def get_emotional_vectors(self) -> np.array:
+        """Returns the (A x 3) PAD vectors where each action is most likely"""
+        return self.__emotional_vectors
+
+    def get_personality_vectors(self) -> np.array:
+        """Returns the (A x 5) OCEAN vectors where each action is most likely"""
+        return self.__personality_vectors
+
+    def get_received_change_vectors(self) -> np.array:
+        """Returns the (A x 3) PAD changes for the person receiving each action"""
+        return self.__received_change_vectors
+
+    def get_given_change_vectors(self) -> np.array:
+        """Returns the (A x 3) PAD changes for the person taking each action"""
+        return self.__given_change_vectors
+
+    def get_base_action_probs(self, personality_vectors: np.array, max_likelihood: float = 1000) -> np.array:
+        """Returns the (N x A) base action probabilities for a (N x 5) block of personality vectors.
+        The likelihood of each action is inversely proportional to the distance between the personality
+        and the action's "most likely personality" (up to max_likelihood)."""
+        personality_distances = np.linalg.norm(
+            np.asarray(personality_vectors, dtype=float)[:, None, :] - self.__personality_vectors[None, :, :], axis=2)
+        # A distance of 0 gives 1/0 -> inf, which is capped at max_likelihood
+        with np.errstate(divide="ignore"):
+            likelihoods = np.minimum(1 / personality_distances, max_likelihood)
+        return normalise_action_probs(likelihoods)
+
+    def get_emotional_action_probs(self, emotional_state_vectors: np.array, max_likelihood: float = 1000) -> np.array:
+        """Returns the (N x A) emotional action probabilities for a (N x 3) block of emotional state vectors.
+        The likelihood of each action is inversely proportional to the distance between the emotional state
+        and the action's "most likely emotional state" (up to max_likelihood)."""
+        emotional_state_distances = np.linalg.norm(
+            np.asarray(emotional_state_vectors, dtype=float)[:, None, :] - self.__emotional_vectors[None, :, :], axis=2)
+        # As for personalities, a distance of 0 (e.g. a state clipped to the corner [-1, -1, -1]) is capped at max_likelihood
+        with np.errstate(divide="ignore"):
+            likelihoods = np.minimum(1 / emotional_state_distances, max_likelihood)
+        return normalise_action_probs(likelihoods)
+
+    def combine_action_probs(self, emotion_probs: np.array, base_probs: np.array, available_masks: np.array, weighting: float = 0.5) -> np.array:
+        """Filters both (N x A) distributions to the available actions, and combines them with the given weighting.
+        Unavailable actions get a probability of exactly 0."""
+        assert weighting >= 0 and weighting <= 1, "weighting must be between 0 and 1"
+        filtered_emotion_probs = normalise_action_probs(
+            np.where(available_masks, emotion_probs, 0))
+        filtered_base_probs = normalise_action_probs(
+            np.where(available_masks, base_probs, 0))
+        return normalise_action_probs(filtered_emotion_probs * weighting + filtered_base_probs / (1 + weighting))
+
+    def get_archetype_base_action_probs(self) -> np.array:
+        """Returns the shared, read-only (32 x A) base action probabilities of the personality archetypes.
+        These are computed once per distinct action table, and reused by every person with an archetype personality."""
+        if self.__fingerprint not in _archetype_base_action_probs_cache:
+            archetype_base_action_probs = self.get_base_action_probs(
+                get_archetype_personality_vectors())
+            archetype_base_action_probs.flags.writeable = False
+            _archetype_base_action_probs_cache[self.__fingerprint] = archetype_base_action_probs
+        return _archetype_base_action_probs_cache[self.__fingerprint]
+
+    def get_base_action_probs_table(self, personality_vectors: np.array) -> tuple:
+        """Returns (table, rows) such that table[rows[i]] is the base action probability distribution of person i.
+        Archetype personalities point into the shared archetype table; only other (distinct) personalities are computed."""
+        archetype_base_action_probs = self.get_archetype_base_action_probs()
+        rows = get_archetype_indices(personality_vectors)
+        is_custom = rows < 0
+        if not np.any(is_custom):
+            return archetype_base_action_probs, rows
+        custom_personality_vectors, custom_rows = np.unique(
+            np.asarray(personality_vectors, dtype=float)[is_custom], axis=0, return_inverse=True)
+        table = np.vstack((archetype_base_action_probs,
+                          self.get_base_action_probs(custom_personality_vectors)))
+        table.flags.writeable = False
+        rows[is_custom] = NUM_PERSONALITY_ARCHETYPES + custom_rows.reshape(-1)
+        return table, rows
+
+
+class ActionProbs(Mapping):
+    """A read-only dict-like mapping from Action to probability, over a vector of probabilities indexed by action id.
+    The dict is only built when the mapping is first used, so keeping one (e.g. in every snapshot) costs a small array.
+    If only_available, actions with a probability of 0 (i.e. unavailable actions) are left out."""
+    __slots__ = ("__action_table", "__probs", "__only_available", "__dict")
+
+    def __init__(self, action_table: ActionTable, probs: np.array, only_available: bool = True):
+        self.__action_table = action_table
+        self.__probs = probs
+        self.__only_available = only_available
+        self.__dict = None
+
+    def __get_dict(self) -> dict:
+        if self.__dict is None:
+            self.__dict = {action: prob for action, prob in zip(self.__action_table, self.__probs)
+                           if prob > 0 or not self.__only_available}
+        return self.__dict
+
+    def __getitem__(self, action: Action):
+        return self.__get_dict()[action]
+
+    def __iter__(self) -> Iterator[Action]:
+        return iter(self.__get_dict())
+
+    def __len__(self) -> int:
+        return len(self.__get_dict())
+
+    def __repr__(self) -> str:
+        return repr(self.__get_dict())
+
+    def get_vector(self) -> np.array:
+        """Returns the probabilities as a vector indexed by action id (without building the dict)"""
+        return self.__probs
+
+    def copy(self) -> dict:
+        """Returns the mapping as a new dict"""
+        return dict(self.__get_dict())
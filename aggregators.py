@@ -0,0 +1,244 @@
+from __future__ import annotations
+import numpy as np
+from typing import Dict, List
+from action_table import NUM_PERSONALITY_ARCHETYPES, get_archetype_indices, get_archetype_personality_vectors
+from population import Population
+
+# Streaming aggregators summarise a run while it happens, so that sweeps which only need summaries do not have
+# to write (and then re-read) a per-turn trace. Each aggregator is started once per run, and then updated once
+# per round (with round_number the same for all turns) with that round's turns, as columns named as in trace_writer.TRACE_COLUMNS (of which the aggregators
+# here use person, action, location_before/after and partner_before/after, where partner_after is the partner
+# the turn was taken with). Each update costs O(turns), and the summaries only grow with the number of rounds.
+# Aggregators of the same kind (e.g. from different runs or worker processes) are combined with merge().
+
+
+class Aggregator:
+    """Base class of the streaming aggregators"""
+
+    def start(self, population: Population):
+        """Prepares for a run of the given population (called before its first round)"""
+        pass
+
+    def update(self, population: Population, turns: Dict[str, np.array]):
+        """Updates the summary with the turns of one round (population is the state after the round)"""
+        raise NotImplementedError
+
+    def merge(self, other: Aggregator):
+        """Adds the summary of another aggregator of the same kind into this one"""
+        raise NotImplementedError
+
+    def get_result(self) -> dict:
+        """Returns the summary, as a dict of names, lists & arrays"""
+        raise NotImplementedError
+
+
+def add_rows(rows: List[np.array], other_rows: List[np.array]):
+    """Adds other_rows into rows (lists of per-round arrays) in place, appending copies of any extra rounds"""
+    for row, other_row in zip(rows, other_rows):
+        row += other_row
+    rows.extend(other_row.copy() for other_row in other_rows[len(rows):])
+
+
+def get_row(rows: List[np.array], round_number: int, size: int, dtype=np.int64) -> np.array:
+    """Returns the row of the given round from a list of per-round arrays, appending rows of zeros as needed"""
+    while len(rows) <= round_number:
+        rows.append(np.zeros(size, dtype=dtype))
+    return rows[round_number]
+
+
+class ActionCountsByPersonality(Aggregator):
+    """Counts how often each action is taken by people of each personality archetype.
+    Row 32 counts the actions of people whose personality is not one of the 32 binary archetypes."""
+
+    def __init__(self):
+        self.__action_names = None
+        self.__counts = None
+        self.__archetype_rows = None
+
+    def start(self, population: Population):
+        action_names = population.get_action_table().get_names()
+        if self.__counts is None:
+            self.__action_names = list(action_names)
+            self.__counts = np.zeros((NUM_PERSONALITY_ARCHETYPES + 1, len(action_names)), dtype=np.int64)
+        assert self.__action_names == list(action_names), "Runs must use the same actions"
+        archetype_indices = get_archetype_indices(population.get_personality_vectors())
+        self.__archetype_rows = np.where(archetype_indices >= 0, archetype_indices, NUM_PERSONALITY_ARCHETYPES)
+
+    def update(self, population: Population, turns: Dict[str, np.array]):
+        np.add.at(self.__counts, (self.__archetype_rows[turns["person"]], turns["action"]), 1)
+
+    def merge(self, other: ActionCountsByPersonality):
+        if other.__counts is None:
+            return
+        if self.__counts is None:
+            self.__action_names, self.__counts = list(other.__action_names), other.__counts.copy()
+            return
+        assert self.__action_names == other.__action_names, "Runs must use the same actions"
+        self.__counts += other.__counts
+
+    def get_result(self) -> dict:
+        return {"personality_vectors": get_archetype_personality_vectors(), "action_names": self.__action_names, "counts": self.__counts}
+
+
+class ConversationLengthHistogram(Aggregator):
+    """Histogram of the lengths of finished conversations, in conversation turns (counting both partners' turns,
+    up to & including leaves_conversation). Lengths of max_length or more are counted in the last bin.
+    Conversations still going on at the end of a run are not counted."""
+
+    def __init__(self, max_length: int = 100):
+        self.__max_length = max_length
+        self.__counts = np.zeros(max_length + 1, dtype=np.int64)
+        self.__leaves_conversation_id = -1
+        # Turns so far of the ongoing conversation of each person, kept by the lower index of the two partners
+        self.__conversation_turns = None
+
+    def start(self, population: Population):
+        action_table = population.get_action_table()
+        self.__leaves_conversation_id = action_table.get_action_id(
+            "leaves_conversation") if "leaves_conversation" in action_table else -1
+        self.__conversation_turns = np.zeros(len(population), dtype=np.int64)
+        # Conversations already going on at the start have an unknown length, so are marked to be skipped
+        partners = population.get_conversation_partners()
+        self.__conversation_turns[partners >= 0] = -1
+
+    def update(self, population: Population, turns: Dict[str, np.array]):
+        persons = np.asarray(turns["person"], dtype=np.int64)
+        partners_before = np.asarray(turns["partner_before"], dtype=np.int64)
+        partners_after = np.asarray(turns["partner_after"], dtype=np.int64)
+        in_conversation = partners_before >= 0
+        is_start = ~in_conversation & (partners_after >= 0)
+        is_event = in_conversation | is_start
+        # Each conversation is identified by the lower index of its partners (each person is in at most one at a time)
+        keys = np.minimum(persons, np.where(in_conversation, partners_before, partners_after))[is_event]
+        is_start = is_start[is_event]
+        is_turn = in_conversation[is_event]
+        is_leave = is_turn & (np.asarray(turns["action"])[is_event] == self.__leaves_conversation_id)
+
+        # Group the events by conversation, keeping their turn order, and count the turns since each start
+        order = np.argsort(keys, kind="stable")
+        keys, is_start, is_turn, is_leave = keys[order], is_start[order], is_turn[order], is_leave[order]
+        is_new_key = np.ones(len(keys), dtype=bool)
+        is_new_key[1:] = keys[1:] != keys[:-1]
+        is_block_start = is_start | is_new_key
+        block_starts = np.flatnonzero(is_block_start)
+        blocks = np.cumsum(is_block_start) - 1
+        turn_counts = np.cumsum(is_turn)
+        # Blocks that do not begin with a start continue the conversation's count from earlier rounds
+        carried_counts = np.where(is_start[block_starts], 0, self.__conversation_turns[keys[block_starts]])
+        block_bases = turn_counts[block_starts] - is_turn[block_starts] - carried_counts
+        lengths = turn_counts - block_bases[blocks]
+        # Conversations that were ongoing at the start of the run stay marked with -1, so are never counted
+        lengths[(carried_counts < 0)[blocks]] = -1
+
+        # A conversation ends with the block that has a leave. In a synchronous tick both partners may leave at once,
+        # so each conversation is counted once, with the length at the end of its block (including both last turns).
+        block_ends = np.append(block_starts[1:], len(keys)) - 1
+        is_finished = np.bincount(blocks[is_leave], minlength=len(block_starts)) > 0
+        finished_lengths = lengths[block_ends[is_finished]]
+        finished_lengths = finished_lengths[finished_lengths >= 0]
+        self.__counts += np.bincount(np.minimum(finished_lengths, self.__max_length), minlength=self.__max_length + 1)
+        is_last = np.append(is_new_key[1:], True)
+        self.__conversation_turns[keys[is_last]] = lengths[is_last]
+
+    def merge(self, other: ConversationLengthHistogram):
+        assert self.__max_length == other.__max_length, "Histograms must have the same bins"
+        self.__counts += other.__counts
+
+    def get_result(self) -> dict:
+        num_conversations = self.__counts.sum()
+        return {"lengths": np.arange(self.__max_length + 1), "counts": self.__counts,
+                "mean_length": float(self.__counts @ np.arange(self.__max_length + 1) / num_conversations) if num_conversations else None}
+
+
+class RoomOccupancy(Aggregator):
+    """The number of people in each room at the end of each round, averaged over runs"""
+
+    def __init__(self):
+        self.__room_names = None
+        self.__occupancy_sums: List[np.array] = []  # Per round, the occupancy of each room summed over runs
+        self.__num_runs: List[np.array] = []  # Per round, the number of runs contributing
+
+    def start(self, population: Population):
+        room_names = population.get_room_graph().get_room_names()
+        if self.__room_names is None:
+            self.__room_names = list(room_names)
+        assert self.__room_names == list(room_names), "Runs must use the same rooms"
+
+    def update(self, population: Population, turns: Dict[str, np.array]):
+        round_number = int(turns["round_number"][0])
+        get_row(self.__occupancy_sums, round_number, len(self.__room_names))[:] += np.bincount(
+            population.get_locations(), minlength=len(self.__room_names))
+        get_row(self.__num_runs, round_number, 1)[:] += 1
+
+    def merge(self, other: RoomOccupancy):
+        if other.__room_names is None:
+            return
+        if self.__room_names is None:
+            self.__room_names = list(other.__room_names)
+        assert self.__room_names == other.__room_names, "Runs must use the same rooms"
+        add_rows(self.__occupancy_sums, other.__occupancy_sums)
+        add_rows(self.__num_runs, other.__num_runs)
+
+    def get_result(self) -> dict:
+        num_runs = np.concatenate(self.__num_runs) if self.__num_runs else np.zeros(0, dtype=np.int64)
+        num_rooms = len(self.__room_names) if self.__room_names is not None else 0
+        # (With no rounds, e.g. a run of 0 rounds, this is an empty (0 x rooms) array)
+        occupancy_sums = np.array(self.__occupancy_sums).reshape(len(num_runs), num_rooms)
+        return {"room_names": self.__room_names, "num_runs": num_runs, "mean_occupancy": occupancy_sums / np.maximum(num_runs, 1)[:, None]}
+
+
+class MeanEmotionalTrajectory(Aggregator):
+    """The mean & standard deviation of everyone's PAD emotional state at the end of each round, over people & runs"""
+
+    def __init__(self):
+        # Per round, the sums (and sums of squares) of the PAD dimensions, and the number of people contributing
+        self.__sums: List[np.array] = []
+        self.__sums_of_squares: List[np.array] = []
+        self.__counts: List[np.array] = []
+
+    def update(self, population: Population, turns: Dict[str, np.array]):
+        emotional_state_vectors = population.get_emotional_state_vectors()
+        round_number = int(turns["round_number"][0])
+        get_row(self.__sums, round_number, 3, float)[:] += emotional_state_vectors.sum(axis=0)
+        get_row(self.__sums_of_squares, round_number, 3, float)[:] += np.square(emotional_state_vectors).sum(axis=0)
+        get_row(self.__counts, round_number, 1)[:] += len(emotional_state_vectors)
+
+    def merge(self, other: MeanEmotionalTrajectory):
+        add_rows(self.__sums, other.__sums)
+        add_rows(self.__sums_of_squares, other.__sums_of_squares)
+        add_rows(self.__counts, other.__counts)
+
+    def get_result(self) -> dict:
+        counts = np.concatenate(self.__counts) if self.__counts else np.zeros(0, dtype=np.int64)
+        divisors = np.maximum(counts, 1)[:, None]
+        means = np.array(self.__sums).reshape(-1, 3) / divisors
+        mean_squares = np.array(self.__sums_of_squares).reshape(-1, 3) / divisors
+        return {"counts": counts, "mean_PAD": means, "std_PAD": np.sqrt(np.maximum(mean_squares - np.square(means), 0))}
+
+
+def get_default_aggregators() -> List[Aggregator]:
+    """Returns one new aggregator of each kind"""
+    return [ActionCountsByPersonality(), ConversationLengthHistogram(), RoomOccupancy(), MeanEmotionalTrajectory()]
+
+
+def merge_aggregators(aggregator_lists: List[List[Aggregator]]) -> List[Aggregator]:
+    """Merges lists of aggregators (e.g. one list per run) position by position into the first list, and returns it"""
+    merged = aggregator_lists[0]
+    for aggregators in aggregator_lists[1:]:
+        assert len(aggregators) == len(merged), "Every run must have the same aggregators"
+        for aggregator, other in zip(merged, aggregators):
+            aggregator.merge(other)
+    return merged
+
+
+def get_results(aggregators: List[Aggregator]) -> dict:
+    """Returns the results of the aggregators as JSON-serialisable data, keyed by aggregator class name"""
+    def to_json(value):
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, dict):
+            return {key: to_json(x) for key, x in value.items()}
+        if isinstance(value, (np.integer, np.floating)):
+            return value.item()
+        return value
+    return {type(aggregator).__name__: to_json(aggregator.get_result()) for aggregator in aggregators}
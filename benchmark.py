@@ -0,0 +1,335 @@
+from __future__ import annotations
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from typing import Callable, Dict, List
+from action import Action
+from action_table import ActionTable
+from room import Room
+import emotional_probs
+import metacode_helpers
+import replicas
+import room_graph
+import simulation
+
+# Benchmarks of the simulation hot paths. Each benchmark reports the time taken, the operations
+# (turns, calls or people) per second, the time spent in each phase (where there are phases),
+# and the peak memory allocated, as JSON. A stored report can be used as a baseline to detect slowdowns.
+
+QUICK_SWEEP = {"num_people": [32, 1000], "num_rooms": [3, 30], "num_actions": [19, 76]}
+FULL_SWEEP = {"num_people": [32, 1000, 10000, 100000],
+              "num_rooms": [3, 30, 300], "num_actions": [19, 76, 304]}
+# The defaults used for the dimensions that are not being swept
+DEFAULT_NUM_PEOPLE, DEFAULT_NUM_ROOMS, DEFAULT_NUM_ACTIONS = 1000, 3, 19
+# Micro-benchmarks time at most this many calls, however large the population
+MAX_CALLS = 2000
+# Replicas stepped together by the replica batch benchmark
+NUM_REPLICAS = 32
+
+
+def make_action_table(num_actions: int, rng: np.random.Generator) -> ActionTable:
+    """Returns the real action catalogue, padded with random conversation actions up to num_actions"""
+    actions = list(metacode_helpers.initialise_all_actions(
+        simulation.DEFAULT_ACTION_FILEPATH))
+    assert num_actions >= len(actions), f"The catalogue already has {len(actions)} actions"
+    for i in range(num_actions - len(actions)):
+        actions.append(Action(action_name=f"synthetic_{i}", action_type="conversation",
+                              most_likely_emotional_vector_PAD=rng.integers(-1, 2, size=3).astype(float),
+                              most_likely_personality_vector_OCEAN=rng.integers(-1, 2, size=5).astype(float),
+                              received_emotional_change_vector_PAD=rng.uniform(-0.01, 0.01, size=3),
+                              given_emotional_change_vector_PAD=rng.uniform(-0.01, 0.01, size=3)))
+    return ActionTable.from_actions(actions)
+
+
+def make_rooms(num_rooms: int) -> List[Room]:
+    """Returns num_rooms rooms connected in a corridor (the default Hall, Kitchen & Lounge for 3 rooms)"""
+    if num_rooms == 3:
+        return simulation.build_rooms(simulation.DEFAULT_ROOM_GRAPH)
+    return room_graph.make_corridor_graph(num_rooms).build_rooms()
+
+
+def run_person_round(all_people: list, all_possible_actions: ActionTable, rng: np.random.Generator, phase_times: Dict[str, float]):
+    """Runs one round of the metacode.ipynb loop over Person objects, accumulating the time of each phase"""
+    conversation_actions = [action for action in all_possible_actions if action.get_action_type() == "conversation"]
+    room_actions = [action for action in all_possible_actions if action.get_action_type() == "room"]
+    room_actions_without_start = [action for action in room_actions if action.get_name() != "starts_conversation"]
+    clock = time.perf_counter
+    for person in all_people:
+        start = clock()
+        partner = person.get_conversation_partner()
+        if partner is not None:
+            action = person.action_selection(available_conv_act=conversation_actions, rng=rng)
+        else:
+            available_room_act = room_actions if person.get_location_state().is_someone_free_to_chat(person) else room_actions_without_start
+            action = person.action_selection(available_room_act=available_room_act, rng=rng)
+        selected = clock()
+        phase_times["action_selection"] += selected - start
+
+        if partner is not None:
+            person.update_emotional_state_vector(action, isOwnAction=True)
+            partner.update_emotional_state_vector(action, isOwnAction=False)
+            if action.get_name() == "leaves_conversation":
+                person.set_conversation_partner(None)
+                partner.set_conversation_partner(None)
+            phase_times["emotional_update"] += clock() - selected
+        elif action.get_name() == "leaves_room":
+            person.move_to_room(person.get_next_room(rng))
+            phase_times["move"] += clock() - selected
+        elif action.get_name() == "starts_conversation":
+            partner = person.get_location_state().get_new_conversation_partner_for(person, rng)
+            person.set_conversation_partner(partner)
+            partner.set_conversation_partner(person)
+            phase_times["partner_search"] += clock() - selected
+
+
+class Benchmark:
+    """A named benchmark with fixed parameters. setup() builds the state, and run() times the operations on it,
+    returning the number of operations and the time of each phase."""
+
+    def __init__(self, name: str, params: dict, setup: Callable[[], object], run: Callable[[object], tuple]):
+        self.__name = name
+        self.__params = params
+        self.__setup = setup
+        self.__run = run
+
+    def get_key(self) -> str:
+        """Returns the key identifying this benchmark in a report"""
+        return self.__name + "".join(f" {key}={value}" for key, value in sorted(self.__params.items()))
+
+    def measure(self, repeats: int = 3, measure_memory: bool = True) -> dict:
+        """Times the benchmark (the best of `repeats` runs, each on fresh state), and optionally measures its peak memory"""
+        best_seconds, best_phases, num_operations = np.inf, None, 0
+        for _ in range(repeats):
+            state = self.__setup()
+            start = time.perf_counter()
+            num_operations, phase_times = self.__run(state)
+            seconds = time.perf_counter() - start
+            if seconds < best_seconds:
+                best_seconds, best_phases = seconds, phase_times
+
+        peak_memory_bytes = None
+        if measure_memory:
+            # A separate pass, as tracing allocations slows everything down
+            tracemalloc.start()
+            self.__run(self.__setup())
+            peak_memory_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        return {
+            "key": self.get_key(),
+            "benchmark": self.__name,
+            "params": self.__params,
+            "seconds": best_seconds,
+            "operations": num_operations,
+            "operations_per_second": num_operations / best_seconds if best_seconds > 0 else None,
+            "phase_seconds": best_phases,
+            "peak_memory_bytes": peak_memory_bytes,
+        }
+
+
+def get_benchmarks(num_people: int, num_rooms: int, num_actions: int, num_rounds: int = 1, seed: int = 0) -> List[Benchmark]:
+    """Returns every benchmark for one combination of parameters"""
+    params = {"num_people": num_people, "num_rooms": num_rooms, "num_actions": num_actions}
+    num_calls = min(num_people, MAX_CALLS)
+
+    def setup_people():
+        rng = np.random.default_rng(seed)
+        all_possible_actions = make_action_table(num_actions, rng)
+        all_people = metacode_helpers.initialise_all_people(all_possible_actions, make_rooms(num_rooms), num_people=num_people, rng=rng, names_filepath=simulation.DEFAULT_NAMES_FILEPATH)
+        return all_possible_actions, all_people, rng
+
+    def setup_population():
+        rng = np.random.default_rng(seed)
+        return metacode_helpers.initialise_population(make_action_table(num_actions, rng), make_rooms(num_rooms), num_people=num_people, rng=rng, names_filepath=simulation.DEFAULT_NAMES_FILEPATH)
+
+    def run_initialise_all_people(state):
+        all_possible_actions, rooms, rng = state
+        metacode_helpers.initialise_all_people(all_possible_actions, rooms, num_people=num_people, rng=rng, names_filepath=simulation.DEFAULT_NAMES_FILEPATH)
+        return num_people, None
+
+    def run_initialise_population(state):
+        all_possible_actions, rooms, rng = state
+        metacode_helpers.initialise_population(all_possible_actions, rooms, num_people=num_people, rng=rng, names_filepath=simulation.DEFAULT_NAMES_FILEPATH)
+        return num_people, None
+
+    def run_action_selection(state):
+        all_possible_actions, all_people, rng = state
+        room_actions = [action for action in all_possible_actions if action.get_action_type() == "room"]
+        for person in all_people[:num_calls]:
+            person.action_selection(available_room_act=room_actions, rng=rng)
+        return num_calls, None
+
+    def run_update_emotional_state_vector(state):
+        all_possible_actions, all_people, rng = state
+        conversation_actions = [action for action in all_possible_actions if action.get_action_type() == "conversation"]
+        for i, person in enumerate(all_people[:num_calls]):
+            person.update_emotional_state_vector(conversation_actions[i % len(conversation_actions)], isOwnAction=i % 2 == 0)
+        return num_calls, None
+
+    def run_get_new_conversation_partner_for(state):
+        all_possible_actions, all_people, rng = state
+        for person in all_people[:num_calls]:
+            current_room = person.get_location_state()
+            if current_room.is_someone_free_to_chat(person):
+                current_room.get_new_conversation_partner_for(person, rng)
+        return num_calls, None
+
+    def setup_room_graph():
+        rng = np.random.default_rng(seed)
+        graph = room_graph.RoomGraph.from_rooms(make_rooms(num_rooms))
+        return graph, rng.integers(0, num_rooms, size=num_people), rng
+
+    def run_sample_neighbours(state):
+        graph, room_ids, rng = state
+        graph.sample_neighbours(room_ids, rng)
+        return num_people, None
+
+    def setup_emotional_probs(mode):
+        def setup():
+            rng = np.random.default_rng(seed)
+            lookup = emotional_probs.make_emotional_probs_lookup(make_action_table(num_actions, rng), mode)
+            emotional_state_vectors = rng.uniform(-1, 1, size=(num_people, 3))
+            # Warm up (e.g. fill the cache), so that steady-state lookups are timed
+            lookup.get_emotional_action_probs(emotional_state_vectors)
+            return lookup, emotional_state_vectors
+        return setup
+
+    def run_emotional_probs(state):
+        lookup, emotional_state_vectors = state
+        lookup.get_emotional_action_probs(emotional_state_vectors)
+        return num_people, None
+
+    def run_person_rounds(state):
+        all_possible_actions, all_people, rng = state
+        phase_times = {"action_selection": 0.0, "emotional_update": 0.0, "move": 0.0, "partner_search": 0.0}
+        for _ in range(num_rounds):
+            run_person_round(all_people, all_possible_actions, rng, phase_times)
+        return num_rounds * num_people, phase_times
+
+    def run_population_rounds(population):
+        for _ in range(num_rounds):
+            population.run_round()
+        return num_rounds * num_people, None
+
+    def run_population_ticks(population):
+        for _ in range(num_rounds):
+            population.run_tick()
+        return num_rounds * num_people, None
+
+    def setup_replica_batch():
+        rng = np.random.default_rng(seed)
+        all_possible_actions, rooms = make_action_table(num_actions, rng), make_rooms(num_rooms)
+        return replicas.ReplicaBatch([metacode_helpers.initialise_population(
+            all_possible_actions, rooms, num_people=num_people, rng=np.random.default_rng(seed + replica),
+            names_filepath=simulation.DEFAULT_NAMES_FILEPATH) for replica in range(NUM_REPLICAS)])
+
+    def run_replica_batch_rounds(batch):
+        for round_number in range(num_rounds):
+            batch.run_round(round_number)
+        return num_rounds * num_people * len(batch), None
+
+    def setup_initialise():
+        rng = np.random.default_rng(seed)
+        return make_action_table(num_actions, rng), make_rooms(num_rooms), rng
+
+    return [
+        Benchmark("initialise_all_people", params, setup_initialise, run_initialise_all_people),
+        Benchmark("initialise_population", params, setup_initialise, run_initialise_population),
+        Benchmark("person.action_selection", params, setup_people, run_action_selection),
+        Benchmark("person.update_emotional_state_vector", params, setup_people, run_update_emotional_state_vector),
+        Benchmark("room.get_new_conversation_partner_for", params, setup_people, run_get_new_conversation_partner_for),
+        Benchmark("room_graph.sample_neighbours", params, setup_room_graph, run_sample_neighbours),
+        *[Benchmark(f"emotional_probs.{mode}", params, setup_emotional_probs(mode), run_emotional_probs) for mode in emotional_probs.LOOKUP_MODES],
+        Benchmark("person_round", dict(params, num_rounds=num_rounds), setup_people, run_person_rounds),
+        Benchmark("population_round", dict(params, num_rounds=num_rounds), setup_population, run_population_rounds),
+        Benchmark("replica_batch_round", dict(params, num_rounds=num_rounds, num_replicas=NUM_REPLICAS), setup_replica_batch, run_replica_batch_rounds),
+        Benchmark("population_tick", dict(params, num_rounds=num_rounds), setup_population, run_population_ticks),
+    ]
+
+
+def get_sweep(sweep: Dict[str, List[int]]) -> List[tuple]:
+    """Returns the (num_people, num_rooms, num_actions) combinations of a sweep.
+    Each dimension is swept on its own, with the defaults for the other two."""
+    combinations = [(num_people, DEFAULT_NUM_ROOMS, DEFAULT_NUM_ACTIONS) for num_people in sweep["num_people"]]
+    combinations += [(DEFAULT_NUM_PEOPLE, num_rooms, DEFAULT_NUM_ACTIONS) for num_rooms in sweep["num_rooms"]]
+    combinations += [(DEFAULT_NUM_PEOPLE, DEFAULT_NUM_ROOMS, num_actions) for num_actions in sweep["num_actions"]]
+    # Remove duplicates, keeping the order
+    return list(dict.fromkeys(combinations))
+
+
+def run_benchmarks(sweep: Dict[str, List[int]], repeats: int = 3, measure_memory: bool = True, name_filter: str | None = None, verbose: bool = True) -> dict:
+    """Runs every benchmark for every combination in the sweep, and returns the report"""
+    results = []
+    for num_people, num_rooms, num_actions in get_sweep(sweep):
+        for benchmark in get_benchmarks(num_people, num_rooms, num_actions):
+            if name_filter is not None and name_filter not in benchmark.get_key():
+                continue
+            result = benchmark.measure(repeats=repeats, measure_memory=measure_memory)
+            if verbose:
+                print(f"{result['key']}: {result['operations_per_second']:.0f} ops/s", file=sys.stderr)
+            results.append(result)
+    return {
+        "environment": {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform()},
+        "results": results,
+    }
+
+
+def compare_reports(baseline: dict, current: dict, tolerance: float = 0.2) -> List[dict]:
+    """Compares the throughput of every benchmark present in both reports.
+    Returns the comparisons, where a benchmark has regressed if it is more than `tolerance` (a fraction) slower."""
+    baseline_results = {result["key"]: result for result in baseline["results"]}
+    comparisons = []
+    for result in current["results"]:
+        if result["key"] not in baseline_results:
+            continue
+        baseline_ops = baseline_results[result["key"]]["operations_per_second"]
+        ratio = result["operations_per_second"] / baseline_ops
+        comparisons.append({"key": result["key"], "baseline_operations_per_second": baseline_ops,
+                            "operations_per_second": result["operations_per_second"], "ratio": ratio, "regressed": ratio < 1 - tolerance})
+    return comparisons
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Command line entry point (run `python benchmark.py --help` for the options)"""
+    parser = argparse.ArgumentParser(description="Benchmark the simulation hot paths, and optionally compare against a baseline report.")
+    parser.add_argument("--output", default=None, help="file to write the JSON report to (default: stdout)")
+    parser.add_argument("--quick", action="store_true", help="run a small sweep")
+    parser.add_argument("--num-people", type=int, nargs="+", default=None, help="agent counts to sweep")
+    parser.add_argument("--num-rooms", type=int, nargs="+", default=None, help="room counts to sweep")
+    parser.add_argument("--num-actions", type=int, nargs="+", default=None, help="action catalogue sizes to sweep")
+    parser.add_argument("--filter", default=None, help="only run benchmarks whose key contains this")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory measurement")
+    parser.add_argument("--compare", default=None, help="baseline JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="fractional slowdown allowed before a benchmark counts as a regression")
+    args = parser.parse_args(argv)
+
+    sweep = dict(QUICK_SWEEP if args.quick else FULL_SWEEP)
+    for dimension in sweep:
+        if getattr(args, dimension) is not None:
+            sweep[dimension] = getattr(args, dimension)
+    report = run_benchmarks(sweep, repeats=args.repeats, measure_memory=not args.no_memory, name_filter=args.filter)
+
+    exit_code = 0
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            comparisons = compare_reports(json.load(baseline_file), report, args.tolerance)
+        report["comparison"] = {"baseline": args.compare, "tolerance": args.tolerance, "benchmarks": comparisons}
+        for comparison in comparisons:
+            print(f"{'REGRESSED' if comparison['regressed'] else 'ok':>9} {comparison['ratio']:6.2f}x {comparison['key']}", file=sys.stderr)
+        exit_code = 1 if any(comparison["regressed"] for comparison in comparisons) else 0
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=1)
+    else:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=1)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
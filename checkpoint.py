@@ -0,0 +1,97 @@
+from __future__ import annotations
+import json
+import os
+import pickle
+import numpy as np
+from typing import List
+from population import Population
+
+# A checkpoint is a single uncompressed .npz holding every array of Population.get_state(), the state of the
+# population's generator, and a JSON metadata dict (e.g. the round number). The object graph (people, rooms,
+# partners) is stored as index arrays, so there are no cycles to serialise, and writing is a sequence of raw
+# array dumps. Restoring rebuilds the population exactly, so a restored run continues with the same draws.
+# The streaming aggregators of a run (see aggregators.py) may be saved with it, pickled, so that a resumed run's
+# summaries still cover the rounds before the checkpoint.
+
+CHECKPOINT_FORMAT_VERSION = 1
+RNG_STATE_KEY = "rng_state"
+METADATA_KEY = "metadata"
+FORMAT_VERSION_KEY = "format_version"
+AGGREGATORS_KEY = "aggregators"
+
+
+def get_rng_state(rng: np.random.Generator) -> str:
+    """Returns the state of a generator as a JSON string"""
+    return json.dumps(rng.bit_generator.state)
+
+
+def make_rng(rng_state: str) -> np.random.Generator:
+    """Returns a generator in the given state (from get_rng_state())"""
+    state = json.loads(rng_state)
+    bit_generator = getattr(np.random, state["bit_generator"])()
+    bit_generator.state = state
+    return np.random.Generator(bit_generator)
+
+
+def save_checkpoint(population: Population, checkpoint_filepath: str, metadata: dict | None = None, aggregators: list | None = None):
+    """Writes the full state of a population (including its generator), and optionally its run's aggregators, to a
+    checkpoint file. The file is written to a temporary file first, so an interrupted save never replaces a good checkpoint."""
+    arrays = dict(population.get_state())
+    if aggregators is not None:
+        arrays[AGGREGATORS_KEY] = np.frombuffer(pickle.dumps(aggregators), dtype=np.uint8)
+    arrays[RNG_STATE_KEY] = np.array(get_rng_state(population.get_rng()))
+    arrays[METADATA_KEY] = np.array(json.dumps(metadata if metadata is not None else {}))
+    arrays[FORMAT_VERSION_KEY] = np.array(CHECKPOINT_FORMAT_VERSION)
+    directory = os.path.dirname(os.path.abspath(checkpoint_filepath))
+    os.makedirs(directory, exist_ok=True)
+    temporary_filepath = f"{checkpoint_filepath}.{os.getpid()}.tmp"
+    with open(temporary_filepath, "wb") as checkpoint_file:
+        np.savez(checkpoint_file, **arrays)
+    os.replace(temporary_filepath, checkpoint_filepath)
+
+
+def read_checkpoint(checkpoint_filepath: str) -> dict:
+    """Reads every array of a checkpoint file into memory"""
+    with np.load(checkpoint_filepath) as arrays:
+        checkpoint = {name: arrays[name] for name in arrays.files}
+    assert int(checkpoint[FORMAT_VERSION_KEY]) == CHECKPOINT_FORMAT_VERSION, \
+        f"Unsupported checkpoint format version {int(checkpoint[FORMAT_VERSION_KEY])}"
+    return checkpoint
+
+
+def get_checkpoint_metadata(checkpoint: dict) -> dict:
+    """Returns the metadata dict saved with a checkpoint (from read_checkpoint())"""
+    return json.loads(str(checkpoint[METADATA_KEY]))
+
+
+def load_checkpoint(checkpoint_filepath: str) -> tuple:
+    """Restores a population from a checkpoint file, with its generator in the saved state.
+    Returns (population, metadata)."""
+    checkpoint = read_checkpoint(checkpoint_filepath)
+    population = Population.from_state(
+        checkpoint, rng=make_rng(str(checkpoint[RNG_STATE_KEY])))
+    return population, get_checkpoint_metadata(checkpoint)
+
+
+def load_checkpoint_aggregators(checkpoint_filepath: str) -> list | None:
+    """Returns the aggregators saved in a checkpoint file (None if it has none), without reading the population"""
+    with np.load(checkpoint_filepath) as arrays:
+        if AGGREGATORS_KEY not in arrays.files:
+            return None
+        return pickle.loads(arrays[AGGREGATORS_KEY].tobytes())
+
+
+def fork_checkpoint(checkpoint_filepath: str, num_forks: int, seed: int | np.random.SeedSequence | None = None) -> List[Population]:
+    """Restores num_forks independent populations from one checkpoint, to continue in different directions.
+    The file is read once, and the forks share its action table & room graph. Each fork gets its own generator,
+    spawned from the given seed, so the forks diverge (restore with load_checkpoint() to continue the saved draws)."""
+    checkpoint = read_checkpoint(checkpoint_filepath)
+    # Each fork also takes a new key for the draws of synchronous ticks from its own generator
+    checkpoint.pop("tick_key", None)
+    seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    forks = []
+    for child_seed_sequence in seed_sequence.spawn(num_forks):
+        forks.append(Population.from_state(checkpoint, rng=np.random.default_rng(child_seed_sequence),
+                                           action_table=forks[0].get_action_table() if forks else None,
+                                           room_graph=forks[0].get_room_graph() if forks else None))
+    return forks
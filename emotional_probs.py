@@ -0,0 +1,150 @@
+from __future__ import annotations
+from collections import OrderedDict
+import numpy as np
+from action_table import ActionTable
+
+# Emotional action probabilities depend only on the 3D emotional state, which lies in [-1, 1]^3, so they can be
+# precomputed. Both lookups below have the same get_emotional_action_probs() method as ActionTable, so either can
+# be given to a Population (or Person) in place of the exact computation.
+
+LOOKUP_MODES = ("exact", "cached", "nearest", "trilinear")
+
+
+class EmotionalActionProbsGrid:
+    """Emotional action probabilities precomputed on a lattice of resolution^3 PAD points (resolution per
+    dimension, including both ends of [-1, 1]). Lookups use the nearest lattice point, or trilinear interpolation
+    between the 8 surrounding points (which is still a probability distribution). States outside [-1, 1]^3 are
+    clipped onto it. get_max_error() reports the largest difference from the exact probabilities."""
+
+    def __init__(self, action_table: ActionTable, resolution: int = 21, interpolation: str = "trilinear"):
+        assert resolution >= 2, "The lattice needs at least 2 points per dimension"
+        assert interpolation in ("nearest", "trilinear"), "interpolation must be nearest or trilinear"
+        self.__action_table = action_table
+        self.__resolution = resolution
+        self.__interpolation = interpolation
+        self.__max_error = None
+        points = np.linspace(-1, 1, resolution)
+        lattice = np.stack(np.meshgrid(points, points, points, indexing="ij"), axis=-1).reshape(-1, 3)
+        self.__probs = action_table.get_emotional_action_probs(lattice).reshape(
+            resolution, resolution, resolution, len(action_table))
+        self.__probs.flags.writeable = False
+
+    def __repr__(self) -> str:
+        return f"EmotionalActionProbsGrid({self.__resolution}^3 points, {self.__interpolation})"
+
+    def get_action_table(self) -> ActionTable:
+        """Returns the action table the probabilities were computed from"""
+        return self.__action_table
+
+    def get_resolution(self) -> int:
+        """Returns the number of lattice points per PAD dimension"""
+        return self.__resolution
+
+    def get_interpolation(self) -> str:
+        """Returns the interpolation used for lookups (nearest or trilinear)"""
+        return self.__interpolation
+
+    def get_emotional_action_probs(self, emotional_state_vectors: np.array) -> np.array:
+        """Returns the (N x A) emotional action probabilities for a (N x 3) block of emotional state vectors"""
+        # Position of each state on the lattice, in units of lattice spacing
+        positions = (np.clip(np.asarray(emotional_state_vectors, dtype=float), -1, 1) + 1) * ((self.__resolution - 1) / 2)
+        if self.__interpolation == "nearest":
+            i, j, k = np.rint(positions).astype(np.int64).T
+            return self.__probs[i, j, k]
+
+        lower_corners = np.minimum(positions.astype(np.int64), self.__resolution - 2)
+        fractions = positions - lower_corners
+        # Gather all 8 surrounding lattice points at once (as flat indices), weighted by the product of the fractions
+        corner_offsets = (np.arange(8)[:, None] >> np.arange(2, -1, -1)) & 1  # (8 x 3)
+        flat_indices = (lower_corners[:, None, :] + corner_offsets[None, :, :]) @ (self.__resolution ** np.arange(2, -1, -1))
+        weights = np.where(corner_offsets[None, :, :], fractions[:, None, :], 1 - fractions[:, None, :]).prod(axis=2)
+        flat_probs = self.__probs.reshape(-1, self.__probs.shape[-1])
+        return np.einsum("nc,nca->na", weights, flat_probs[flat_indices])
+
+    def get_max_error(self, num_samples: int = 10000, rng: np.random.Generator | None = None) -> float:
+        """Returns the largest absolute difference between a looked up and an exact probability, over the centre
+        of every lattice cell and num_samples random states (measured once, then cached)"""
+        if self.__max_error is None:
+            rng = rng if rng is not None else np.random.default_rng(0)
+            centres = np.linspace(-1, 1, self.__resolution)[:-1] + 1 / (self.__resolution - 1)
+            states = np.vstack((np.stack(np.meshgrid(centres, centres, centres, indexing="ij"), axis=-1).reshape(-1, 3),
+                                rng.uniform(-1, 1, size=(num_samples, 3))))
+            max_error = 0.0
+            # In batches, to bound the memory of the (states x A) arrays
+            for batch in np.array_split(states, max(1, len(states) // 4096)):
+                max_error = max(max_error, float(np.abs(self.get_emotional_action_probs(batch) -
+                                                        self.__action_table.get_emotional_action_probs(batch)).max()))
+            self.__max_error = max_error
+        return self.__max_error
+
+
+class EmotionalActionProbsCache:
+    """Exact emotional action probabilities, memoised in a least-recently-used cache of at most max_size states.
+    Only exactly repeated states hit the cache (e.g. people whose emotional state has not changed since their
+    last turn, or states clipped to a corner of [-1, 1]^3), so the results are identical to the exact computation."""
+
+    def __init__(self, action_table: ActionTable, max_size: int = 65536):
+        assert max_size > 0, "The cache must hold at least one state"
+        self.__action_table = action_table
+        self.__max_size = max_size
+        self.__cache: OrderedDict[bytes, np.array] = OrderedDict()
+        self.__num_hits = 0
+        self.__num_misses = 0
+
+    def __len__(self) -> int:
+        return len(self.__cache)
+
+    def __repr__(self) -> str:
+        return f"EmotionalActionProbsCache({len(self)}/{self.__max_size} states, {self.__num_hits} hits, {self.__num_misses} misses)"
+
+    def get_action_table(self) -> ActionTable:
+        """Returns the action table the probabilities are computed from"""
+        return self.__action_table
+
+    def get_num_hits(self) -> int:
+        """Returns the number of lookups answered from the cache"""
+        return self.__num_hits
+
+    def get_num_misses(self) -> int:
+        """Returns the number of lookups that had to be computed"""
+        return self.__num_misses
+
+    def get_max_error(self) -> float:
+        """Returns the largest difference from the exact probabilities (always 0, as cached values are exact)"""
+        return 0.0
+
+    def get_emotional_action_probs(self, emotional_state_vectors: np.array) -> np.array:
+        """Returns the (N x A) emotional action probabilities for a (N x 3) block of emotional state vectors"""
+        emotional_state_vectors = np.ascontiguousarray(emotional_state_vectors, dtype=float)
+        keys = [emotional_state_vector.tobytes() for emotional_state_vector in emotional_state_vectors]
+        emotional_action_probs = np.empty((len(keys), len(self.__action_table)))
+        misses = []
+        for row, key in enumerate(keys):
+            cached = self.__cache.get(key)
+            if cached is None:
+                misses.append(row)
+            else:
+                self.__cache.move_to_end(key)
+                emotional_action_probs[row] = cached
+        self.__num_hits += len(keys) - len(misses)
+        self.__num_misses += len(misses)
+        if misses:
+            # All misses are computed together, then added to the cache (evicting the least recently used states)
+            emotional_action_probs[misses] = self.__action_table.get_emotional_action_probs(emotional_state_vectors[misses])
+            for row in misses:
+                self.__cache[keys[row]] = emotional_action_probs[row].copy()
+                if len(self.__cache) > self.__max_size:
+                    self.__cache.popitem(last=False)
+        return emotional_action_probs
+
+
+def make_emotional_probs_lookup(action_table: ActionTable, mode: str = "exact", resolution: int = 21, max_size: int = 65536):
+    """Returns the emotional probability lookup for a mode: exact (the action table itself, with no memoisation),
+    cached (exact, with an LRU cache), nearest or trilinear (a precomputed lattice)"""
+    if mode == "exact":
+        return action_table
+    if mode == "cached":
+        return EmotionalActionProbsCache(action_table, max_size=max_size)
+    if mode in ("nearest", "trilinear"):
+        return EmotionalActionProbsGrid(action_table, resolution=resolution, interpolation=mode)
+    raise ValueError(f"Unknown emotional probability lookup mode: {mode}")
@@ -0,0 +1,28 @@
+from __future__ import annotations
+import numpy as np
+from action_table import ActionTable
+
+
+def apply_emotional_updates(emotional_state_vectors: np.array, actors: np.array, partners: np.array, action_ids: np.array, action_table: ActionTable, validate: bool = False):
+    """Applies the emotional changes of a batch of conversational turns to a (N x 3) block of emotional states, in place.
+    For turn i, actors[i] took action action_ids[i] towards partners[i]: the actor gets the action's given change vector,
+    and the partner gets its received change vector. All changes are summed (so a person may appear in several turns),
+    and then every updated emotional state is clipped to [-1, 1] once.
+    This matches applying the turns one at a time unless a person's state crosses a bound part way through the batch."""
+    actors = np.asarray(actors, dtype=np.int64)
+    partners = np.asarray(partners, dtype=np.int64)
+    action_ids = np.asarray(action_ids, dtype=np.int64)
+    if validate:
+        assert actors.shape == partners.shape == action_ids.shape, "Actors, partners & actions must be equal-length vectors"
+        assert np.all((actors >= 0) & (actors < len(emotional_state_vectors))), "Actor out of range"
+        assert np.all((partners >= 0) & (partners < len(emotional_state_vectors))), "Partner out of range"
+        assert np.all(actors != partners), "Cannot have conversation with self"
+        assert np.all((action_ids >= 0) & (action_ids < len(action_table))), "Action id out of range"
+
+    np.add.at(emotional_state_vectors, actors,
+              action_table.get_given_change_vectors()[action_ids])
+    np.add.at(emotional_state_vectors, partners,
+              action_table.get_received_change_vectors()[action_ids])
+    updated = np.concatenate((actors, partners))
+    emotional_state_vectors[updated] = np.clip(
+        emotional_state_vectors[updated], -1, 1)
@@ -0,0 +1,69 @@
+from __future__ import annotations
+import numpy as np
+from typing import Hashable, Iterator
+import sampling
+
+
+class IndexedSet:
+    """A set whose members are also kept in an indexable list, so that membership tests, adds, removes
+    and drawing a uniformly random member are all O(1).
+    Removing a member swaps the last member into its slot, so the order of members is not preserved."""
+
+    def __init__(self, items=()):
+        self.__items = []  # The members, in slot order
+        self.__positions = dict()  # The slot of each member
+        for item in items:
+            self.add(item)
+
+    def __len__(self) -> int:
+        return len(self.__items)
+
+    def __contains__(self, item: Hashable) -> bool:
+        return item in self.__positions
+
+    def __iter__(self) -> Iterator:
+        return iter(self.__items)
+
+    def __getitem__(self, position: int):
+        return self.__items[position]
+
+    def __repr__(self) -> str:
+        return f"IndexedSet({self.__items})"
+
+    def add(self, item: Hashable):
+        """Adds a member to the end of the list"""
+        assert item not in self.__positions, f"{item} is already in the set"
+        self.__positions[item] = len(self.__items)
+        self.__items.append(item)
+
+    def remove(self, item: Hashable):
+        """Removes a member, moving the last member into its slot"""
+        assert item in self.__positions, f"{item} is not in the set"
+        position = self.__positions.pop(item)
+        last_item = self.__items.pop()
+        if position < len(self.__items):
+            self.__items[position] = last_item
+            self.__positions[last_item] = position
+
+    def discard(self, item: Hashable):
+        """Removes a member if present"""
+        if item in self.__positions:
+            self.remove(item)
+
+    def get_position(self, item: Hashable) -> int:
+        """Returns the current slot of a member"""
+        return self.__positions[item]
+
+    def count_excluding(self, item: Hashable) -> int:
+        """Returns the number of members other than the given item"""
+        return len(self.__items) - (item in self.__positions)
+
+    def sample(self, rng: np.random.Generator | None = None, excluding: Hashable | None = None):
+        """Returns a uniformly random member (other than `excluding`, if given), using a single draw"""
+        num_choices = self.count_excluding(excluding)
+        assert num_choices > 0, "No members to choose from"
+        position = sampling.sample_uniform_index(num_choices, rng)
+        # Skip over the excluded member's slot
+        if excluding in self.__positions and position >= self.__positions[excluding]:
+            position += 1
+        return self.__items[position]
@@ -1,7 +1,11 @@
+from __future__ import annotations
 import numpy as np
-import pandas as pd
 from action import Action
+from action_loader import load_action_table
+from action_table import ActionTable
 from person import Person
+from population import Population
+import sampling
 
 import os
 
@@ -10,6 +14,8 @@ def parse_vector(string_vector_iterable: pd.Series) -> pd.Series:
     """
     Parses a pd.Series of vectors in string representation (of form "[x,..,y,z]") into a pd.Series of numpy array objects
     """
+    # pandas is only imported where it is used, so that the simulation itself never imports it
+    import pandas as pd
     parsed_vectors = []
     for vector in string_vector_iterable:
         # If this vector is empty, skip it.
@@ -23,27 +29,35 @@ def parse_vector(string_vector_iterable: pd.Series) -> pd.Series:
 
 
 def initialise_all_actions(action_filepath="action_values.csv"):
-    """This function reads in action initialisation data & returns a np.array of Action objects"""
-    actions_df = pd.read_csv(action_filepath)
-    for col_name in actions_df.columns:
-        if col_name == "action_name" or col_name == "action_type":
-            continue
-        else:
-            actions_df[col_name] = parse_vector(actions_df[col_name])
-
-    actions_initialised = []
-    for _, action in actions_df.iterrows():
-        # initialises action
-        # Use kwargs to pass in the values of the action
-        actions_initialised.append(Action(**action))
-
-    return np.array(actions_initialised)
+    """This function reads in action initialisation data & returns an ActionTable (which iterates over the Action objects).
+    The parsed action file is cached in binary form, so this is fast after the first call (see action_loader.py)."""
+    return load_action_table(action_filepath)
 
 
 def get_names(filepath="names.csv"):
+    import pandas as pd
     return pd.read_csv(filepath, header=None).squeeze("columns")
 
 
+def read_names(filepath="names.csv"):
+    """Returns the names in the names file (one per line) as a list, without using pandas"""
+    with open(filepath) as names_file:
+        return [line.strip() for line in names_file if line.strip()]
+
+
+def get_unique_names(num_people, filepath="names.csv"):
+    """Returns num_people unique names, cycling through the names file and adding a numeric suffix to repeats"""
+    names = read_names(filepath)
+    unique_names = []
+    times_used = dict()
+    for i in range(num_people):
+        name = names[i % len(names)]
+        times_used[name] = times_used.get(name, 0) + 1
+        unique_names.append(
+            name if times_used[name] == 1 else f"{name}_{times_used[name] - 1}")
+    return unique_names
+
+
 def get_personality_vector(personality_number):
     personality_seed = personality_number % 32
     personality_vector_string = bin(personality_seed)[2:]
@@ -52,16 +66,38 @@ def get_personality_vector(personality_number):
     return np.array([int(char) for char in personality_vector_string])
 
 
-def initialise_all_people(all_possible_actions, rooms, num_people=32):
+def initialise_all_people(all_possible_actions, rooms, num_people=32, rng=None, names_filepath="names.csv", state_dtype=float):
+    rng = rng if rng is not None else sampling.get_default_rng()
+    # Compiled once, so that every person shares the same action table
+    all_possible_actions = ActionTable.from_actions(all_possible_actions)
     all_people = []
-    # TODO get_names() should depend on num_people.
-    names = get_names()
+    names = get_unique_names(num_people, names_filepath)
+    # People with the same personality share a (read-only) row of one array
+    personality_vectors = np.array([get_personality_vector(personality_number)
+                                    for personality_number in range(min(num_people, 32))])
+    personality_vectors.flags.writeable = False
     for personality_number in range(num_people):
-        personality_vector = get_personality_vector(personality_number)
-        initial_emotional_state_vector = np.random.uniform(
+        personality_vector = personality_vectors[personality_number % 32]
+        initial_emotional_state_vector = rng.uniform(
             low=-1, high=1, size=3)
-        initial_location_state = np.random.choice(rooms)
+        initial_location_state = rooms[sampling.sample_uniform_index(
+            len(rooms), rng)]
         new_person = Person(name=names[personality_number], location_state=initial_location_state, all_possible_actions=all_possible_actions,
-                            personality_vector=personality_vector, emotional_state_vector=initial_emotional_state_vector, conversation_partner=None)
+                            personality_vector=personality_vector, emotional_state_vector=initial_emotional_state_vector, conversation_partner=None,
+                            state_dtype=state_dtype)
         all_people.append(new_person)
     return all_people
+
+
+def initialise_population(all_possible_actions, rooms, num_people=32, rng=None, names_filepath="names.csv"):
+    """Returns a Population of num_people people, initialised in the same way as initialise_all_people()"""
+    rng = rng if rng is not None else sampling.get_default_rng()
+    names = get_unique_names(num_people, names_filepath)
+    personality_vectors = np.array(
+        [get_personality_vector(personality_number) for personality_number in range(num_people)])
+    initial_emotional_state_vectors = rng.uniform(
+        low=-1, high=1, size=(num_people, 3))
+    initial_locations = sampling.sample_uniform_index(
+        np.full(num_people, len(rooms)), rng)
+    return Population(names=names, rooms=rooms, all_possible_actions=all_possible_actions, personality_vectors=personality_vectors,
+                      emotional_state_vectors=initial_emotional_state_vectors, locations=initial_locations, rng=rng)
@@ -2,18 +2,26 @@
 from __future__ import annotations
 import numpy as np
 from action import Action
+from action_table import ActionProbs, ActionTable
 from typing import List
 import room
+import sampling
 
 
 class Person:
-    def __init__(self, name: str, location_state: room.Room, all_possible_actions: List[Action], personality_vector: np.array = np.zeros(5), emotional_state_vector: np.array = np.zeros(
-            3), conversation_partner: Person | None = None):
+    # No per-person __dict__: a person is only these references & small arrays
+    __slots__ = ("__name", "__action_table", "__personality_vector", "__emotional_state_vector", "__population", "__index",
+                 "__base_action_probs_table", "__base_action_probs_row", "__emotional_probs_lookup", "__conversation_partner", "__location_state",
+                 "__current_action_probs")
+
+    def __init__(self, name: str, location_state: room.Room, all_possible_actions: ActionTable | List[Action], personality_vector: np.array = np.zeros(5), emotional_state_vector: np.array = np.zeros(
+            3), conversation_partner: Person | None = None, state_dtype=float):
         # Initialize the person's name. This MUST be unique.
         self.__name = name
 
-        # Initialise the all possible actions
-        self.__all_possible_actions = all_possible_actions
+        # Initialise the all possible actions (compiled into an ActionTable if given as a list, so pass the same
+        # ActionTable to every person to share it)
+        self.__action_table = ActionTable.from_actions(all_possible_actions)
 
         # Personality (Modelled by the "Big 5" personality scales).
         # OCEAN: openness, conscientiousness, extraversion, agreeableness, neuroticism
@@ -33,25 +41,68 @@ class Person:
         # Pleasure: how much one is happy (1 is highly happy)
         # Arousal: how much one is excited (1 is highly excited)
         # Dominance: how much one is dominant (1 is highly dominant)
-        self.__emotional_state_vector = emotional_state_vector
+        # A private float copy is kept so in-place updates never touch the caller's array.
+        # The state may be kept as float32 (state_dtype=np.float32) to halve its size.
+        self.__emotional_state_vector = np.array(
+            emotional_state_vector, dtype=state_dtype)
+
+        # A standalone person owns its state. People created by Person.from_population()
+        # instead read & write a row of a population.Population's arrays.
+        self.__population = None
+        self.__index = None
 
         # The base action probabilities are derived solely from personality.
         # This means they are static, and do not change over time.
         # N.B. These probabilities are analagous to the emotional_action_probs,
         # but those must be derived for the current emotional state, which changes over time.
-        self.__base_action_probs = None
+        self.__base_action_probs_table = None
+        self.__base_action_probs_row = None
         self.set_base_action_probs()
+        # The emotional action probabilities are computed by the action table, unless a lookup is set
+        # (see emotional_probs.py), which may be shared between people.
+        self.__emotional_probs_lookup = self.__action_table
+
+        # Initialise the conversation partner (before joining the room, which checks whether we are free to chat)
+        self.__conversation_partner = conversation_partner
 
         # Initialise the location state to the given location
         self.__location_state = location_state
         # Add self to the collection of people in the room
         self.__location_state.add_person(self)
 
-        # Initialise the conversation partner
-        self.__conversation_partner = conversation_partner
+        # Final probs of taking actions, by action id (initially all 0 until calculated in action_select())
+        self.__current_action_probs = np.zeros(
+            len(self.__action_table), dtype=state_dtype)
+
+    @classmethod
+    def from_population(cls, population, index: int) -> Person:
+        """Returns a person that is a thin view over row `index` of a population.Population.
+        The personality & emotional state vectors are views into the population's arrays,
+        and location & conversation partner are read from (and written to) its index arrays."""
+        self = cls.__new__(cls)
+        self.__name = population.get_names()[index]
+        self.__action_table = population.get_action_table()
+        self.__personality_vector = population.get_personality_vectors()[index]
+        self.__emotional_state_vector = population.get_emotional_state_vectors()[
+            index]
+        self.__population = population
+        self.__index = index
+        # Everything below lives in the population's arrays.
+        self.__base_action_probs_table = None
+        self.__base_action_probs_row = None
+        self.__emotional_probs_lookup = None
+        self.__location_state = None
+        self.__conversation_partner = None
+        self.__current_action_probs = None
+        return self
 
-        # Final probs of taking actions (initially empty until calculated in action_select()
-        self.__current_action_probs = dict()
+    def get_population(self):
+        """Returns the population this person is a view over (None for a standalone person)"""
+        return self.__population
+
+    def get_index(self) -> int | None:
+        """Returns this person's row in its population (None for a standalone person)"""
+        return self.__index
 
     def get_snapshot(self):
         """Returns a snapshot of the person's current state"""
@@ -59,12 +110,13 @@ class Person:
             "name": self.__name,
             "personality_vector": self.__personality_vector.copy(),
             "emotional_state": self.__emotional_state_vector.copy(),
-            "location_state": self.__location_state.get_name(),
-            "current_action_probs": self.__current_action_probs.copy(),
+            "location_state": self.get_location_state().get_name(),
+            # Kept as a copy of the vector, only expanded into a dict keyed by Action when it is used
+            "current_action_probs": ActionProbs(self.__action_table, self.get_current_action_probs_vector().copy()),
         }
 
         if self.has_conversation_partner():
-            snapshot["conversation_partner"] = self.__conversation_partner.get_name()
+            snapshot["conversation_partner"] = self.get_conversation_partner().get_name()
         else:
             snapshot["conversation_partner"] = None
 
@@ -77,6 +129,10 @@ class Person:
         """Returns the name of the person"""
         return self.__name
 
+    def get_action_table(self) -> ActionTable:
+        """Returns the table of all possible actions"""
+        return self.__action_table
+
     def get_personality_vector(self) -> np.array:
         """Returns the personality vector of the person"""
         return self.__personality_vector
@@ -85,196 +141,191 @@ class Person:
         """Returns the emotional state vector of the person"""
         return self.__emotional_state_vector
 
-    def set_emotional_state_vector(self, emotional_state_vector: np.array):
-        """Sets the emotional state vector of the person"""
-        assert(type(emotional_state_vector) ==
-               np.ndarray), "Emotional state vector must be a numpy array"
-        assert(len(emotional_state_vector) ==
-               3), "Emotional state vector must be 3 dimensional"
-        assert(np.all(emotional_state_vector >= -1) and np.all(emotional_state_vector <= 1)
-               ), "Emotional state vector values must be between -1 and 1"
-        self.__emotional_state_vector = emotional_state_vector
+    def set_emotional_state_vector(self, emotional_state_vector: np.array, validate: bool = True):
+        """Sets the emotional state vector of the person (validate=False skips the checks, for values known to be valid)"""
+        if validate:
+            assert(type(emotional_state_vector) ==
+                   np.ndarray), "Emotional state vector must be a numpy array"
+            assert(len(emotional_state_vector) ==
+                   3), "Emotional state vector must be 3 dimensional"
+            assert(np.all(emotional_state_vector >= -1) and np.all(emotional_state_vector <= 1)
+                   ), "Emotional state vector values must be between -1 and 1"
+        if self.__population is not None:
+            # Through the population, so that it notices the change (e.g. to a prepared turn)
+            self.__population.set_emotional_state_vector(self.__index, emotional_state_vector)
+            return
+        self.__emotional_state_vector[:] = emotional_state_vector
 
     def get_base_action_probs(self) -> dict:
         """Returns the base action probabilities"""
-        return self.__base_action_probs
+        if self.__population is not None:
+            return self.__population.get_base_action_probs_dict(self.__index)
+        return dict(zip(self.__action_table, self.__base_action_probs_table[self.__base_action_probs_row]))
+
+    def get_current_action_probs(self) -> ActionProbs:
+        """Returns the action probabilities used for the most recent action selection, keyed by Action"""
+        if self.__population is not None:
+            return self.__population.get_current_action_probs_dict(self.__index)
+        # Only the actions that were available (non-zero probability) are included
+        return ActionProbs(self.__action_table, self.__current_action_probs.copy())
+
+    def get_current_action_probs_vector(self) -> np.array:
+        """Returns the action probabilities used for the most recent action selection, as an array indexed by action id"""
+        if self.__population is not None:
+            return self.__population.get_current_action_probs()[self.__index]
+        return self.__current_action_probs
 
     def set_base_action_probs(self) -> dict:
         """This function returns the "base action probabilities" for the person, derived solely from the "personality" attribute."""
-        assert(self.__base_action_probs ==
+        assert(self.__base_action_probs_table is
                None), "Base action probabilities already set"
 
-        max_likelihood = 1000  # Arbitrary large number.
-
-        # Initialise an empty dictionary
-        base_action_probs = dict()
-        # Loop through all possible actions
-        for action in self.__all_possible_actions:
-            # Get the "most likely personality" for the action
-            most_likely_personality_vector = action.get_most_likely_personality_vector()
-            # Compute the distance between this person's personality and the most likely personality
-            personality_distance = np.linalg.norm(
-                self.__personality_vector - most_likely_personality_vector)
-            # We want the probability to be inversely proportional to the distance.
-            # That is, the more closely this personality aligns with the "most likely personality" for the action
-            # The more likely this person is to take that action.
-            if personality_distance == 0:
-                # If the distance is 0, then the likelihood is maximum
-                base_action_probs[action] = max_likelihood
-            else:
-                # Otherwise, the likelihood is inversely proportional to the distance (up to the maximum value)
-                # This happens when the distance is less than 0.001 units in magnitude.
-                base_action_probs[action] = min(
-                    1 / personality_distance, max_likelihood)
-        # Normalise the action probabilities to sum to 1
-        self.__base_action_probs = self.normalise_action_probs(
-            base_action_probs)
+        # The likelihood of each action is inversely proportional to the distance between this person's
+        # personality and the "most likely personality" for the action (up to a maximum for a distance of 0).
+        # That is, the more closely this personality aligns with the "most likely personality" for the action
+        # The more likely this person is to take that action.
+        # Stored as a row of a table, indexed by action id. For an archetype personality this is a row of the
+        # action table's shared (read-only) archetype matrix, so each person only keeps a reference & row number.
+        self.__base_action_probs_table, rows = self.__action_table.get_base_action_probs_table(
+            self.__personality_vector[None, :])
+        self.__base_action_probs_row = int(rows[0])
+
+    def get_emotional_probs_lookup(self):
+        """Returns what computes the emotional action probabilities (the action table, unless a lookup has been set)"""
+        if self.__population is not None:
+            return self.__population.get_emotional_probs_lookup()
+        return self.__emotional_probs_lookup
+
+    def set_emotional_probs_lookup(self, emotional_probs_lookup):
+        """Sets what computes the emotional action probabilities (see emotional_probs.py; None for the exact computation)"""
+        assert self.__population is None, "Set the lookup of the population instead"
+        self.__emotional_probs_lookup = emotional_probs_lookup if emotional_probs_lookup is not None else self.__action_table
 
     def get_location_state(self) -> room.Room:
         """Returns location state"""
+        if self.__population is not None:
+            return self.__population.get_room(self.__population.get_locations()[self.__index])
         return self.__location_state
 
     def set_location_state(self, new_location_state: room.Room):
         """Sets the location state of the person"""
-        assert self.__location_state != new_location_state, "Already in this location"
-        assert self.__conversation_partner == None, "Cannot change location while in conversation"
-        self.__location_state = new_location_state
+        assert self.get_location_state() != new_location_state, "Already in this location"
+        assert not self.has_conversation_partner(
+        ), "Cannot change location while in conversation"
+        if self.__population is not None:
+            self.__population.move_to_room(
+                self.__index, self.__population.get_room_index(new_location_state))
+        else:
+            self.__location_state = new_location_state
 
     def has_conversation_partner(self) -> bool:
+        if self.__population is not None:
+            return self.__population.get_conversation_partners()[self.__index] >= 0
         return self.__conversation_partner != None
 
     def get_conversation_partner(self) -> Person | None:
+        if self.__population is not None:
+            partner_index = self.__population.get_conversation_partners()[
+                self.__index]
+            return self.__population.get_person(partner_index) if partner_index >= 0 else None
         return self.__conversation_partner
 
     def set_conversation_partner(self, partner):
         if partner != None:
-            assert(self.__location_state == partner.get_location_state()
+            assert(self.get_location_state() == partner.get_location_state()
                    ), "Partner not in same location"
-            assert(self.__name != partner.get_name()
-                   ), "Cannot have conversation with self"
-
+            # Compared by identity, as names.csv contains repeated names
+            assert(partner is not self), "Cannot have conversation with self"
+
+        if self.__population is not None:
+            self.__population.set_conversation_partner(
+                self.__index, -1 if partner == None else partner.get_index())
+            return
+
+        # Keep the room's index of people who are free to chat up to date
+        if self.__conversation_partner == None and partner != None:
+            self.__location_state.remove_free_person(self)
+        elif self.__conversation_partner != None and partner == None:
+            self.__location_state.add_free_person(self)
         self.__conversation_partner = partner
 
     def get_emotional_action_probs(self) -> dict:
         """This function returns the "emotional action probabilities" for the person,
         derived solely from the "emotional_state_vector" attribute."""
 
-        # Initialise an empty dictionary
-        emotional_action_probs = dict()
-        # Loop through all possible actions
-        for action in self.__all_possible_actions:
-            # Get the "most likely emotional state" for the action
-            most_likely_emotional_vector = action.get_most_likely_emotional_vector()
-            # Compute the distance between this person's emotional state and the most likely emotional state
-            emotional_state_distance = np.linalg.norm(
-                self.__emotional_state_vector - most_likely_emotional_vector)
-            # We want the probability to be inversely proportional to the distance.
-            # That is, the more closely this person's emotional state aligns with the "most likely emotional state" for the action
-            # The more likely this person is to take that action.
-            emotional_action_probs[action] = 1 / emotional_state_distance
-        # Normalise the action probabilities to sum to 1
-        emotional_action_probs = self.normalise_action_probs(
-            emotional_action_probs)
-        return emotional_action_probs
-
-    def normalise_action_probs(self, probs: dict) -> dict:
-        total_sum = sum(probs.values())
-        # Normalise the relevant probabilities so they sum to 1
-        return {action: likelihood/total_sum for action, likelihood in probs.items()}
-
-    def filter_action_probs(self, probs_dict: dict, available_conv_act: List[Action] = [], available_room_act: List[Action] = []) -> dict:
-        """This function filters out the invalid actions from ALL action probabilities."""
-        filtered_probs = dict()
-        total_sum = 0
-        # add only actions in available_conv_act
-        for action in available_conv_act:
-            filtered_probs[action] = probs_dict[action]
-            total_sum += probs_dict[action]
-
-        # add only actions in available_room_act
-        for action in available_room_act:
-            filtered_probs[action] = probs_dict[action]
-            total_sum += probs_dict[action]
-
-        filtered_probs = self.normalise_action_probs(filtered_probs)
-
-        return filtered_probs
-
-    def combine_emotion_base_probs(self, emotion_probs: dict, base_probs: dict, weighting: float = 0.5) -> dict:
-        """This function combines the emotional action probabilities with the base action probabilities, and returns the result as a dictionary"""
-        assert weighting >= 0 and weighting <= 1, "weighting must be between 0 and 1"
-        assert emotion_probs.keys() == base_probs.keys(
-        ), "Emotion and base action probabilities must have the same actions as keys"
-
-        combined_probs = dict()
-        for key in emotion_probs.keys():
-            combined_probs[key] = (
-                emotion_probs[key] * weighting + base_probs[key] / (1 + weighting))
-        combined_probs = self.normalise_action_probs(combined_probs)
-
-        return combined_probs
-
-    def action_selection(self, available_conv_act: List[Action] = [], available_room_act: List[Action] = []) -> Action:
+        # The likelihood of each action is inversely proportional to the distance between this person's emotional state
+        # and the "most likely emotional state" for the action.
+        # That is, the more closely this person's emotional state aligns with the "most likely emotional state" for the action
+        # The more likely this person is to take that action.
+        emotional_action_probs = self.get_emotional_probs_lookup().get_emotional_action_probs(
+            self.__emotional_state_vector[None, :])[0]
+        return dict(zip(self.__action_table, emotional_action_probs))
+
+    def action_selection(self, available_conv_act: List[Action] = [], available_room_act: List[Action] = [], rng: np.random.Generator | None = None) -> Action:
         """This function selects an action from the given available actions."""
+        if self.__population is not None:
+            # The population computes (and records) the distribution for this row, using its own generator.
+            return self.__population.action_selection(self.__index, available_conv_act, available_room_act)
+
         # Get action probabilities for ALL actions, based on persons current emotional state
-        emotional_action_probs = self.get_emotional_action_probs()
+        emotional_action_probs = self.__emotional_probs_lookup.get_emotional_action_probs(
+            self.__emotional_state_vector[None, :])[0]
 
         # If available_conv_act or available_room_act are given, then filter out the invalid actions
         if available_conv_act or available_room_act:
-            # filter to get the (emotional and base) distribution for only AVAILABLE actions.
-            filtered_emotional_probs = self.filter_action_probs(
-                emotional_action_probs, available_conv_act, available_room_act)
-            filtered_base_probs = self.filter_action_probs(
-                self.__base_action_probs, available_conv_act, available_room_act)
+            available_mask = self.__action_table.get_action_mask(
+                list(available_conv_act) + list(available_room_act))
         else:  # If no available actions are given, then use the full distributions
-            filtered_emotional_probs = emotional_action_probs
-            filtered_base_probs = self.__base_action_probs
+            available_mask = np.ones(len(self.__action_table), dtype=bool)
 
-        # Combine the two distributions
-        combined_probs = self.combine_emotion_base_probs(
-            filtered_emotional_probs, filtered_base_probs)
+        # Filter & combine the (emotional and base) distributions, for only AVAILABLE actions
+        combined_probs = self.__action_table.combine_action_probs(
+            emotional_action_probs, self.__base_action_probs_table[self.__base_action_probs_row], available_mask)
 
-        self.__current_action_probs = combined_probs
+        # Written in place, keeping the dtype of the state
+        self.__current_action_probs[:] = combined_probs
 
         # Select an action based on the combined distribution
-        action = np.random.choice(
-            list(combined_probs.keys()), p=list(combined_probs.values()))
+        action = self.__action_table[sampling.sample_categorical(
+            combined_probs, rng)]
 
         return action
 
     # Method to handle updating emotional_state_vector (for either own action, and partner's action)
     def update_emotional_state_vector(self, action: Action, isOwnAction: bool):
+        if self.__population is not None:
+            # Through the population, so that it notices the change (e.g. to a prepared turn)
+            self.__population.update_emotional_state_vectors(
+                [self.__index], [self.__action_table.get_action_id(action)], isOwnAction)
+            return
+
         # Get the vector to use in the update from the action, depending on whether it is the own action or the partner's action
         change_vector = action.get_given_emotional_change_vector(
         ) if isOwnAction else action.get_received_emotional_change_vector()
 
-        # Get the new emotional state vector by adding state and change vectors
-        new_emotional_state_vector = self.get_emotional_state_vector(
-        ) + change_vector
-
-        # Ensure the emotional state vector remains in the range [-1,1] for all dimensions
-        for i, dim in enumerate(new_emotional_state_vector):
-            # If the emotional state vector has gone negative, set it to 0
-            if dim < -1:
-                new_emotional_state_vector[i] = -1
-            elif dim > 1:
-                new_emotional_state_vector[i] = 1
-
-        # Set the new emotional state vector
-        self.set_emotional_state_vector(new_emotional_state_vector)
+        # Add the change vector to the emotional state vector, and ensure it remains in the range [-1,1]
+        # for all dimensions. Both are done in place, and the result needs no further validation.
+        emotional_state_vector = self.get_emotional_state_vector()
+        np.add(emotional_state_vector, change_vector, out=emotional_state_vector)
+        np.clip(emotional_state_vector, -1, 1, out=emotional_state_vector)
 
     # Methods to handle special non-conversation actions
     def leave_conversation(self):
         """This function handles the special case of a person leaving a conversation."""
-        assert self.__conversation_partner != None, "No conversation partner to leave"
-        if self.__conversation_partner.has_conversation_partner():
-            self.__conversation_partner.leave_conversation()
-        self.__conversation_partner = None
+        partner = self.get_conversation_partner()
+        assert partner != None, "No conversation partner to leave"
+        self.set_conversation_partner(None)
+        if partner.has_conversation_partner():
+            partner.leave_conversation()
 
     def move_to_room(self, room):
         """This function handles the special case of a person moving to a new room."""
         from_room = self.get_location_state()
         to_room = room
+        if self.__population is not None:
+            # Room occupancy of a population is tracked by its locations array.
+            self.set_location_state(to_room)
+            return
         # Remove self from the current room
         from_room.remove_person(self)
         # Update own location state to the new room
@@ -282,7 +333,10 @@ class Person:
         # Add self to the new room 'people set'
         to_room.add_person(self)
 
-    def get_next_room(self) -> room.Room:
+    def get_next_room(self, rng: np.random.Generator | None = None) -> room.Room:
         """Selects & returns the next room to go to"""
         # For now, this selection is uniformly random.
-        return np.random.choice(list(self.get_location_state().get_adjacent_rooms()))
+        # Sorted by name, so that the choice for a given seed does not depend on set ordering.
+        adjacent_rooms = sorted(self.get_location_state(
+        ).get_adjacent_rooms(), key=lambda adjacent_room: adjacent_room.get_name())
+        return adjacent_rooms[sampling.sample_uniform_index(len(adjacent_rooms), rng)]
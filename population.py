@@ -0,0 +1,546 @@
+from __future__ import annotations
+import numpy as np
+from action import Action
+from action_table import ActionProbs, ActionTable
+from emotional_updates import apply_emotional_updates
+from indexed_set import IndexedSet
+from person import Person
+from room_graph import RoomGraph
+from typing import Dict, List
+import room
+import sampling
+import scheduler
+
+# The kinds of available actions a person may have (see get_available_action_kinds())
+CONVERSATION_ACTIONS, ROOM_ACTIONS, ROOM_ACTIONS_WITHOUT_START = 0, 1, 2
+# When a person's prepared turn is no longer valid, the invalid turns of up to this many people from them on are
+# prepared again together (see select_turn_action())
+TURN_BATCH_SIZE = 256
+
+
+class Population:
+    """Struct-of-arrays state for a whole population of agents.
+
+    Personalities (N x 5), emotional states (N x 3), locations (room index) and
+    conversation partners (person index, -1 for none) are held in contiguous arrays,
+    so probability & sampling work for many agents runs as batched matrix operations.
+    Rooms are only used for their names & adjacency (compiled into a RoomGraph); occupancy is the locations array.
+    Person objects for individual agents are thin views obtained with get_person().
+    All random draws use the population's own np.random.Generator.
+    """
+
+    def __init__(self, names: List[str], rooms: List[room.Room] | RoomGraph, all_possible_actions: ActionTable | List[Action], personality_vectors: np.array, emotional_state_vectors: np.array, locations: np.array, conversation_partners: np.array | None = None, rng: np.random.Generator | None = None, emotional_probs_lookup=None):
+        num_people = len(names)
+        self.__rng = rng if rng is not None else sampling.get_default_rng()
+
+        # Initialise the names. These MUST be unique.
+        self.__names = list(names)
+        self.__name_indices = {name: i for i, name in enumerate(self.__names)}
+        assert len(self.__name_indices) == num_people, "Names must be unique"
+
+        # Initialise the rooms, and the adjacency between them as room indices (in CSR form).
+        # Rooms may be given as a RoomGraph (e.g. a generated building), in which case Room objects are created for it.
+        if isinstance(rooms, RoomGraph):
+            self.__room_graph = rooms
+            self.__rooms = rooms.build_rooms()
+        else:
+            self.__rooms = list(rooms)
+            self.__room_graph = RoomGraph.from_rooms(self.__rooms)
+        self.__room_indices = {r: i for i, r in enumerate(self.__rooms)}
+
+        # Compile the actions into dense arrays, indexed by action id
+        self.__action_table = ActionTable.from_actions(all_possible_actions)
+        self.__starts_conversation_id = self.__action_table.get_action_id(
+            "starts_conversation") if "starts_conversation" in self.__action_table else -1
+        self.__leaves_conversation_id = self.__action_table.get_action_id(
+            "leaves_conversation") if "leaves_conversation" in self.__action_table else -1
+        self.__leaves_room_id = self.__action_table.get_action_id(
+            "leaves_room") if "leaves_room" in self.__action_table else -1
+        isolated_room_ids = np.flatnonzero(self.__room_graph.get_degrees() == 0)
+        assert self.__leaves_room_id < 0 or len(isolated_room_ids) == 0, \
+            f"Every room must be adjacent to another room, for people to leave it (not {[self.__room_graph.get_room_names()[i] for i in isolated_room_ids]})"
+        # The mask of available actions of each kind, indexed by kind
+        room_action_mask_without_start = self.__action_table.get_room_action_mask().copy()
+        if self.__starts_conversation_id >= 0:
+            room_action_mask_without_start[self.__starts_conversation_id] = False
+        self.__action_kind_masks = np.stack((self.__action_table.get_conversation_action_mask(),
+                                             self.__action_table.get_room_action_mask(), room_action_mask_without_start))
+        # The action probabilities prepared for each person's next turn by prepare_turns() (allocated on first use),
+        # the kind of available actions they were computed for, and whether they are still valid
+        self.__turn_probs = None
+        self.__turn_action_kinds = np.zeros(num_people, dtype=np.int8)
+        self.__is_turn_prepared = np.zeros(num_people, dtype=bool)
+        # Computes the emotional action probabilities (the action table itself, or a lookup from emotional_probs.py)
+        self.__emotional_probs_lookup = self.__action_table
+        if emotional_probs_lookup is not None:
+            self.set_emotional_probs_lookup(emotional_probs_lookup)
+
+        # Initialise the state arrays (copied, so that the population owns them)
+        self.__personality_vectors = np.array(personality_vectors, dtype=float)
+        self.__emotional_state_vectors = np.array(
+            emotional_state_vectors, dtype=float)
+        self.__locations = np.array(locations, dtype=np.int64)
+        if conversation_partners is None:
+            conversation_partners = np.full(num_people, -1)
+        self.__conversation_partners = np.array(
+            conversation_partners, dtype=np.int64)
+        assert self.__personality_vectors.shape == (
+            num_people, 5), "Personality vectors must be (N x 5)"
+        assert self.__emotional_state_vectors.shape == (
+            num_people, 3), "Emotional state vectors must be (N x 3)"
+        assert self.__locations.shape == (
+            num_people,), "Locations must be a vector of room indices"
+        assert self.__conversation_partners.shape == (
+            num_people,), "Conversation partners must be a vector of person indices"
+
+        # The base action probabilities depend only on personality, so are computed once.
+        # Each person points at a row of a (read-only) table, shared with other populations for archetype personalities.
+        self.__base_action_probs_table, self.__base_action_probs_rows = self.__action_table.get_base_action_probs_table(
+            self.__personality_vectors)
+        # Final probs of taking actions (all 0 until an action has been selected)
+        self.__current_action_probs = np.zeros(
+            (num_people, len(self.__action_table)))
+
+        # The people in each room who are free to chat, kept up to date by the state-changing methods
+        # below, so that finding (or counting) free conversation partners is O(1).
+        # A synchronous tick (run_tick()) only recomputes the counts: the sets are rebuilt when next needed.
+        self.__free_people = [IndexedSet() for _ in self.__rooms]
+        self.__free_counts = np.zeros(len(self.__rooms), dtype=np.int64)
+        self.__free_index_valid = True
+        for i in np.flatnonzero(self.__conversation_partners < 0):
+            self.__mark_free(i)
+
+        # The counter-based draws of synchronous ticks are keyed by a key taken from the generator on first use
+        # (-1 until then), and the number of ticks run so far (see scheduler.py)
+        self.__tick_key = -1
+        self.__tick_number = 0
+
+        # Person views are created on demand, and reused so that identity comparisons work.
+        self.__people: Dict[int, Person] = dict()
+
+    def __len__(self) -> int:
+        return len(self.__names)
+
+    def __repr__(self) -> str:
+        return f"Population of {len(self)} people in {len(self.__rooms)} rooms"
+
+    # Getters for the underlying arrays (returned without copying)
+    def get_rng(self) -> np.random.Generator:
+        """Returns the generator used for all random draws"""
+        return self.__rng
+
+    def set_rng(self, rng: np.random.Generator):
+        """Sets the generator used for all random draws"""
+        self.__rng = rng
+
+    def get_names(self) -> List[str]:
+        """Returns the names of all people"""
+        return self.__names
+
+    def get_rooms(self) -> List[room.Room]:
+        """Returns all rooms, in room index order"""
+        return self.__rooms
+
+    def get_room_graph(self) -> RoomGraph:
+        """Returns the room adjacency, with rooms identified by room index"""
+        return self.__room_graph
+
+    def get_action_table(self) -> ActionTable:
+        """Returns the action table (which iterates over all actions, in action id order)"""
+        return self.__action_table
+
+    def get_emotional_probs_lookup(self):
+        """Returns what computes the emotional action probabilities (the action table, unless a lookup has been set)"""
+        return self.__emotional_probs_lookup
+
+    def set_emotional_probs_lookup(self, emotional_probs_lookup):
+        """Sets what computes the emotional action probabilities (see emotional_probs.py; None for the exact computation)"""
+        if emotional_probs_lookup is None:
+            emotional_probs_lookup = self.__action_table
+        if emotional_probs_lookup is not self.__action_table:
+            assert emotional_probs_lookup.get_action_table().get_fingerprint(
+            ) == self.__action_table.get_fingerprint(), "Lookup must be for the population's actions"
+        self.__emotional_probs_lookup = emotional_probs_lookup
+        self.__is_turn_prepared[:] = False
+
+    def get_personality_vectors(self) -> np.array:
+        """Returns the (N x 5) personality vectors"""
+        return self.__personality_vectors
+
+    def get_emotional_state_vectors(self) -> np.array:
+        """Returns the (N x 3) emotional state vectors"""
+        return self.__emotional_state_vectors
+
+    def get_locations(self) -> np.array:
+        """Returns the room index of every person"""
+        return self.__locations
+
+    def get_conversation_partners(self) -> np.array:
+        """Returns the conversation partner index of every person (-1 for none)"""
+        return self.__conversation_partners
+
+    def get_base_action_probs(self, indices: np.array | None = None) -> np.array:
+        """Returns the (n x A) base action probabilities for the given people (default everyone)"""
+        if indices is None:
+            return self.__base_action_probs_table[self.__base_action_probs_rows]
+        return self.__base_action_probs_table[self.__base_action_probs_rows[indices]]
+
+    def get_base_action_probs_table(self) -> np.array:
+        """Returns the (read-only) table of base action probabilities that get_base_action_probs_rows() index into"""
+        return self.__base_action_probs_table
+
+    def get_base_action_probs_rows(self) -> np.array:
+        """Returns the row of the shared base action probabilities table used by each person"""
+        return self.__base_action_probs_rows
+
+    def get_current_action_probs(self) -> np.array:
+        """Returns the (N x A) action probabilities used for each person's most recent action selection"""
+        return self.__current_action_probs
+
+    # Lookups between indices and objects
+    def get_index(self, name: str) -> int:
+        """Returns the index of the person with the given name"""
+        return self.__name_indices[name]
+
+    def get_person(self, index: int) -> Person:
+        """Returns a Person that is a view over the given row"""
+        index = int(index)
+        if index not in self.__people:
+            self.__people[index] = Person.from_population(self, index)
+        return self.__people[index]
+
+    def get_people(self) -> List[Person]:
+        """Returns Person views for every row"""
+        return [self.get_person(i) for i in range(len(self))]
+
+    def get_room(self, room_index: int) -> room.Room:
+        """Returns the room with the given index"""
+        return self.__rooms[room_index]
+
+    def get_room_index(self, room_to_find: room.Room) -> int:
+        """Returns the index of the given room"""
+        return self.__room_indices[room_to_find]
+
+    def get_base_action_probs_dict(self, index: int) -> dict:
+        """Returns the base action probabilities of one person, keyed by Action"""
+        return dict(zip(self.__action_table, self.__base_action_probs_table[self.__base_action_probs_rows[index]]))
+
+    def get_current_action_probs_dict(self, index: int) -> ActionProbs:
+        """Returns the most recent action probabilities of one person, keyed by Action (only available actions)"""
+        return ActionProbs(self.__action_table, self.__current_action_probs[index].copy())
+
+    def get_snapshot(self, index: int) -> dict:
+        """Returns a snapshot of one person's current state (see Person.get_snapshot())"""
+        return self.get_person(index).get_snapshot()
+
+    # Full state, as arrays (see checkpoint.py)
+    def get_state(self) -> Dict[str, np.array]:
+        """Returns every array needed to recreate this population exactly (apart from the generator), without copying.
+        The free-to-chat index is included in slot order, as partner draws depend on it."""
+        self.__ensure_free_index()
+        free_people = [np.array(list(free_people), dtype=np.int64)
+                       for free_people in self.__free_people]
+        return {
+            "names": np.array(self.__names),
+            "room_names": np.array(self.__room_graph.get_room_names()),
+            "room_offsets": self.__room_graph.get_offsets(),
+            "room_neighbours": self.__room_graph.get_neighbour_array(),
+            "action_names": np.array(self.__action_table.get_names()),
+            "action_types": self.__action_table.get_types(),
+            "most_likely_emotional_vectors_PAD": self.__action_table.get_emotional_vectors(),
+            "most_likely_personality_vectors_OCEAN": self.__action_table.get_personality_vectors(),
+            "received_emotional_change_vectors_PAD": self.__action_table.get_received_change_vectors(),
+            "given_emotional_change_vectors_PAD": self.__action_table.get_given_change_vectors(),
+            "personality_vectors": self.__personality_vectors,
+            "emotional_state_vectors": self.__emotional_state_vectors,
+            "locations": self.__locations,
+            "conversation_partners": self.__conversation_partners,
+            "current_action_probs": self.__current_action_probs,
+            "free_people_offsets": np.concatenate(([0], np.cumsum([len(x) for x in free_people]))).astype(np.int64),
+            "free_people": np.concatenate(free_people) if free_people else np.empty(0, dtype=np.int64),
+            "tick_key": np.array(self.__tick_key, dtype=np.int64),
+            "tick_number": np.array(self.__tick_number, dtype=np.int64),
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict[str, np.array], rng: np.random.Generator | None = None, action_table: ActionTable | None = None, room_graph: RoomGraph | None = None) -> Population:
+        """Recreates a population from get_state(). The state arrays are copied, so one state can seed many populations.
+        An equal action table or room graph that is already built may be passed in to be shared."""
+        if action_table is None:
+            action_table = ActionTable(**{name: state[name] for name in (
+                "action_names", "action_types", "most_likely_emotional_vectors_PAD", "most_likely_personality_vectors_OCEAN",
+                "received_emotional_change_vectors_PAD", "given_emotional_change_vectors_PAD")})
+        if room_graph is None:
+            room_graph = RoomGraph(
+                state["room_names"].tolist(), state["room_offsets"], state["room_neighbours"])
+        population = cls(names=state["names"].tolist(), rooms=room_graph, all_possible_actions=action_table,
+                         personality_vectors=state["personality_vectors"], emotional_state_vectors=state["emotional_state_vectors"],
+                         locations=state["locations"], conversation_partners=state["conversation_partners"], rng=rng)
+        population.__current_action_probs[:] = state["current_action_probs"]
+        # Restore the slot order of the free-to-chat index
+        free_people_offsets = state["free_people_offsets"]
+        for room_index in range(len(room_graph)):
+            population.__free_people[room_index] = IndexedSet(
+                state["free_people"][free_people_offsets[room_index]:free_people_offsets[room_index + 1]].tolist())
+        # (States from before synchronous ticks, or forks that should draw a new key, have no tick state)
+        population.__tick_key = int(state.get("tick_key", -1))
+        population.__tick_number = int(state.get("tick_number", 0))
+        return population
+
+    # Batched probability computations
+    def get_free_to_chat_counts(self, indices: np.array) -> np.array:
+        """Returns, for each given person, the number of OTHER people in their room who are free to chat"""
+        return self.__free_counts[self.__locations[indices]] - (self.__conversation_partners[indices] < 0)
+
+    def get_free_people(self, room_index: int) -> IndexedSet:
+        """Returns the indices of the people in the given room who are free to chat"""
+        self.__ensure_free_index()
+        return self.__free_people[room_index]
+
+    def get_available_action_kinds(self, indices: np.array) -> np.array:
+        """Returns the kind of available actions of each of the given people: CONVERSATION_ACTIONS in a conversation,
+        otherwise ROOM_ACTIONS, or ROOM_ACTIONS_WITHOUT_START when nobody else in their room is free to chat"""
+        indices = np.asarray(indices)
+        kinds = np.where(self.get_free_to_chat_counts(indices) > 0, ROOM_ACTIONS, ROOM_ACTIONS_WITHOUT_START)
+        if self.__starts_conversation_id < 0:
+            kinds[:] = ROOM_ACTIONS
+        kinds[self.__conversation_partners[indices] >= 0] = CONVERSATION_ACTIONS
+        return kinds.astype(np.int8)
+
+    def get_available_action_kind(self, index: int) -> int:
+        """Returns the kind of available actions of one person (see get_available_action_kinds())"""
+        if self.__conversation_partners[index] >= 0:
+            return CONVERSATION_ACTIONS
+        if self.__starts_conversation_id >= 0 and self.__free_counts[self.__locations[index]] <= 1:
+            return ROOM_ACTIONS_WITHOUT_START
+        return ROOM_ACTIONS
+
+    def get_available_action_masks(self, indices: np.array) -> np.array:
+        """Returns the (n x A) masks of available actions for the given people.
+        People in a conversation may take any conversation action, everyone else may take any room action,
+        except starting a conversation when nobody else in their room is free to chat."""
+        return self.__action_kind_masks[self.get_available_action_kinds(indices)]
+
+    def get_emotional_action_probs(self, indices: np.array | None = None) -> np.array:
+        """Returns the (n x A) emotional action probabilities for the given people (default everyone)"""
+        if indices is None:
+            indices = np.arange(len(self))
+        return self.__emotional_probs_lookup.get_emotional_action_probs(self.__emotional_state_vectors[indices])
+
+    def get_action_probs(self, indices: np.array, available_masks: np.array, weighting: float = 0.5) -> np.array:
+        """Returns the (n x A) combined action probabilities for the given people, over their available actions"""
+        return self.__action_table.combine_action_probs(self.get_emotional_action_probs(indices), self.get_base_action_probs(indices), available_masks, weighting)
+
+    def select_actions(self, indices: np.array, available_masks: np.array | None = None) -> np.array:
+        """Selects an action id for each of the given people, and records the distributions used"""
+        indices = np.asarray(indices)
+        if available_masks is None:
+            available_masks = self.get_available_action_masks(indices)
+        probs = self.get_action_probs(indices, available_masks)
+        self.__current_action_probs[indices] = probs
+        return sampling.sample_categorical(probs, self.__rng)
+
+    def action_selection(self, index: int, available_conv_act: List[Action] = [], available_room_act: List[Action] = []) -> Action:
+        """Selects an action for one person from the given available actions (see Person.action_selection())"""
+        if available_conv_act or available_room_act:
+            available_masks = self.__action_table.get_action_mask(
+                list(available_conv_act) + list(available_room_act))[None, :]
+        else:
+            available_masks = np.ones(
+                (1, len(self.__action_table)), dtype=bool)
+        return self.__action_table[self.select_actions([index], available_masks)[0]]
+
+    def set_emotional_state_vector(self, index: int, emotional_state_vector: np.array):
+        """Sets one person's emotional state vector"""
+        self.__emotional_state_vectors[index] = emotional_state_vector
+        self.__is_turn_prepared[index] = False
+
+    def update_emotional_state_vectors(self, indices: np.array, action_ids: np.array, is_own_action: bool):
+        """Applies the given (or received) emotional change of each action to the given people, clamped to [-1, 1]"""
+        change_vectors = self.__action_table.get_given_change_vectors(
+        ) if is_own_action else self.__action_table.get_received_change_vectors()
+        self.__emotional_state_vectors[indices] = np.clip(
+            self.__emotional_state_vectors[indices] + change_vectors[action_ids], -1, 1)
+        self.__is_turn_prepared[indices] = False
+
+    def apply_conversation_updates(self, actors: np.array, partners: np.array, action_ids: np.array, validate: bool = False):
+        """Applies the emotional changes of a batch of conversational turns (see apply_emotional_updates())"""
+        apply_emotional_updates(self.__emotional_state_vectors, actors,
+                                partners, action_ids, self.__action_table, validate)
+        self.__is_turn_prepared[actors] = False
+        self.__is_turn_prepared[partners] = False
+
+    def apply_conversation_turn(self, index: int, partner_index: int, action_id: int):
+        """Applies the emotional changes of one conversational turn (as apply_conversation_updates() for one turn)"""
+        for person_index, change_vectors in ((index, self.__action_table.get_given_change_vectors()),
+                                             (partner_index, self.__action_table.get_received_change_vectors())):
+            emotional_state_vector = self.__emotional_state_vectors[person_index]
+            emotional_state_vector += change_vectors[action_id]
+            # Clipped to [-1, 1] in place (as np.clip)
+            np.minimum(emotional_state_vector, 1, out=emotional_state_vector)
+            np.maximum(emotional_state_vector, -1, out=emotional_state_vector)
+            self.__is_turn_prepared[person_index] = False
+
+    # Single-person state changes (these keep the free-to-chat index up to date)
+    def __mark_free(self, index: int):
+        room_index = self.__locations[index]
+        if self.__free_index_valid:
+            self.__free_people[room_index].add(int(index))
+        self.__free_counts[room_index] += 1
+
+    def __mark_busy(self, index: int):
+        room_index = self.__locations[index]
+        if self.__free_index_valid:
+            self.__free_people[room_index].remove(int(index))
+        self.__free_counts[room_index] -= 1
+
+    def __invalidate_free_index(self):
+        # Called after bulk changes of locations & partners: the counts are recomputed now, the sets when next needed
+        self.__free_index_valid = False
+        self.__free_counts[:] = np.bincount(self.__locations[self.__conversation_partners < 0], minlength=len(self.__rooms))
+
+    def __ensure_free_index(self):
+        if self.__free_index_valid:
+            return
+        # Rebuilt in index order, so the slot order (and so partner draws) is the same as for a fresh population
+        self.__free_people = [IndexedSet() for _ in self.__rooms]
+        for i in np.flatnonzero(self.__conversation_partners < 0):
+            self.__free_people[self.__locations[i]].add(int(i))
+        self.__free_index_valid = True
+
+    def set_conversation_partner(self, index: int, partner_index: int):
+        """Sets the conversation partner of one person only (-1 for none)"""
+        if partner_index >= 0:
+            assert index != partner_index, "Cannot have conversation with self"
+            assert self.__locations[index] == self.__locations[partner_index], "Partner not in same location"
+        was_free = self.__conversation_partners[index] < 0
+        self.__conversation_partners[index] = partner_index
+        if was_free and partner_index >= 0:
+            self.__mark_busy(index)
+        elif not was_free and partner_index < 0:
+            self.__mark_free(index)
+
+    def start_conversation(self, index: int, partner_index: int):
+        """Makes the two given people conversation partners"""
+        self.set_conversation_partner(index, partner_index)
+        self.set_conversation_partner(partner_index, index)
+
+    def leave_conversation(self, index: int):
+        """Ends the conversation the given person is in, for both partners"""
+        partner_index = self.__conversation_partners[index]
+        assert partner_index >= 0, "No conversation partner to leave"
+        self.set_conversation_partner(index, -1)
+        self.set_conversation_partner(partner_index, -1)
+
+    def move_to_room(self, index: int, room_index: int):
+        """Moves the given person to the given room"""
+        assert self.__locations[index] != room_index, "Already in this location"
+        assert self.__conversation_partners[index] < 0, "Cannot change location while in conversation"
+        self.__mark_busy(index)
+        self.__locations[index] = room_index
+        self.__mark_free(index)
+
+    def get_next_room(self, index: int) -> int:
+        """Selects & returns the index of the next room for the given person to go to"""
+        # For now, this selection is uniformly random.
+        return self.__room_graph.sample_neighbour(self.__locations[index], self.__rng)
+
+    def get_next_rooms(self, indices: np.array) -> np.array:
+        """Selects & returns the index of the next room for each of the given people (one draw each, in order)"""
+        return self.__room_graph.sample_neighbours(self.__locations[indices], self.__rng)
+
+    def get_new_conversation_partner_for(self, index: int) -> int:
+        """Randomly selects another person in the given person's room who is free to chat"""
+        self.__ensure_free_index()
+        return self.__free_people[self.__locations[index]].sample(self.__rng, excluding=int(index))
+
+    # Sequential turns
+    def prepare_turns(self):
+        """Computes everyone's action probabilities for their next turn, in one batch (e.g. at the start of a round).
+        At a person's turn, these are used if their emotional state & kind of available actions have not changed since,
+        and otherwise recomputed for them alone. Changes made other than through this population's methods (e.g. to
+        the arrays from the getters) are not noticed, so prepare the turns again after any such change."""
+        self.__is_turn_prepared[:] = False
+        self.__prepare_invalid_turns(0, len(self))
+
+    def __prepare_invalid_turns(self, start: int, stop: int):
+        if self.__turn_probs is None:
+            self.__turn_probs = np.empty((len(self), len(self.__action_table)))
+        indices = start + np.flatnonzero(~self.__is_turn_prepared[start:stop])
+        kinds = self.get_available_action_kinds(indices)
+        self.__turn_action_kinds[indices] = kinds
+        self.__turn_probs[indices] = self.get_action_probs(indices, self.__action_kind_masks[kinds])
+        self.__is_turn_prepared[indices] = True
+
+    def select_turn_action(self, index: int) -> int:
+        """Selects an action id for one person's turn (with their prepared probabilities if still valid, see
+        prepare_turns()), and records the distribution used"""
+        if not self.__is_turn_prepared[index] and self.__turn_probs is not None:
+            # Usually the emotional state was changed by the partner's turn. As people only change each other's
+            # emotional states on their turns, the states of the next people are usually final too, so their
+            # probabilities are computed in the same batch.
+            self.__prepare_invalid_turns(index, index + TURN_BATCH_SIZE)
+        kind = self.get_available_action_kind(index)
+        if self.__is_turn_prepared[index] and self.__turn_action_kinds[index] == kind:
+            probs = self.__turn_probs[index]
+        else:
+            probs = self.get_action_probs([index], self.__action_kind_masks[kind][None, :])[0]
+        # Prepared probabilities are only used once
+        self.__is_turn_prepared[index] = False
+        self.__current_action_probs[index] = probs
+        return sampling.sample_categorical(probs, self.__rng)
+
+    def take_turn(self, index: int) -> int:
+        """Runs one turn for the given person, and returns the id of the action taken"""
+        partner_index = self.__conversation_partners[index]
+        action_id = self.select_turn_action(index)
+
+        # If in a conversation, update the person & conversation partner's emotional state according to the action
+        if partner_index >= 0:
+            self.apply_conversation_turn(index, partner_index, action_id)
+            if action_id == self.__leaves_conversation_id:
+                self.leave_conversation(index)
+        # Otherwise, deal with the room action
+        elif action_id == self.__leaves_room_id:
+            self.move_to_room(index, self.get_next_room(index))
+        elif action_id == self.__starts_conversation_id:
+            self.start_conversation(
+                index, self.get_new_conversation_partner_for(index))
+        return action_id
+
+    def run_round(self) -> np.array:
+        """Runs one round (every person takes a turn, in index order), and returns the action ids taken"""
+        self.prepare_turns()
+        return np.array([self.take_turn(i) for i in range(len(self))], dtype=np.int64)
+
+    # Synchronous ticks (see scheduler.py), an alternative to the sequential turns of run_round()
+    def get_tick_key(self) -> int:
+        """Returns the key of the counter-based draws of synchronous ticks (-1 until the first tick)"""
+        return self.__tick_key
+
+    def get_tick_number(self) -> int:
+        """Returns the number of synchronous ticks run so far"""
+        return self.__tick_number
+
+    def start_ticks(self) -> int:
+        """Draws the key of the counter-based draws of synchronous ticks from the generator (on first use), and returns it"""
+        if self.__tick_key < 0:
+            self.__tick_key = int(self.__rng.integers(2 ** 63))
+        return self.__tick_key
+
+    def end_ticks(self, num_ticks: int = 1):
+        """Records that num_ticks synchronous ticks have been run on the state arrays (e.g. by sharding.py), updating
+        the tick number and the free-to-chat index"""
+        self.__tick_number += num_ticks
+        self.__invalidate_free_index()
+        self.__is_turn_prepared[:] = False
+
+    def run_tick(self) -> Dict[str, np.array]:
+        """Runs one synchronous tick (everyone acts at once on the state at the start of the tick), and returns the
+        turns as columns (as in trace_writer.TRACE_COLUMNS, with round_number the tick number)"""
+        turns = scheduler.run_synchronous_tick(
+            np.arange(len(self)), self.start_ticks(), self.__tick_number, self.__action_table, self.__emotional_probs_lookup,
+            self.get_base_action_probs(), self.__room_graph, self.__emotional_state_vectors, self.__locations,
+            self.__conversation_partners, self.__current_action_probs)
+        self.end_ticks()
+        return turns
@@ -0,0 +1,246 @@
+from __future__ import annotations
+import contextlib
+import functools
+import json
+import time
+from collections import defaultdict
+import numpy as np
+from typing import Dict, List
+from action_table import ActionTable
+from emotional_probs import EmotionalActionProbsCache, EmotionalActionProbsGrid
+from person import Person
+from population import Population
+from room import Room
+from sharding import ShardedPopulation
+from trace_writer import TraceWriter
+import sampling
+import scheduler
+
+# Low-overhead instrumentation of the turn pipeline. While profiling is disabled nothing is instrumented at all:
+# enable() replaces the methods below with timed wrappers, and disable() puts the originals back, so an
+# unprofiled run pays no cost. Phase times are inclusive (e.g. Population.action_selection includes
+# Population.select_actions), and are accumulated per round, along with counters of turn events.
+
+# Phase name -> (class or module, function) timed while profiling is enabled. The emotional probabilities are timed
+# per lookup mode (the cache computes its misses through ActionTable).
+PHASES = {
+    "action_selection": (Person, "action_selection"),
+    "update_emotional_state_vector": (Person, "update_emotional_state_vector"),
+    "partner_search": (Room, "get_new_conversation_partner_for"),
+    "move_to_room": (Person, "move_to_room"),
+    "emotional_probs.exact": (ActionTable, "get_emotional_action_probs"),
+    "emotional_probs.cached": (EmotionalActionProbsCache, "get_emotional_action_probs"),
+    "emotional_probs.grid": (EmotionalActionProbsGrid, "get_emotional_action_probs"),
+    "combine_action_probs": (ActionTable, "combine_action_probs"),
+    "sample_categorical": (sampling, "sample_categorical"),
+    "sample_categorical_with_draws": (sampling, "sample_categorical_with_draws"),
+    "population.prepare_turns": (Population, "prepare_turns"),
+    "population.select_turn_action": (Population, "select_turn_action"),
+    "population.select_actions": (Population, "select_actions"),
+    "population.apply_conversation_turn": (Population, "apply_conversation_turn"),
+    "population.apply_conversation_updates": (Population, "apply_conversation_updates"),
+    "population.partner_search": (Population, "get_new_conversation_partner_for"),
+    "population.move_to_room": (Population, "move_to_room"),
+    "population.run_tick": (Population, "run_tick"),
+    "synchronous_tick": (scheduler, "run_synchronous_tick"),
+    "sharded.run_ticks": (ShardedPopulation, "run_ticks"),
+    "trace.append_turn": (TraceWriter, "append_turn"),
+    "trace.append_turns": (TraceWriter, "append_turns"),
+}
+# Action name -> the counter of turns taking it. In sequential turns each of these turns is one event, but in a
+# synchronous tick a conversation may be started or ended by both partners at once, or started by a partner's
+# request, so ticks count the conversations started & ended instead (see count_tick()).
+EVENT_COUNTERS = {
+    "starts_conversation": "conversations_started",
+    "leaves_conversation": "conversations_ended",
+    "leaves_room": "moves",
+    "stands_in_corner": "corner_standing",
+}
+
+
+class Profiler:
+    """Accumulates phase times & calls and event counters, and closes them off into one row per round"""
+
+    def __init__(self):
+        self.__phase_seconds: Dict[str, float] = defaultdict(float)
+        self.__phase_calls: Dict[str, int] = defaultdict(int)
+        self.__counters: Dict[str, int] = defaultdict(int)
+        self.__rounds: List[dict] = []
+
+    def add_phase_time(self, name: str, seconds: float):
+        """Adds one call of the given phase"""
+        self.__phase_seconds[name] += seconds
+        self.__phase_calls[name] += 1
+
+    def count(self, name: str, num_events: int = 1):
+        """Adds to the given counter"""
+        self.__counters[name] += num_events
+
+    def count_actions(self, action_names: List[str], action_ids: np.array):
+        """Adds the event counters of the given actions taken"""
+        for action_id, num_taken in enumerate(np.bincount(np.asarray(action_ids).reshape(-1), minlength=len(action_names))):
+            if num_taken and action_names[action_id] in EVENT_COUNTERS:
+                self.__counters[EVENT_COUNTERS[action_names[action_id]]] += int(num_taken)
+
+    def count_tick(self, action_names: List[str], turns: Dict[str, np.array]):
+        """Adds the event counters of a synchronous tick's turns, counting the conversations actually started & ended"""
+        # The conversation actions are left out of the action counts
+        conversation_actions = ("starts_conversation", "leaves_conversation")
+        self.count_actions([name if name not in conversation_actions else None for name in action_names], turns["action"])
+        self.__counters[EVENT_COUNTERS["starts_conversation"]] += len(scheduler.get_started_conversations(turns))
+        if "leaves_conversation" in action_names:
+            self.__counters[EVENT_COUNTERS["leaves_conversation"]] += len(scheduler.get_ended_conversations(
+                turns, action_names.index("leaves_conversation")))
+
+    def end_round(self, round_number: int | None = None):
+        """Records everything accumulated since the previous round as one row, and starts the next round"""
+        row = {"round_number": round_number if round_number is not None else len(self.__rounds)}
+        row.update({counter: self.__counters.get(counter, 0) for counter in EVENT_COUNTERS.values()})
+        row.update({counter: value for counter, value in self.__counters.items() if counter not in row})
+        for name in sorted(self.__phase_seconds):
+            row[f"{name}.seconds"] = self.__phase_seconds[name]
+            row[f"{name}.calls"] = self.__phase_calls[name]
+        self.__rounds.append(row)
+        self.__phase_seconds.clear()
+        self.__phase_calls.clear()
+        self.__counters.clear()
+
+    def get_rounds(self) -> List[dict]:
+        """Returns one dict per round"""
+        return self.__rounds
+
+    def get_table(self) -> Dict[str, np.array]:
+        """Returns the rounds as columns (0 where a round has no value for a column)"""
+        columns = list(dict.fromkeys(column for row in self.__rounds for column in row))
+        return {column: np.array([row.get(column, 0) for row in self.__rounds]) for column in columns}
+
+    def get_totals(self) -> dict:
+        """Returns every column summed over the rounds (apart from round_number)"""
+        return {column: values.sum().item() for column, values in self.get_table().items() if column != "round_number"}
+
+    def to_json(self) -> str:
+        """Returns the rounds & totals as JSON"""
+        return json.dumps({"rounds": self.__rounds, "totals": self.get_totals()})
+
+
+_profiler: Profiler | None = None
+_original_methods: Dict[str, object] = dict()
+
+
+def get_profiler() -> Profiler | None:
+    """Returns the enabled profiler (None if profiling is disabled)"""
+    return _profiler
+
+
+def make_timed(name: str, method):
+    """Returns a wrapper of the method that adds the time of every call to the given phase"""
+    @functools.wraps(method)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            _profiler.add_phase_time(name, time.perf_counter() - start)
+    return timed
+
+
+def make_counting_population_select_actions(method):
+    """Returns a wrapper of Population.select_actions that also counts the events of the actions selected"""
+    @functools.wraps(method)
+    def select_actions(self, *args, **kwargs):
+        action_ids = method(self, *args, **kwargs)
+        _profiler.count_actions(self.get_action_table().get_names(), action_ids)
+        return action_ids
+    return select_actions
+
+
+def make_counting_population_select_turn_action(method):
+    """Returns a wrapper of Population.select_turn_action that also counts the event of the action selected"""
+    @functools.wraps(method)
+    def select_turn_action(self, *args, **kwargs):
+        action_id = method(self, *args, **kwargs)
+        _profiler.count_actions(self.get_action_table().get_names(), [action_id])
+        return action_id
+    return select_turn_action
+
+
+def make_counting_population_run_tick(method):
+    """Returns a wrapper of Population.run_tick that also counts the events of the tick"""
+    @functools.wraps(method)
+    def run_tick(self, *args, **kwargs):
+        turns = method(self, *args, **kwargs)
+        _profiler.count_tick(self.get_action_table().get_names(), turns)
+        return turns
+    return run_tick
+
+
+def make_counting_sharded_run_ticks(method):
+    """Returns a wrapper of ShardedPopulation.run_ticks that also counts the events of each tick"""
+    @functools.wraps(method)
+    def run_ticks(self, *args, **kwargs):
+        ticks = method(self, *args, **kwargs)
+        for turns in ticks:
+            _profiler.count_tick(self.get_population().get_action_table().get_names(), turns)
+        return ticks
+    return run_ticks
+
+
+def make_counting_person_action_selection(method):
+    """Returns a wrapper of Person.action_selection that also counts the event of the action selected
+    (for standalone people; people in a population are counted by Population.select_turn_action & select_actions)"""
+    @functools.wraps(method)
+    def action_selection(self, *args, **kwargs):
+        action = method(self, *args, **kwargs)
+        if self.get_population() is None and action.get_name() in EVENT_COUNTERS:
+            _profiler.count(EVENT_COUNTERS[action.get_name()])
+        return action
+    return action_selection
+
+
+def enable(profiler: Profiler | None = None) -> Profiler:
+    """Starts profiling into the given (or a new) profiler, instrumenting the pipeline, and returns the profiler"""
+    global _profiler
+    if _profiler is not None:
+        disable()
+    _profiler = profiler if profiler is not None else Profiler()
+    for name, (cls, method_name) in PHASES.items():
+        method = getattr(cls, method_name)
+        _original_methods[name] = method
+        if (cls, method_name) == (Population, "select_actions"):
+            method = make_counting_population_select_actions(method)
+        elif (cls, method_name) == (Population, "select_turn_action"):
+            method = make_counting_population_select_turn_action(method)
+        elif (cls, method_name) == (Population, "run_tick"):
+            method = make_counting_population_run_tick(method)
+        elif (cls, method_name) == (ShardedPopulation, "run_ticks"):
+            method = make_counting_sharded_run_ticks(method)
+        elif (cls, method_name) == (Person, "action_selection"):
+            method = make_counting_person_action_selection(method)
+        setattr(cls, method_name, make_timed(name, method))
+    return _profiler
+
+
+def disable() -> Profiler | None:
+    """Stops profiling, restoring the uninstrumented methods, and returns the profiler that was enabled"""
+    global _profiler
+    for name, (cls, method_name) in PHASES.items():
+        if name in _original_methods:
+            setattr(cls, method_name, _original_methods.pop(name))
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+@contextlib.contextmanager
+def profile(profiler: Profiler | None = None):
+    """Context manager that profiles its body, e.g. `with profiling.profile() as profiler:`"""
+    profiler = enable(profiler)
+    try:
+        yield profiler
+    finally:
+        disable()
+
+
+def end_round(round_number: int | None = None):
+    """Ends the current round of the enabled profiler (does nothing if profiling is disabled)"""
+    if _profiler is not None:
+        _profiler.end_round(round_number)
@@ -0,0 +1,286 @@
+from __future__ import annotations
+import numpy as np
+from typing import Dict, List
+from action_table import ActionTable
+from emotional_updates import apply_emotional_updates
+from population import Population
+from room_graph import RoomGraph
+import sampling
+
+# Many replicas of the same small population (e.g. one scenario run with many seeds) are stepped in lockstep, with
+# the replicas as an extra leading dimension of every state array: (R x N x 3) emotional states, (R x N) locations
+# and partners, and so on. Each turn of a round is one set of array operations over all R replicas, so the
+# interpreter overhead of a turn is paid once for all replicas rather than once per replica. Each replica keeps its
+# own generator and free-to-chat index (as arrays, with the slot order of an IndexedSet), and its draws are made in
+# the same order as in Population.take_turn(), so each replica's results are identical to running it alone.
+
+
+class ReplicaView:
+    """A read-only view of one replica of a ReplicaBatch, with the getters of a Population used by the aggregators
+    (the arrays are views of the batch's arrays, so always show the replica's current state)"""
+
+    def __init__(self, batch: ReplicaBatch, replica: int):
+        self.__batch = batch
+        self.__replica = replica
+
+    def __len__(self) -> int:
+        return len(self.__batch.get_names())
+
+    def __repr__(self) -> str:
+        return f"Replica {self.__replica} of {self.__batch}"
+
+    def get_names(self) -> List[str]:
+        return self.__batch.get_names()
+
+    def get_room_graph(self) -> RoomGraph:
+        return self.__batch.get_room_graph()
+
+    def get_action_table(self) -> ActionTable:
+        return self.__batch.get_action_table()
+
+    def get_personality_vectors(self) -> np.array:
+        return self.__batch.get_personality_vectors()
+
+    def get_emotional_state_vectors(self) -> np.array:
+        return self.__batch.get_emotional_state_vectors()[self.__replica]
+
+    def get_locations(self) -> np.array:
+        return self.__batch.get_locations()[self.__replica]
+
+    def get_conversation_partners(self) -> np.array:
+        return self.__batch.get_conversation_partners()[self.__replica]
+
+    def get_current_action_probs(self) -> np.array:
+        return self.__batch.get_current_action_probs()[self.__replica]
+
+
+class ReplicaBatch:
+    """R replicas of a population (the same people, rooms & actions, with their own states & generators), advanced in
+    lockstep. Each replica's generator is drawn from in blocks of block_size uniforms, so after a round it is further
+    along than a population run alone would be, although the draws used (and so the results) are the same.
+    The free-to-chat index is held as (R x rooms x N) slots, so this is meant for small populations."""
+
+    def __init__(self, populations: List[Population], block_size: int = 1024):
+        assert len(populations) > 0, "Need at least one replica"
+        first = populations[0]
+        for population in populations[1:]:
+            assert population.get_names() == first.get_names(), "Replicas must have the same people"
+            assert np.array_equal(population.get_personality_vectors(), first.get_personality_vectors()), "Replicas must have the same personalities"
+            assert population.get_action_table().get_names() == first.get_action_table().get_names(), "Replicas must have the same actions"
+            assert population.get_room_graph().get_room_names() == first.get_room_graph().get_room_names(), "Replicas must have the same rooms"
+        num_replicas, num_people, num_rooms = len(populations), len(first), len(first.get_room_graph())
+
+        # Shared by every replica
+        self.__names = first.get_names()
+        self.__room_graph = first.get_room_graph()
+        self.__action_table = first.get_action_table()
+        self.__emotional_probs_lookup = first.get_emotional_probs_lookup()
+        self.__personality_vectors = first.get_personality_vectors()
+        self.__base_action_probs = first.get_base_action_probs()
+        self.__starts_conversation_id = self.__action_table.get_action_id(
+            "starts_conversation") if "starts_conversation" in self.__action_table else -1
+        self.__leaves_conversation_id = self.__action_table.get_action_id(
+            "leaves_conversation") if "leaves_conversation" in self.__action_table else -1
+        self.__leaves_room_id = self.__action_table.get_action_id(
+            "leaves_room") if "leaves_room" in self.__action_table else -1
+
+        # The state of each replica, stacked along the first dimension (copied, so that the batch owns it)
+        states = [population.get_state() for population in populations]
+        self.__emotional_state_vectors = np.stack([state["emotional_state_vectors"] for state in states])
+        self.__locations = np.stack([state["locations"] for state in states])
+        self.__conversation_partners = np.stack([state["conversation_partners"] for state in states])
+        self.__current_action_probs = np.stack([state["current_action_probs"] for state in states])
+        self.__state_template = {name: array for name, array in states[0].items() if name in (
+            "names", "room_names", "room_offsets", "room_neighbours", "action_names", "action_types", "most_likely_emotional_vectors_PAD",
+            "most_likely_personality_vectors_OCEAN", "received_emotional_change_vectors_PAD", "given_emotional_change_vectors_PAD", "personality_vectors")}
+
+        # The free-to-chat index of each replica: the people in each room's slots (in IndexedSet slot order), the slot
+        # of each free person (-1 if not free), and the number free in each room
+        self.__free_people = np.full((num_replicas, num_rooms, num_people), -1, dtype=np.int64)
+        self.__free_positions = np.full((num_replicas, num_people), -1, dtype=np.int64)
+        self.__free_counts = np.zeros((num_replicas, num_rooms), dtype=np.int64)
+        for replica, state in enumerate(states):
+            free_people_offsets = state["free_people_offsets"]
+            for room_index in range(num_rooms):
+                free_people = state["free_people"][free_people_offsets[room_index]:free_people_offsets[room_index + 1]]
+                self.__free_people[replica, room_index, :len(free_people)] = free_people
+                self.__free_positions[replica, free_people] = np.arange(len(free_people))
+                self.__free_counts[replica, room_index] = len(free_people)
+
+        # Each replica's generator, and a block of its upcoming draws
+        self.__rngs = [population.get_rng() for population in populations]
+        self.__block_size = block_size
+        self.__draws = np.empty((num_replicas, block_size))
+        self.__next_draws = np.full(num_replicas, block_size, dtype=np.int64)
+        self.__replicas = np.arange(num_replicas)
+
+    def __len__(self) -> int:
+        return len(self.__rngs)
+
+    def __repr__(self) -> str:
+        return f"ReplicaBatch of {len(self)} replicas of {len(self.__names)} people"
+
+    # Getters for the underlying arrays (returned without copying)
+    def get_names(self) -> List[str]:
+        """Returns the names of the people (the same in every replica)"""
+        return self.__names
+
+    def get_room_graph(self) -> RoomGraph:
+        """Returns the room graph (the same in every replica)"""
+        return self.__room_graph
+
+    def get_action_table(self) -> ActionTable:
+        """Returns the action table (the same in every replica)"""
+        return self.__action_table
+
+    def get_personality_vectors(self) -> np.array:
+        """Returns the (N x 5) personality vectors (the same in every replica)"""
+        return self.__personality_vectors
+
+    def get_emotional_state_vectors(self) -> np.array:
+        """Returns the (R x N x 3) emotional state vectors"""
+        return self.__emotional_state_vectors
+
+    def get_locations(self) -> np.array:
+        """Returns the (R x N) room index of every person in every replica"""
+        return self.__locations
+
+    def get_conversation_partners(self) -> np.array:
+        """Returns the (R x N) conversation partner index of every person in every replica (-1 for none)"""
+        return self.__conversation_partners
+
+    def get_current_action_probs(self) -> np.array:
+        """Returns the (R x N x A) most recent action probabilities of every person in every replica"""
+        return self.__current_action_probs
+
+    def get_rng(self, replica: int) -> np.random.Generator:
+        """Returns the generator of one replica"""
+        return self.__rngs[replica]
+
+    def get_replica(self, replica: int) -> ReplicaView:
+        """Returns a read-only view of one replica (e.g. for the aggregators)"""
+        return ReplicaView(self, replica)
+
+    def get_replica_state(self, replica: int) -> Dict[str, np.array]:
+        """Returns the state of one replica as from Population.get_state() (copied), e.g. to continue it alone
+        with Population.from_state()"""
+        free_counts = self.__free_counts[replica]
+        return {
+            **self.__state_template,
+            "emotional_state_vectors": self.__emotional_state_vectors[replica].copy(),
+            "locations": self.__locations[replica].copy(),
+            "conversation_partners": self.__conversation_partners[replica].copy(),
+            "current_action_probs": self.__current_action_probs[replica].copy(),
+            "free_people_offsets": np.concatenate(([0], np.cumsum(free_counts))).astype(np.int64),
+            "free_people": np.concatenate([free_people[:free_count] for free_people, free_count in zip(self.__free_people[replica], free_counts)]),
+        }
+
+    def __draw(self, replicas: np.array) -> np.array:
+        # The next uniform draw of each of the given replicas' generators, refilling used up blocks
+        for replica in replicas[self.__next_draws[replicas] == self.__block_size]:
+            self.__draws[replica] = self.__rngs[replica].random(self.__block_size)
+            self.__next_draws[replica] = 0
+        draws = self.__draws[replicas, self.__next_draws[replicas]]
+        self.__next_draws[replicas] += 1
+        return draws
+
+    # Free-to-chat index changes, for one person in each of the given replicas (as IndexedSet.add() & remove())
+    def __mark_free(self, replicas: np.array, indices: np.array):
+        rooms = self.__locations[replicas, indices]
+        positions = self.__free_counts[replicas, rooms]
+        self.__free_people[replicas, rooms, positions] = indices
+        self.__free_positions[replicas, indices] = positions
+        self.__free_counts[replicas, rooms] += 1
+
+    def __mark_busy(self, replicas: np.array, indices: np.array):
+        rooms = self.__locations[replicas, indices]
+        positions = self.__free_positions[replicas, indices]
+        last_positions = self.__free_counts[replicas, rooms] - 1
+        # The last member moves into the removed member's slot
+        last_people = self.__free_people[replicas, rooms, last_positions]
+        self.__free_people[replicas, rooms, positions] = last_people
+        self.__free_positions[replicas, last_people] = positions
+        self.__free_people[replicas, rooms, last_positions] = -1
+        self.__free_positions[replicas, indices] = -1
+        self.__free_counts[replicas, rooms] -= 1
+
+    def take_turn(self, index: int) -> np.array:
+        """Runs one turn for the given person in every replica (as Population.take_turn()), and returns the ids of the actions taken"""
+        replicas = self.__replicas
+        partners = self.__conversation_partners[:, index].copy()
+        rooms = self.__locations[:, index].copy()
+        in_conversation = partners >= 0
+        available_masks = np.where(in_conversation[:, None],
+                                   self.__action_table.get_conversation_action_mask(), self.__action_table.get_room_action_mask())
+        if self.__starts_conversation_id >= 0:
+            available_masks[:, self.__starts_conversation_id] &= self.__free_counts[replicas, rooms] - ~in_conversation > 0
+        probs = self.__action_table.combine_action_probs(self.__emotional_probs_lookup.get_emotional_action_probs(
+            self.__emotional_state_vectors[:, index]), np.broadcast_to(self.__base_action_probs[index], available_masks.shape), available_masks)
+        self.__current_action_probs[:, index] = probs
+        action_ids = sampling.sample_categorical_with_draws(probs, self.__draw(replicas))
+
+        # In a conversation: update both partners' emotional states, and end the conversation if leaving it
+        talking = replicas[in_conversation]
+        num_people = len(self.__names)
+        apply_emotional_updates(self.__emotional_state_vectors.reshape(-1, 3), talking * num_people + index,
+                                talking * num_people + partners[talking], action_ids[talking], self.__action_table)
+        leaving = talking[action_ids[talking] == self.__leaves_conversation_id]
+        for indices in (np.full(len(leaving), index), partners[leaving]):
+            self.__conversation_partners[leaving, indices] = -1
+            self.__mark_free(leaving, indices)
+
+        # Otherwise, deal with the room action
+        free = replicas[~in_conversation]
+        moving = free[action_ids[free] == self.__leaves_room_id]
+        if len(moving):
+            indices = np.full(len(moving), index)
+            new_rooms = self.__room_graph.select_neighbours(rooms[moving], self.__draw(moving))
+            self.__mark_busy(moving, indices)
+            self.__locations[moving, index] = new_rooms
+            self.__mark_free(moving, indices)
+        starting = free[action_ids[free] == self.__starts_conversation_id]
+        if len(starting):
+            indices = np.full(len(starting), index)
+            # As IndexedSet.sample(), a uniformly random slot other than the person's own
+            num_choices = self.__free_counts[starting, rooms[starting]] - 1
+            positions = np.minimum((self.__draw(starting) * num_choices).astype(np.int64), num_choices - 1)
+            positions += positions >= self.__free_positions[starting, indices]
+            new_partners = self.__free_people[starting, rooms[starting], positions]
+            self.__conversation_partners[starting, indices] = new_partners
+            self.__mark_busy(starting, indices)
+            self.__conversation_partners[starting, new_partners] = index
+            self.__mark_busy(starting, new_partners)
+        return action_ids
+
+    def run_round(self, round_number: int = 0, record_emotional_states: bool = False) -> Dict[str, np.array]:
+        """Runs one round (every person takes a turn, in index order) in every replica, and returns the turns as
+        (R x N) columns (as in trace_writer.TRACE_COLUMNS, without the emotional states). If record_emotional_states,
+        the (R x N x 3) person_/partner_emotional_state_before/after are included too (NaN where there is no partner)."""
+        num_replicas, num_people = self.__locations.shape
+        turns = {"round_number": np.full((num_replicas, num_people), round_number, dtype=np.int64),
+                 "person": np.broadcast_to(np.arange(num_people), (num_replicas, num_people)).copy(),
+                 **{column: np.empty((num_replicas, num_people), dtype=np.int64) for column in (
+                     "action", "location_before", "location_after", "partner_before", "partner_after")}}
+        if record_emotional_states:
+            turns.update({f"{who}_emotional_state_{when}": np.full((num_replicas, num_people, 3), np.nan)
+                          for who in ("person", "partner") for when in ("before", "after")})
+        replicas = self.__replicas
+        for index in range(num_people):
+            partners_before = turns["partner_before"][:, index] = self.__conversation_partners[:, index].copy()
+            turns["location_before"][:, index] = self.__locations[:, index]
+            if record_emotional_states:
+                turns["person_emotional_state_before"][:, index] = self.__emotional_state_vectors[:, index]
+                talking = replicas[partners_before >= 0]
+                turns["partner_emotional_state_before"][talking, index] = self.__emotional_state_vectors[talking, partners_before[talking]]
+
+            turns["action"][:, index] = self.take_turn(index)
+
+            # As in metacode.ipynb, the partner after a turn is the partner the turn was taken with
+            partners_after = turns["partner_after"][:, index] = np.where(
+                partners_before >= 0, partners_before, self.__conversation_partners[:, index])
+            turns["location_after"][:, index] = self.__locations[:, index]
+            if record_emotional_states:
+                turns["person_emotional_state_after"][:, index] = self.__emotional_state_vectors[:, index]
+                talking = replicas[partners_after >= 0]
+                turns["partner_emotional_state_after"][talking, index] = self.__emotional_state_vectors[talking, partners_after[talking]]
+        return turns
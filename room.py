@@ -3,14 +3,20 @@ import numpy as np
 from action import Action
 from typing import List, Set
 import person
+from indexed_set import IndexedSet
 
 
 class Room:
+    __slots__ = ("__name", "__people", "__free_people", "__adjacent_rooms")
+
     def __init__(self, name: str):
         assert(type(name) == str), f"{name} is not a string"
 
         self.__name = name  # The name of the room
         self.__people = set()  # The set of people currently in the room
+        # The people in the room without a conversation partner, kept up to date by Person
+        # (set_conversation_partner(), leave_conversation() & move_to_room()) so lookups are O(1).
+        self.__free_people = IndexedSet()
         # The set of rooms that are adjacent to this room. Empty to start with.
         self.__adjacent_rooms = set()
 
@@ -26,25 +32,25 @@ class Room:
 
     def is_someone_free_to_chat(self, persons):
         """Returns true if someone ELSE is free to chat in this room"""
-        for person in self.__people:
-            # skip yourself
-            if person.get_name() == persons.get_name():
-                continue
-            if not person.has_conversation_partner():
-                #print(person.get_name(), 'is free')
-                return True
-        else:
-            return False
+        return self.__free_people.count_excluding(persons) > 0
 
-    def get_new_conversation_partner_for(self, person):
-        """Randomly selects the first OTHER person in this room who is free to chat"""
-       
+    def get_new_conversation_partner_for(self, person, rng: np.random.Generator | None = None):
+        """Randomly selects another person in this room who is free to chat"""
+        return self.__free_people.sample(rng, excluding=person)
 
-        
-        
+    def get_free_people(self) -> IndexedSet:
+        """Returns the people in the room who are free to chat"""
+        return self.__free_people
 
+    def add_free_person(self, person_to_add):
+        """Marks a person in the room as free to chat"""
+        assert(
+            person_to_add in self.__people), f"{person_to_add} is not in {self.__name}"
+        self.__free_people.add(person_to_add)
 
-        return np.random.choice([partner for partner in self.__people if ((not partner.has_conversation_partner()) and (partner.get_name() != person.get_name()))])
+    def remove_free_person(self, person_to_remove):
+        """Marks a person in the room as no longer free to chat"""
+        self.__free_people.remove(person_to_remove)
 
     def get_name(self):
         """Returns room name"""
@@ -57,12 +63,15 @@ class Room:
         assert(type(person_to_add) ==
                person.Person), f"{person_to_add} is not a person"
         self.__people.add(person_to_add)
+        if not person_to_add.has_conversation_partner():
+            self.__free_people.add(person_to_add)
 
     def remove_person(self, person_to_add):
         """Removes a person from the room"""
         assert(
             person_to_add in self.__people), f"{person_to_add} is not in {self.__name}"
         self.__people.remove(person_to_add)
+        self.__free_people.discard(person_to_add)
 
     def has_person(self, person):
         """Returns true if the person is in the room"""
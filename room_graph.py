@@ -0,0 +1,182 @@
+from __future__ import annotations
+import numpy as np
+from typing import Dict, List
+from room import Room
+import sampling
+
+
+class RoomGraph:
+    """The rooms of a building and their adjacency, with rooms identified by integer ids.
+
+    Adjacency is stored in compressed sparse row (CSR) form: the neighbours of room r are
+    neighbours[offsets[r]:offsets[r + 1]]. Adjacency is symmetric. Room objects remain the
+    name-level facade: build_rooms() creates connected Room objects for a graph, and
+    from_rooms() compiles a graph from existing Room objects.
+    """
+
+    def __init__(self, room_names: List[str], offsets: np.array, neighbours: np.array):
+        self.__room_names = list(room_names)
+        self.__room_ids = {name: i for i, name in enumerate(self.__room_names)}
+        assert len(self.__room_ids) == len(self.__room_names), "Room names must be unique"
+        self.__offsets = np.asarray(offsets, dtype=np.int64)
+        self.__neighbours = np.asarray(neighbours, dtype=np.int64)
+        assert self.__offsets.shape == (len(self.__room_names) + 1,), "There must be one offset per room, plus one"
+        assert self.__offsets[0] == 0 and self.__offsets[-1] == len(self.__neighbours), "Offsets must span the neighbours"
+        assert np.all(np.diff(self.__offsets) >= 0), "Offsets must be non-decreasing"
+        self.__degrees = np.diff(self.__offsets)
+        for array in (self.__offsets, self.__neighbours, self.__degrees):
+            array.flags.writeable = False
+
+    @classmethod
+    def from_edges(cls, room_names: List[str], edges: np.array) -> RoomGraph:
+        """Builds a graph from (E x 2) pairs of adjacent room ids (in either order; duplicates are ignored)"""
+        num_rooms = len(room_names)
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        assert np.all((edges >= 0) & (edges < num_rooms)), "Edge refers to a room that does not exist"
+        assert np.all(edges[:, 0] != edges[:, 1]), "A room cannot be adjacent to itself"
+        # Both directions of every edge, without duplicates, sorted by room then neighbour
+        directed_edges = np.unique(np.vstack((edges, edges[:, ::-1])), axis=0)
+        offsets = np.zeros(num_rooms + 1, dtype=np.int64)
+        np.cumsum(np.bincount(directed_edges[:, 0], minlength=num_rooms), out=offsets[1:])
+        return cls(room_names, offsets, directed_edges[:, 1])
+
+    @classmethod
+    def from_rooms(cls, rooms: List[Room]) -> RoomGraph:
+        """Compiles the adjacency of the given Room objects. Room ids are their positions in the list, and each room's
+        neighbours are ordered by name (as in Person.get_next_room())."""
+        room_ids = {r: i for i, r in enumerate(rooms)}
+        offsets = [0]
+        neighbours = []
+        for r in rooms:
+            for adjacent_room in sorted(r.get_adjacent_rooms(), key=lambda x: x.get_name()):
+                assert adjacent_room in room_ids, f"{adjacent_room.get_name()} is not in the given rooms"
+                neighbours.append(room_ids[adjacent_room])
+            offsets.append(len(neighbours))
+        return cls([r.get_name() for r in rooms], offsets, neighbours)
+
+    @classmethod
+    def from_dict(cls, room_graph: Dict[str, List[str]]) -> RoomGraph:
+        """Builds a graph from a mapping of each room name to the names of (some of) its adjacent rooms"""
+        room_names = list(room_graph)
+        room_ids = {name: i for i, name in enumerate(room_names)}
+        edges = []
+        for name, adjacent_names in room_graph.items():
+            for adjacent_name in adjacent_names:
+                assert adjacent_name in room_ids, f"{adjacent_name} is not a room in the room graph"
+                edges.append((room_ids[name], room_ids[adjacent_name]))
+        return cls.from_edges(room_names, edges)
+
+    def __len__(self) -> int:
+        return len(self.__room_names)
+
+    def __repr__(self) -> str:
+        return f"RoomGraph of {len(self)} rooms and {len(self.__neighbours) // 2} adjacencies"
+
+    def get_room_names(self) -> List[str]:
+        """Returns the room names, in id order"""
+        return self.__room_names
+
+    def get_room_id(self, name: str) -> int:
+        """Returns the id of the room with the given name"""
+        return self.__room_ids[name]
+
+    def get_offsets(self) -> np.array:
+        """Returns the CSR offsets (one per room, plus one)"""
+        return self.__offsets
+
+    def get_neighbour_array(self) -> np.array:
+        """Returns the CSR neighbour ids of every room, concatenated"""
+        return self.__neighbours
+
+    def get_degrees(self) -> np.array:
+        """Returns the number of neighbours of every room"""
+        return self.__degrees
+
+    def get_neighbours(self, room_id: int) -> np.array:
+        """Returns the ids of the rooms adjacent to the given room"""
+        return self.__neighbours[self.__offsets[room_id]:self.__offsets[room_id + 1]]
+
+    def to_dict(self) -> Dict[str, List[str]]:
+        """Returns the mapping of each room name to the names of its adjacent rooms"""
+        return {name: [self.__room_names[neighbour] for neighbour in self.get_neighbours(room_id)]
+                for room_id, name in enumerate(self.__room_names)}
+
+    def build_rooms(self) -> List[Room]:
+        """Creates a connected Room object for every room, in id order"""
+        rooms = [Room(name) for name in self.__room_names]
+        for room_id, r in enumerate(rooms):
+            for neighbour in self.get_neighbours(room_id):
+                if rooms[neighbour] not in r.get_adjacent_rooms():
+                    r.add_adjacent_room(rooms[neighbour])
+        return rooms
+
+    def sample_neighbour(self, room_id: int, rng: np.random.Generator | None = None) -> int:
+        """Returns a uniformly random neighbour of the given room"""
+        return int(self.__neighbours[self.__offsets[room_id] + sampling.sample_uniform_index(int(self.__degrees[room_id]), rng)])
+
+    def sample_neighbours(self, room_ids: np.array, rng: np.random.Generator | None = None) -> np.array:
+        """Returns a uniformly random neighbour of each of the given rooms, with one draw per room (in order)"""
+        room_ids = np.asarray(room_ids, dtype=np.int64)
+        return self.__neighbours[self.__offsets[room_ids] + sampling.sample_uniform_index(self.__degrees[room_ids], rng)]
+
+    def select_neighbours(self, room_ids: np.array, draws: np.array) -> np.array:
+        """Returns a neighbour of each of the given rooms, chosen by the given uniform draws in [0, 1)"""
+        room_ids = np.asarray(room_ids, dtype=np.int64)
+        degrees = self.__degrees[room_ids]
+        assert np.all(degrees > 0), "Cannot choose from nothing"
+        return self.__neighbours[self.__offsets[room_ids] + np.minimum((np.asarray(draws) * degrees).astype(np.int64), degrees - 1)]
+
+
+def connect_components(num_rooms: int, edges: np.array) -> np.array:
+    """Returns the edges, plus one edge joining the lowest room id of each connected component to that of the next"""
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    # Union-find over the rooms
+    parents = np.arange(num_rooms)
+
+    def find(room_id):
+        while parents[room_id] != room_id:
+            parents[room_id] = parents[parents[room_id]]
+            room_id = parents[room_id]
+        return room_id
+
+    for a, b in edges:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parents[max(root_a, root_b)] = min(root_a, root_b)
+    roots = sorted({find(room_id) for room_id in range(num_rooms)})
+    return np.vstack((edges, np.column_stack((roots[:-1], roots[1:])).reshape(-1, 2)))
+
+
+def make_corridor_graph(num_rooms: int, prefix: str = "Room") -> RoomGraph:
+    """Returns num_rooms rooms in a line, each adjacent to the next"""
+    room_ids = np.arange(num_rooms - 1)
+    return RoomGraph.from_edges([f"{prefix} {i}" for i in range(num_rooms)], np.column_stack((room_ids, room_ids + 1)))
+
+
+def make_grid_graph(num_rows: int, num_columns: int, prefix: str = "Room") -> RoomGraph:
+    """Returns a num_rows x num_columns grid of rooms, each adjacent to the rooms above, below, left & right of it"""
+    room_ids = np.arange(num_rows * num_columns).reshape(num_rows, num_columns)
+    edges = np.vstack((np.column_stack((room_ids[:, :-1].ravel(), room_ids[:, 1:].ravel())),
+                       np.column_stack((room_ids[:-1, :].ravel(), room_ids[1:, :].ravel()))))
+    return RoomGraph.from_edges([f"{prefix} {row},{column}" for row in range(num_rows) for column in range(num_columns)], edges)
+
+
+def make_random_geometric_graph(num_rooms: int, radius: float, rng: np.random.Generator | None = None, ensure_connected: bool = True, prefix: str = "Room") -> RoomGraph:
+    """Returns num_rooms rooms placed uniformly at random in the unit square, where rooms closer than radius are adjacent.
+    If ensure_connected, any separate groups of rooms are joined up (see connect_components())."""
+    rng = rng if rng is not None else sampling.get_default_rng()
+    positions = rng.random((num_rooms, 2))
+    # Sort by x, so that only rooms within radius in x need their distance checked
+    order = np.argsort(positions[:, 0])
+    sorted_positions = positions[order]
+    window_ends = np.searchsorted(sorted_positions[:, 0], sorted_positions[:, 0] + radius, side="right")
+    edges = []
+    for i in range(num_rooms):
+        candidates = np.arange(i + 1, window_ends[i])
+        distances = np.linalg.norm(sorted_positions[candidates] - sorted_positions[i], axis=1)
+        close = candidates[distances < radius]
+        edges.append(np.column_stack((np.full(len(close), order[i]), order[close])))
+    edges = np.vstack(edges) if edges else np.empty((0, 2), dtype=np.int64)
+    if ensure_connected and num_rooms > 1:
+        edges = connect_components(num_rooms, edges)
+    return RoomGraph.from_edges([f"{prefix} {i}" for i in range(num_rooms)], edges)
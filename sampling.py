@@ -0,0 +1,72 @@
+from __future__ import annotations
+import numpy as np
+
+# Every draw made by the simulation consumes exactly one uniform double from a np.random.Generator.
+# So drawing a batch of B samples gives the same results as B scalar draws in turn, for a given seed.
+
+# The generator used when none is passed explicitly
+_default_rng = np.random.default_rng()
+
+
+def get_default_rng() -> np.random.Generator:
+    """Returns the generator used when no generator is passed explicitly"""
+    return _default_rng
+
+
+def seed(seed: int | np.random.SeedSequence | None = None) -> np.random.Generator:
+    """Re-seeds (replaces) the default generator, and returns it"""
+    global _default_rng
+    _default_rng = np.random.default_rng(seed)
+    return _default_rng
+
+
+def sample_categorical(probs: np.array, rng: np.random.Generator | None = None) -> int | np.array:
+    """Draws from a (A,) categorical distribution (returns an int), or from each row of a (B x A) batch (returns B ints).
+    The probabilities need not be normalised; zero-probability entries are never selected."""
+    rng = rng if rng is not None else _default_rng
+    probs = np.asarray(probs)
+    if probs.ndim == 1:
+        cumulative_probs = probs.cumsum()
+        draw = rng.random() * cumulative_probs[-1]
+        return min(int(cumulative_probs.searchsorted(draw, side="right")), len(probs) - 1)
+    return sample_categorical_with_draws(probs, rng.random(len(probs)))
+
+
+def sample_categorical_with_draws(probs: np.array, draws: np.array) -> np.array:
+    """Draws from each row of a (B x A) batch of categorical distributions, using the given B uniform draws in [0, 1)"""
+    cumulative_probs = np.cumsum(probs, axis=-1)
+    scaled_draws = np.asarray(draws) * cumulative_probs[:, -1]
+    # The number of entries with cumulative probability <= the draw is the (right) searchsorted index of each row
+    return np.minimum((cumulative_probs <= scaled_draws[:, None]).sum(axis=1), probs.shape[1] - 1)
+
+
+def sample_uniform_index(num_choices: int | np.array, rng: np.random.Generator | None = None) -> int | np.array:
+    """Draws a uniformly random index in [0, num_choices), for a single int or for each entry of an array of counts"""
+    rng = rng if rng is not None else _default_rng
+    if np.ndim(num_choices) == 0:
+        assert num_choices > 0, "Cannot choose from nothing"
+        return min(int(rng.random() * num_choices), int(num_choices) - 1)
+    num_choices = np.asarray(num_choices)
+    assert np.all(num_choices > 0), "Cannot choose from nothing"
+    return np.minimum((rng.random(len(num_choices)) * num_choices).astype(np.int64), num_choices - 1)
+
+
+# Counter-based draws: a uniform computed by hashing (key, tick, stream, id), rather than taken from a generator's
+# sequence. The same inputs always give the same draw, so results do not depend on the order in which draws are
+# made, or on which process makes them. The hash is the SplitMix64 finaliser.
+_HASH_MULTIPLIERS = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F), np.uint64(0x165667B19E3779F9))
+
+
+def hash_uniforms(key: int, tick: int, stream: int, ids: np.array) -> np.array:
+    """Returns a uniform draw in [0, 1) for each id, determined only by (key, tick, stream, id)"""
+    ids = np.asarray(ids).astype(np.uint64)
+    with np.errstate(over="ignore"):
+        x = np.uint64(key) ^ (np.uint64(tick) * _HASH_MULTIPLIERS[0]) ^ (np.uint64(stream) * _HASH_MULTIPLIERS[1])
+        x = (x + ids * _HASH_MULTIPLIERS[2]).astype(np.uint64)
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+    # The top 53 bits, as a double in [0, 1)
+    return (x >> np.uint64(11)).astype(float) * 2.0 ** -53
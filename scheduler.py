@@ -0,0 +1,119 @@
+from __future__ import annotations
+import numpy as np
+from typing import Dict
+from action_table import ActionTable
+from emotional_updates import apply_emotional_updates
+from room_graph import RoomGraph
+import sampling
+
+# The synchronous tick scheduler, an alternative to the sequential turns of Population.take_turn() (the reference
+# mode, as in metacode.ipynb). In a tick, everyone acts at once on the state at the start of the tick:
+#   1. Every person selects an action (intent), with the actions available at the start of the tick.
+#   2. Conversation actions update both partners' emotional states in bulk (summed, then clipped once),
+#      and a conversation ends if either partner takes leaves_conversation.
+#   3. People taking leaves_room move to a random adjacent room.
+#   4. In each room, the starts_conversation requests are resolved together by a randomised matching over the free
+#      people staying in the room: they are put in a random order, and paired off in turn (1st & 2nd, 3rd & 4th, ...),
+#      where a pair starts a conversation if either of them asked to. So each request is paired with a uniformly
+#      random free person (unless it is left over at the end of an odd-sized room).
+# Every random draw is a counter-based draw keyed by (tick key, tick number, stream, person index), see
+# sampling.hash_uniforms(), and people only interact within a room. So the result of a tick does not depend on the
+# order in which people are processed, and the rooms can be split between processes (see sharding.py).
+
+# How the turns of a round are run: one person at a time (Population.run_round()), or in a synchronous tick
+SCHEDULERS = ("sequential", "synchronous")
+ACTION_STREAM, ROOM_STREAM, MATCHING_STREAM = 0, 1, 2
+
+
+def get_turn_columns(num_turns: int) -> Dict[str, np.array]:
+    """Returns the empty columns of a tick's turns"""
+    return {column: np.empty(num_turns, dtype=np.int64) for column in
+            ("round_number", "person", "action", "location_before", "location_after", "partner_before", "partner_after")}
+
+
+def get_started_conversations(turns: Dict[str, np.array]) -> np.array:
+    """Returns the (k x 2) pairs (lower index first) of the conversations started by a tick's turns"""
+    persons = np.asarray(turns["person"], dtype=np.int64)
+    partners = np.asarray(turns["partner_after"], dtype=np.int64)
+    # Both partners of a new conversation were free at the start of the tick, so each pair is seen twice
+    is_started = (np.asarray(turns["partner_before"]) < 0) & (partners > persons)
+    return np.stack((persons[is_started], partners[is_started]), axis=1)
+
+
+def get_ended_conversations(turns: Dict[str, np.array], leaves_conversation_id: int) -> np.array:
+    """Returns the (k x 2) pairs (lower index first) of the conversations ended by a tick's turns"""
+    persons = np.asarray(turns["person"], dtype=np.int64)
+    partners = np.asarray(turns["partner_before"], dtype=np.int64)
+    is_leaving = (partners >= 0) & (np.asarray(turns["action"]) == leaves_conversation_id)
+    # Both partners may leave in the same tick, which ends one conversation
+    pairs = np.stack((np.minimum(persons, partners)[is_leaving], np.maximum(persons, partners)[is_leaving]), axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def run_synchronous_tick(indices: np.array, key: int, tick_number: int, action_table: ActionTable, emotional_probs_lookup,
+                         base_action_probs: np.array, room_graph: RoomGraph, emotional_state_vectors: np.array, locations: np.array,
+                         conversation_partners: np.array, current_action_probs: np.array | None = None) -> Dict[str, np.array]:
+    """Runs one synchronous tick for the given people (every person in the rooms they are in must be included), updating
+    the (N x 3) emotional states, locations and conversation partners in place. base_action_probs are the (n x A) base
+    probabilities of the given people. If current_action_probs (N x A) is given, each person's distribution is recorded.
+    Returns the turns as columns (as in trace_writer.TRACE_COLUMNS, with round_number the tick number)."""
+    indices = np.asarray(indices, dtype=np.int64)
+    turns = get_turn_columns(len(indices))
+    turns["round_number"][:] = tick_number
+    turns["person"][:] = indices
+    room_ids = turns["location_before"]
+    room_ids[:] = locations[indices]
+    partners = turns["partner_before"]
+    partners[:] = conversation_partners[indices]
+    in_conversation = partners >= 0
+
+    def get_action_id(name: str) -> int:
+        return action_table.get_action_id(name) if name in action_table else -1
+    starts_conversation_id, leaves_conversation_id, leaves_room_id = get_action_id(
+        "starts_conversation"), get_action_id("leaves_conversation"), get_action_id("leaves_room")
+
+    # 1. Intents, from the state at the start of the tick
+    available_masks = np.where(in_conversation[:, None],
+                               action_table.get_conversation_action_mask(), action_table.get_room_action_mask())
+    if starts_conversation_id >= 0:
+        free_counts = np.bincount(room_ids[~in_conversation], minlength=len(room_graph))
+        available_masks[:, starts_conversation_id] &= free_counts[room_ids] - ~in_conversation > 0
+    probs = action_table.combine_action_probs(emotional_probs_lookup.get_emotional_action_probs(
+        emotional_state_vectors[indices]), base_action_probs, available_masks)
+    if current_action_probs is not None:
+        current_action_probs[indices] = probs
+    action_ids = turns["action"]
+    action_ids[:] = sampling.sample_categorical_with_draws(
+        probs, sampling.hash_uniforms(key, tick_number, ACTION_STREAM, indices)) if len(indices) else []
+
+    # 2. Conversations: emotional updates in bulk, and conversations that end
+    apply_emotional_updates(emotional_state_vectors, indices[in_conversation], partners[in_conversation],
+                            action_ids[in_conversation], action_table)
+    is_leaving = in_conversation & (action_ids == leaves_conversation_id)
+    conversation_partners[indices[is_leaving]] = -1
+    conversation_partners[partners[is_leaving]] = -1
+
+    # 3. Moves
+    is_moving = ~in_conversation & (action_ids == leaves_room_id)
+    movers = indices[is_moving]
+    locations[movers] = room_graph.select_neighbours(
+        room_ids[is_moving], sampling.hash_uniforms(key, tick_number, ROOM_STREAM, movers))
+
+    # 4. Conversation matching, per room, over the free people staying in the room
+    is_pooled = ~in_conversation & ~is_moving
+    pool = indices[is_pooled]
+    pool_rooms = room_ids[is_pooled]
+    is_requesting = action_ids[is_pooled] == starts_conversation_id
+    order = np.lexsort((pool, sampling.hash_uniforms(key, tick_number, MATCHING_STREAM, pool), pool_rooms))
+    pool, pool_rooms, is_requesting = pool[order], pool_rooms[order], is_requesting[order]
+    room_starts = np.flatnonzero(np.r_[True, pool_rooms[1:] != pool_rooms[:-1]]) if len(pool) else np.empty(0, dtype=np.int64)
+    ranks = np.arange(len(pool)) - np.repeat(room_starts, np.diff(np.r_[room_starts, len(pool)]))
+    firsts = np.flatnonzero((ranks % 2 == 0)[:-1] & (pool_rooms[1:] == pool_rooms[:-1])) if len(pool) else np.empty(0, dtype=np.int64)
+    firsts = firsts[is_requesting[firsts] | is_requesting[firsts + 1]]
+    conversation_partners[pool[firsts]] = pool[firsts + 1]
+    conversation_partners[pool[firsts + 1]] = pool[firsts]
+
+    turns["location_after"][:] = locations[indices]
+    # As in the trace, the partner after a turn is the partner the turn was taken with
+    turns["partner_after"][:] = np.where(in_conversation, partners, conversation_partners[indices])
+    return turns
@@ -0,0 +1,230 @@
+from __future__ import annotations
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+import numpy as np
+from typing import Dict, List
+from population import Population
+from room_graph import RoomGraph
+import scheduler
+
+# Room-sharded synchronous ticks, for a single population too large for one process. People only interact with
+# others in the same room, so the rooms are partitioned between shard processes, and each shard runs the
+# synchronous ticks (see scheduler.py) of the people in its rooms. The state arrays are held in shared memory, and
+# each shard only writes the rows of its own people. At the end of each tick, a shard hands the people who moved
+# into a neighbouring shard's rooms to that shard through a migration queue (one per ordered pair of neighbouring
+# shards), and takes in the people who arrived. The migration queues are the only synchronisation between shards:
+# a shard starts its next tick once each neighbouring shard has finished the current one. As the draws of a tick
+# are counter-based, the results are the same as Population.run_tick() in a single process, for any partition.
+
+# How often (in seconds) to check that the shard processes are alive, while waiting for their results
+RESULT_POLL_SECONDS = 1.0
+
+
+def partition_rooms(room_graph: RoomGraph, num_shards: int, room_weights: np.array | None = None) -> np.array:
+    """Returns the shard of each room: the rooms in breadth-first order (so that each shard's rooms are mostly
+    connected, with few edges between shards), cut into num_shards runs of about equal total weight (default 1 per room)"""
+    num_rooms = len(room_graph)
+    assert 0 < num_shards <= num_rooms, "Need between 1 shard and 1 shard per room"
+    weights = np.ones(num_rooms) if room_weights is None else np.asarray(room_weights, dtype=float)
+    assert weights.shape == (num_rooms,) and np.all(weights >= 0) and weights.sum() > 0, "Room weights must be non-negative, and not all 0"
+    order = []
+    visited = np.zeros(num_rooms, dtype=bool)
+    for first_room_id in range(num_rooms):
+        if visited[first_room_id]:
+            continue
+        visited[first_room_id] = True
+        frontier = [first_room_id]
+        # The frontier grows while it is iterated over
+        for room_id in frontier:
+            neighbours = room_graph.get_neighbours(room_id)
+            neighbours = neighbours[~visited[neighbours]]
+            visited[neighbours] = True
+            frontier.extend(neighbours.tolist())
+        order.extend(frontier)
+    order = np.array(order, dtype=np.int64)
+    # Each room goes to the shard that the middle of its weight falls in
+    cumulative_weights = np.cumsum(weights[order])
+    shards = ((cumulative_weights - weights[order] / 2) * (num_shards / cumulative_weights[-1])).astype(np.int64)
+    shard_of_room = np.empty(num_rooms, dtype=np.int64)
+    shard_of_room[order] = np.minimum(shards, num_shards - 1)
+    return shard_of_room
+
+
+def get_neighbouring_shards(room_graph: RoomGraph, shard_of_room: np.array) -> List[tuple]:
+    """Returns every ordered pair (from shard, to shard) of different shards with adjacent rooms"""
+    room_ids = np.repeat(np.arange(len(room_graph)), room_graph.get_degrees())
+    pairs = np.unique(np.stack((shard_of_room[room_ids], shard_of_room[room_graph.get_neighbour_array()]), axis=1), axis=0)
+    return [(int(from_shard), int(to_shard)) for from_shard, to_shard in pairs if from_shard != to_shard]
+
+
+def make_shared_array(array: np.array) -> tuple:
+    """Returns (block, copy of the array in the block) for a new block of shared memory"""
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    shared_array[...] = array
+    return block, shared_array
+
+
+def run_shard_ticks(shard: int, members: np.array, shard_of_room: np.array, key: int, tick_inputs: dict, arrays: Dict[str, np.array],
+                    commands: multiprocessing.Queue, migration_queues: Dict[tuple, multiprocessing.Queue], results: multiprocessing.Queue):
+    """Runs the ticks of one shard, starting with the given members, as commanded by (first tick number, number of
+    ticks), until commanded None"""
+    locations = arrays["locations"]
+    outgoing_queues = {to_shard: migration_queue for (from_shard, to_shard), migration_queue in migration_queues.items() if from_shard == shard}
+    incoming_queues = [migration_queue for (from_shard, to_shard), migration_queue in migration_queues.items() if to_shard == shard]
+    base_action_probs_table = tick_inputs["base_action_probs_table"]
+    base_action_probs_rows = tick_inputs["base_action_probs_rows"]
+    command = commands.get()
+    while command is not None:
+        first_tick_number, num_ticks = command
+        for tick_number in range(first_tick_number, first_tick_number + num_ticks):
+            turns = scheduler.run_synchronous_tick(
+                members, key, tick_number, tick_inputs["action_table"], tick_inputs["emotional_probs_lookup"],
+                base_action_probs_table[base_action_probs_rows[members]], tick_inputs["room_graph"],
+                arrays["emotional_state_vectors"], locations, arrays["conversation_partners"], arrays["current_action_probs"])
+            # Hand over the people who left this shard's rooms, then take in those who arrived (in index order)
+            destinations = shard_of_room[turns["location_after"]]
+            for to_shard, migration_queue in outgoing_queues.items():
+                migration_queue.put(members[destinations == to_shard])
+            results.put((shard, tick_number, turns))
+            members = np.sort(np.concatenate([members[destinations == shard]] + [migration_queue.get() for migration_queue in incoming_queues]))
+        command = commands.get()
+
+
+def run_shard(shard: int, members: np.array, shard_of_room: np.array, key: int, tick_inputs: dict, array_specs: Dict[str, tuple],
+              commands: multiprocessing.Queue, migration_queues: Dict[tuple, multiprocessing.Queue], results: multiprocessing.Queue):
+    """The body of a shard process: attaches the shared state arrays, and runs the shard's ticks"""
+    blocks = {name: shared_memory.SharedMemory(name=block_name) for name, (block_name, _, _) in array_specs.items()}
+    try:
+        arrays = {name: np.ndarray(shape, dtype=dtype, buffer=blocks[name].buf) for name, (_, shape, dtype) in array_specs.items()}
+        run_shard_ticks(shard, members, shard_of_room, key, tick_inputs, arrays, commands, migration_queues, results)
+    finally:
+        # The views must be released before the blocks can be closed
+        arrays = None
+        for block in blocks.values():
+            block.close()
+
+
+class ShardedPopulation:
+    """Runs the synchronous ticks of one population in num_shards processes, each running the people in its rooms
+    (see partition_rooms(), by default weighted by the number of people in each room). The population is updated after
+    every call to run_ticks(), and must not be changed in any other way while this is open. Use as a context manager,
+    or call close() to stop the processes."""
+
+    def __init__(self, population: Population, num_shards: int, shard_of_room: np.array | None = None):
+        room_graph = population.get_room_graph()
+        if shard_of_room is None:
+            shard_of_room = partition_rooms(room_graph, num_shards, np.bincount(
+                population.get_locations(), minlength=len(room_graph)) + 1)
+        self.__population = population
+        self.__shard_of_room = np.asarray(shard_of_room, dtype=np.int64)
+        self.__num_shards = num_shards
+        assert self.__shard_of_room.shape == (len(room_graph),) and np.all(
+            (self.__shard_of_room >= 0) & (self.__shard_of_room < num_shards)), "Every room needs a shard"
+        self.__tick_number = population.get_tick_number()
+
+        # The state arrays written by ticks are copied into shared memory
+        self.__blocks = dict()
+        self.__arrays = dict()
+        for name, array in (("emotional_state_vectors", population.get_emotional_state_vectors()), ("locations", population.get_locations()),
+                            ("conversation_partners", population.get_conversation_partners()),
+                            ("current_action_probs", population.get_current_action_probs())):
+            self.__blocks[name], self.__arrays[name] = make_shared_array(array)
+        array_specs = {name: (self.__blocks[name].name, array.shape, array.dtype.str) for name, array in self.__arrays.items()}
+        # Everything else a tick needs is read-only, so is copied into each process once
+        tick_inputs = {"action_table": population.get_action_table(), "emotional_probs_lookup": population.get_emotional_probs_lookup(),
+                             "room_graph": room_graph, "base_action_probs_table": population.get_base_action_probs_table(),
+                             "base_action_probs_rows": population.get_base_action_probs_rows()}
+
+        self.__commands = [multiprocessing.Queue() for _ in range(num_shards)]
+        self.__results = multiprocessing.Queue()
+        migration_queues = {pair: multiprocessing.Queue() for pair in get_neighbouring_shards(room_graph, self.__shard_of_room)}
+        # The first members are found here, as a shard that has started its first tick may already have moved people
+        # in the shared locations before another shard has started
+        shard_of_person = self.__shard_of_room[population.get_locations()]
+        key = population.start_ticks()
+        self.__processes = [multiprocessing.Process(target=run_shard, daemon=True, args=(
+            shard, np.flatnonzero(shard_of_person == shard), self.__shard_of_room, key, tick_inputs, array_specs,
+            self.__commands[shard], migration_queues, self.__results)) for shard in range(num_shards)]
+        for process in self.__processes:
+            process.start()
+        self.__closed = False
+
+    def __enter__(self) -> ShardedPopulation:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self) -> str:
+        return f"ShardedPopulation of {len(self.__population)} people in {self.__num_shards} shards"
+
+    def get_population(self) -> Population:
+        """Returns the population being run"""
+        return self.__population
+
+    def get_num_shards(self) -> int:
+        """Returns the number of shards (processes)"""
+        return self.__num_shards
+
+    def get_shard_of_room(self) -> np.array:
+        """Returns the shard of each room"""
+        return self.__shard_of_room
+
+    def run_ticks(self, num_ticks: int) -> List[Dict[str, np.array]]:
+        """Runs num_ticks synchronous ticks (the shards only wait for their neighbours between ticks), and returns the
+        turns of each tick, as from Population.run_tick()"""
+        assert not self.__closed, "Sharded population is closed"
+        assert self.__population.get_tick_number() == self.__tick_number, "The population was changed outside the shards"
+        for commands in self.__commands:
+            commands.put((self.__tick_number, num_ticks))
+        shard_turns = [[] for _ in range(num_ticks)]
+        for _ in range(num_ticks * self.__num_shards):
+            _, tick_number, turns = self.__get_result()
+            shard_turns[tick_number - self.__tick_number].append(turns)
+        # Every turn is in exactly one shard's results, so the turns of a tick are merged back into person order
+        ticks = []
+        for turns_list in shard_turns:
+            order = np.argsort(np.concatenate([turns["person"] for turns in turns_list]))
+            ticks.append({column: np.concatenate([turns[column] for turns in turns_list])[order] for column in turns_list[0]})
+
+        for name, array in (("emotional_state_vectors", self.__population.get_emotional_state_vectors()), ("locations", self.__population.get_locations()),
+                            ("conversation_partners", self.__population.get_conversation_partners()),
+                            ("current_action_probs", self.__population.get_current_action_probs())):
+            array[...] = self.__arrays[name]
+        self.__population.end_ticks(num_ticks)
+        self.__tick_number += num_ticks
+        return ticks
+
+    def __get_result(self) -> tuple:
+        """Waits for the next result of a shard, failing (and closing) if a shard process has died"""
+        while True:
+            try:
+                return self.__results.get(timeout=RESULT_POLL_SECONDS)
+            except queue.Empty:
+                dead_shards = [shard for shard, process in enumerate(self.__processes) if not process.is_alive()]
+                if dead_shards:
+                    # The other shards may be waiting on the dead shard's migrations, so are stopped too
+                    for process in self.__processes:
+                        process.terminate()
+                    self.close()
+                    raise RuntimeError(f"Shard processes {dead_shards} exited during a tick")
+
+    def run_tick(self) -> Dict[str, np.array]:
+        """Runs one synchronous tick, and returns its turns (see Population.run_tick())"""
+        return self.run_ticks(1)[0]
+
+    def close(self):
+        """Stops the shard processes, and frees the shared memory"""
+        if self.__closed:
+            return
+        self.__closed = True
+        for commands in self.__commands:
+            commands.put(None)
+        for process in self.__processes:
+            process.join()
+        self.__arrays = None
+        for block in self.__blocks.values():
+            block.close()
+            block.unlink()
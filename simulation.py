@@ -0,0 +1,482 @@
+from __future__ import annotations
+import argparse
+import contextlib
+import copy
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from typing import Callable, Dict, List
+from aggregators import Aggregator, get_default_aggregators, get_results, merge_aggregators
+from checkpoint import load_checkpoint, load_checkpoint_aggregators, save_checkpoint
+from emotional_probs import LOOKUP_MODES, make_emotional_probs_lookup
+from population import Population
+from room import Room
+from room_graph import RoomGraph, make_corridor_graph, make_grid_graph, make_random_geometric_graph
+from replicas import ReplicaBatch
+from scheduler import SCHEDULERS
+from sharding import ShardedPopulation
+from trace_writer import ACTION_PROBS_COLUMN, METADATA_FILENAME, PAD_DIMENSIONS, TraceWriter, merge_traces, remove_trace
+import metacode_helpers
+import profiling
+
+PACKAGE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_ACTION_FILEPATH = os.path.join(PACKAGE_DIRECTORY, "action_values.csv")
+DEFAULT_NAMES_FILEPATH = os.path.join(PACKAGE_DIRECTORY, "names.csv")
+
+# The room graph used in metacode.ipynb: the Hall is adjacent to the Kitchen and the Lounge.
+# A room graph maps each room name to the names of (some of) its adjacent rooms; adjacency is symmetric.
+DEFAULT_ROOM_GRAPH = {"Hall": ["Kitchen", "Lounge"], "Kitchen": [], "Lounge": []}
+
+
+def build_rooms(room_graph: Dict[str, List[str]] | RoomGraph) -> List[Room]:
+    """Creates the rooms of a room graph, in the graph's order, and connects the adjacent rooms"""
+    if not isinstance(room_graph, RoomGraph):
+        room_graph = RoomGraph.from_dict(room_graph)
+    return room_graph.build_rooms()
+
+
+def make_room_layout(layout: str, seed: int | None = None) -> RoomGraph:
+    """Generates the room graph of a layout specification: "corridor:<num_rooms>", "grid:<num_rows>x<num_columns>"
+    or "geometric:<num_rooms>:<radius>" (rooms placed at random, using the given seed)"""
+    kind, _, size = layout.partition(":")
+    if kind == "corridor":
+        return make_corridor_graph(int(size))
+    if kind == "grid":
+        num_rows, num_columns = size.split("x")
+        return make_grid_graph(int(num_rows), int(num_columns))
+    if kind == "geometric":
+        num_rooms, radius = size.split(":")
+        return make_random_geometric_graph(int(num_rooms), float(radius), rng=np.random.default_rng(seed))
+    raise ValueError(f"Unknown room layout: {layout}")
+
+
+def make_turn_columns(num_turns: int, round_number: int) -> Dict[str, np.array]:
+    """Returns the columns recorded for each turn of a round (by person index), to be filled in"""
+    return {"round_number": np.full(num_turns, round_number, dtype=np.int64), "person": np.arange(num_turns),
+            **{column: np.empty(num_turns, dtype=np.int64) for column in ("action", "location_before", "location_after", "partner_before", "partner_after")}}
+
+
+def run_recorded_round(population: Population, round_number: int) -> Dict[str, np.array]:
+    """Runs one round (every person takes a turn, in index order), and returns the turns as columns
+    (as in trace_writer.TRACE_COLUMNS, without the emotional states), e.g. for the aggregators"""
+    locations = population.get_locations()
+    conversation_partners = population.get_conversation_partners()
+    turns = make_turn_columns(len(population), round_number)
+    turns["location_before"][:] = locations
+    population.prepare_turns()
+    for index in range(len(population)):
+        partner_before = turns["partner_before"][index] = conversation_partners[index]
+        turns["action"][index] = population.take_turn(index)
+        turns["location_after"][index] = locations[index]
+        turns["partner_after"][index] = partner_before if partner_before >= 0 else conversation_partners[index]
+    return turns
+
+
+def run_traced_round(population: Population, trace_writer: TraceWriter, run_number: int, round_number: int, turn_number: int) -> Dict[str, np.array]:
+    """Runs one round (every person takes a turn, in index order), writing a trace row per turn starting at turn_number.
+    Returns the turns as columns (see run_recorded_round())."""
+    emotional_state_vectors = population.get_emotional_state_vectors()
+    locations = population.get_locations()
+    conversation_partners = population.get_conversation_partners()
+    current_action_probs = population.get_current_action_probs()
+    turns = make_turn_columns(len(population), round_number)
+    population.prepare_turns()
+    for index in range(len(population)):
+        partner_before = conversation_partners[index]
+        location_before = locations[index]
+        person_emotional_state_before = emotional_state_vectors[index].copy()
+        partner_emotional_state_before = emotional_state_vectors[partner_before].copy(
+        ) if partner_before >= 0 else None
+
+        action_id = population.take_turn(index)
+
+        # As in metacode.ipynb, the partner after a turn is the partner the turn was taken with
+        # (the old partner after leaving a conversation, or the new partner after starting one).
+        partner_after = partner_before if partner_before >= 0 else conversation_partners[index]
+        trace_writer.append_turn(run_number, round_number, turn_number, index, action_id, location_before, locations[index],
+                                 person_emotional_state_before, emotional_state_vectors[index],
+                                 partner_before=partner_before, partner_after=partner_after,
+                                 partner_emotional_state_before=partner_emotional_state_before,
+                                 partner_emotional_state_after=emotional_state_vectors[partner_after] if partner_after >= 0 else None,
+                                 action_probs=current_action_probs[index])
+        turn_number += 1
+        for column, value in (("action", action_id), ("location_before", location_before), ("location_after", locations[index]),
+                              ("partner_before", partner_before), ("partner_after", partner_after)):
+            turns[column][index] = value
+    return turns
+
+
+def run_traced_tick(population: Population, trace_writer: TraceWriter, run_number: int, round_number: int, turn_number: int,
+                    run_tick: Callable[[], Dict[str, np.array]] | None = None) -> Dict[str, np.array]:
+    """Runs one synchronous tick (with run_tick, default Population.run_tick()), writing a trace row per turn (in person
+    order) starting at turn_number. Returns the turns as columns (see run_recorded_round())."""
+    emotional_state_vectors = population.get_emotional_state_vectors()
+    emotional_state_vectors_before = emotional_state_vectors.copy()
+    turns = run_tick() if run_tick is not None else population.run_tick()
+    turns["round_number"][:] = round_number
+    columns = {"run_number": np.full(len(population), run_number), "turn_number": turn_number + np.arange(len(population)),
+               ACTION_PROBS_COLUMN: population.get_current_action_probs(), **turns}
+    # As in run_traced_round(), the partner's states are those of partner_before before, and partner_after after
+    for who, when, indices, states in (("person", "before", turns["person"], emotional_state_vectors_before),
+                                       ("person", "after", turns["person"], emotional_state_vectors),
+                                       ("partner", "before", turns["partner_before"], emotional_state_vectors_before),
+                                       ("partner", "after", turns["partner_after"], emotional_state_vectors)):
+        values = np.where((indices >= 0)[:, None], states[indices], np.nan)
+        for i, dimension in enumerate(PAD_DIMENSIONS):
+            columns[f"{who}_{dimension}_{when}"] = values[:, i]
+    trace_writer.append_turns(columns)
+    return turns
+
+
+def get_checkpoint_filename(run_number: int) -> str:
+    """Returns the file name of a run's checkpoint (the latest checkpoint of a run replaces the previous one)"""
+    return f"run_{run_number:05d}.npz"
+
+
+def run_single(run_number: int, seed_sequence: np.random.SeedSequence, num_rounds: int, num_people: int, room_graph: Dict[str, List[str]] | RoomGraph,
+               action_filepath: str, names_filepath: str, trace_directory: str | None = None, chunk_size: int = 65536,
+               checkpoint_directory: str | None = None, checkpoint_interval: int = 0, aggregators: List[Aggregator] | None = None,
+               emotional_probs_mode: str = "exact", emotional_probs_resolution: int = 21, profile: bool = False,
+               scheduler: str = "sequential", num_shards: int = 1) -> dict:
+    """Runs one independent simulation run with its own generator, and returns a summary of it.
+    This is the unit of work handed to each worker process.
+    If a checkpoint directory is given, the run's state is saved there every checkpoint_interval rounds, and a run
+    whose checkpoint already exists resumes from it (its trace then only covers the rounds after the checkpoint).
+    Copies of the given (empty) aggregators are updated every round, and returned in the summary.
+    emotional_probs_mode selects how emotional action probabilities are computed (see emotional_probs.py).
+    If profile, the run is profiled (see profiling.py), and the summary includes its per-round profile.
+    scheduler selects sequential turns (the reference, as in metacode.ipynb) or synchronous ticks (see scheduler.py).
+    Synchronous ticks can be split between num_shards processes by room (see sharding.py), with the same results."""
+    assert scheduler in SCHEDULERS, f"scheduler must be one of {SCHEDULERS}"
+    assert num_shards == 1 or scheduler == "synchronous", "Only synchronous ticks can be sharded"
+    checkpoint_filepath = None if checkpoint_directory is None else os.path.join(
+        checkpoint_directory, get_checkpoint_filename(run_number))
+    if checkpoint_filepath is not None and os.path.exists(checkpoint_filepath):
+        population, metadata = load_checkpoint(checkpoint_filepath)
+        first_round_number = metadata["round_number"]
+        action_counts = np.array(metadata["action_counts"], dtype=np.int64)
+    else:
+        rng = np.random.default_rng(seed_sequence)
+        all_possible_actions = metacode_helpers.initialise_all_actions(
+            action_filepath)
+        if not isinstance(room_graph, RoomGraph):
+            room_graph = RoomGraph.from_dict(room_graph)
+        population = metacode_helpers.initialise_population(
+            all_possible_actions, room_graph, num_people=num_people, rng=rng, names_filepath=names_filepath)
+        first_round_number = 0
+        action_counts = np.zeros(len(all_possible_actions), dtype=np.int64)
+    all_possible_actions = population.get_action_table()
+    population.set_emotional_probs_lookup(make_emotional_probs_lookup(
+        all_possible_actions, emotional_probs_mode, resolution=emotional_probs_resolution))
+    aggregators = copy.deepcopy(aggregators) if aggregators is not None else []
+    if first_round_number > 0 and aggregators:
+        # A resumed run continues the aggregators saved with its checkpoint, which cover the rounds before it
+        saved_aggregators = load_checkpoint_aggregators(checkpoint_filepath)
+        assert saved_aggregators is not None, f"{checkpoint_filepath} was saved without aggregators, so cannot be resumed with them"
+        assert [type(aggregator) for aggregator in saved_aggregators] == [type(aggregator) for aggregator in aggregators], \
+            f"{checkpoint_filepath} was saved with different aggregators"
+        aggregators = saved_aggregators
+    else:
+        for aggregator in aggregators:
+            aggregator.start(population)
+
+    trace_writer_context = contextlib.nullcontext() if trace_directory is None else TraceWriter(
+        trace_directory, person_names=population.get_names(), room_names=population.get_room_graph().get_room_names(),
+        action_names=all_possible_actions.get_names(), personality_vectors=population.get_personality_vectors(), chunk_size=chunk_size)
+    profiling_context = profiling.profile() if profile else contextlib.nullcontext()
+    sharding_context = ShardedPopulation(population, num_shards) if num_shards > 1 else contextlib.nullcontext()
+    with trace_writer_context as trace_writer, profiling_context as profiler, sharding_context as sharded_population:
+        run_tick = sharded_population.run_tick if sharded_population is not None else population.run_tick
+        for round_number in range(first_round_number, num_rounds):
+            if scheduler == "synchronous":
+                if trace_writer is not None:
+                    turns = run_traced_tick(population, trace_writer, run_number,
+                                            round_number, round_number * num_people, run_tick)
+                else:
+                    turns = run_tick()
+                    turns["round_number"][:] = round_number
+            elif trace_writer is not None:
+                turns = run_traced_round(
+                    population, trace_writer, run_number, round_number, round_number * num_people)
+            elif aggregators:
+                turns = run_recorded_round(population, round_number)
+            else:
+                turns = {"action": population.run_round()}
+            for aggregator in aggregators:
+                aggregator.update(population, turns)
+            action_counts += np.bincount(turns["action"],
+                                         minlength=len(all_possible_actions))
+            profiling.end_round(round_number)
+            if checkpoint_filepath is not None and checkpoint_interval > 0 and (round_number + 1) % checkpoint_interval == 0:
+                save_checkpoint(population, checkpoint_filepath, {"run_number": run_number, "round_number": round_number + 1,
+                                                                  "action_counts": action_counts.tolist()},
+                                aggregators=aggregators)
+
+    return {
+        "run_number": run_number,
+        # Only the turns run by this call (a resumed run starts from its checkpoint's round)
+        "num_turns": max(num_rounds - first_round_number, 0) * num_people,
+        "action_counts": action_counts,
+        "final_emotional_state_vectors": population.get_emotional_state_vectors(),
+        "final_locations": population.get_locations(),
+        "trace_directory": trace_directory,
+        "aggregators": aggregators,
+        "profile": profiler.get_rounds() if profiler is not None else None,
+    }
+
+
+def write_replica_round(trace_writer: TraceWriter, turns: Dict[str, np.array], replica: int, run_number: int, turn_number: int,
+                        current_action_probs: np.array):
+    """Writes one replica's rows of a ReplicaBatch.run_round() (recorded with emotional states) to its trace"""
+    num_people = turns["person"].shape[1]
+    columns = {"run_number": np.full(num_people, run_number), "turn_number": turn_number + np.arange(num_people),
+               ACTION_PROBS_COLUMN: current_action_probs,
+               **{column: turns[column][replica] for column in ("round_number", "person", "action", "location_before",
+                                                                "location_after", "partner_before", "partner_after")}}
+    for who in ("person", "partner"):
+        for when in ("before", "after"):
+            for i, dimension in enumerate(PAD_DIMENSIONS):
+                columns[f"{who}_{dimension}_{when}"] = turns[f"{who}_emotional_state_{when}"][replica, :, i]
+    trace_writer.append_turns(columns)
+
+
+def run_batch(run_numbers: List[int], seed_sequences: List[np.random.SeedSequence], num_rounds: int, num_people: int,
+              room_graph: Dict[str, List[str]] | RoomGraph, action_filepath: str, names_filepath: str,
+              trace_directories: List[str] | None = None, chunk_size: int = 65536, aggregators: List[Aggregator] | None = None,
+              emotional_probs_mode: str = "exact", emotional_probs_resolution: int = 21) -> List[dict]:
+    """Runs several independent runs together as one ReplicaBatch (see replicas.py), and returns the summary of each
+    (as from run_single(), with the same results for the same seed sequences). Each run writes its own trace."""
+    all_possible_actions = metacode_helpers.initialise_all_actions(action_filepath)
+    if not isinstance(room_graph, RoomGraph):
+        room_graph = RoomGraph.from_dict(room_graph)
+    populations = [metacode_helpers.initialise_population(all_possible_actions, room_graph, num_people=num_people,
+                                                          rng=np.random.default_rng(seed_sequence), names_filepath=names_filepath)
+                   for seed_sequence in seed_sequences]
+    # Every replica uses the first population's action table (so its emotional probability lookup too)
+    populations[0].set_emotional_probs_lookup(make_emotional_probs_lookup(
+        populations[0].get_action_table(), emotional_probs_mode, resolution=emotional_probs_resolution))
+    batch = ReplicaBatch(populations)
+    action_table = batch.get_action_table()
+    replica_aggregators = [copy.deepcopy(aggregators) if aggregators is not None else [] for _ in run_numbers]
+    for replica, aggregator_list in enumerate(replica_aggregators):
+        for aggregator in aggregator_list:
+            aggregator.start(batch.get_replica(replica))
+    action_counts = np.zeros((len(run_numbers), len(action_table)), dtype=np.int64)
+
+    with contextlib.ExitStack() as stack:
+        trace_writers = None if trace_directories is None else [stack.enter_context(TraceWriter(
+            trace_directory, person_names=batch.get_names(), room_names=room_graph.get_room_names(), action_names=action_table.get_names(),
+            personality_vectors=batch.get_personality_vectors(), chunk_size=chunk_size)) for trace_directory in trace_directories]
+        for round_number in range(num_rounds):
+            turns = batch.run_round(round_number, record_emotional_states=trace_writers is not None)
+            for replica, run_number in enumerate(run_numbers):
+                if trace_writers is not None:
+                    write_replica_round(trace_writers[replica], turns, replica, run_number, round_number * num_people,
+                                        batch.get_current_action_probs()[replica])
+                if replica_aggregators[replica]:
+                    replica_turns = {column: turns[column][replica] for column in (
+                        "round_number", "person", "action", "location_before", "location_after", "partner_before", "partner_after")}
+                    for aggregator in replica_aggregators[replica]:
+                        aggregator.update(batch.get_replica(replica), replica_turns)
+                action_counts[replica] += np.bincount(turns["action"][replica], minlength=len(action_table))
+
+    return [{
+        "run_number": run_number,
+        "num_turns": num_rounds * num_people,
+        "action_counts": action_counts[replica],
+        "final_emotional_state_vectors": batch.get_emotional_state_vectors()[replica].copy(),
+        "final_locations": batch.get_locations()[replica].copy(),
+        "trace_directory": None if trace_directories is None else trace_directories[replica],
+        "aggregators": replica_aggregators[replica],
+        "profile": None,
+    } for replica, run_number in enumerate(run_numbers)]
+
+
+class Simulation:
+    """Runs a number of independent simulation runs of a population, optionally in parallel.
+
+    Each run gets its own np.random.Generator, spawned from a single SeedSequence, so results for a
+    given seed do not depend on the number of worker processes. If a trace directory is given, each
+    run writes its own trace, and the traces are merged (in run order) into the trace directory, which must not
+    already hold a trace unless overwrite_trace (the old trace is then replaced once the runs have finished).
+    If a checkpoint directory is given, each run saves its state there every checkpoint_interval
+    rounds, and running the same simulation again resumes each run from its latest checkpoint.
+    If aggregators are given, every run updates its own copies of them, and these are merged after
+    the runs (see get_aggregators()), so summaries need no trace.
+    """
+
+    def __init__(self, num_runs: int = 10, num_rounds: int = 10, num_people: int = 32, room_graph: Dict[str, List[str]] | RoomGraph | None = None,
+                 action_filepath: str = DEFAULT_ACTION_FILEPATH, names_filepath: str = DEFAULT_NAMES_FILEPATH, seed: int | None = None,
+                 trace_directory: str | None = None, num_workers: int | None = None, chunk_size: int = 65536,
+                 checkpoint_directory: str | None = None, checkpoint_interval: int = 0, aggregators: List[Aggregator] | None = None,
+                 emotional_probs_mode: str = "exact", emotional_probs_resolution: int = 21, profile: bool = False,
+                 scheduler: str = "sequential", num_shards: int = 1, batch_size: int = 1, overwrite_trace: bool = False):
+        assert num_runs > 0 and num_rounds >= 0 and num_people > 0, "Number of runs & people must be positive"
+        self.__num_runs = num_runs
+        self.__num_rounds = num_rounds
+        self.__num_people = num_people
+        # Compiled once here, and shared by every run
+        if not isinstance(room_graph, RoomGraph):
+            room_graph = RoomGraph.from_dict(
+                room_graph if room_graph is not None else DEFAULT_ROOM_GRAPH)
+        self.__room_graph = room_graph
+        self.__action_filepath = action_filepath
+        self.__names_filepath = names_filepath
+        self.__seed_sequence = np.random.SeedSequence(seed)
+        self.__trace_directory = trace_directory
+        self.__overwrite_trace = overwrite_trace
+        # None uses one worker per CPU; 1 runs everything in this process.
+        self.__num_workers = num_workers
+        self.__chunk_size = chunk_size
+        self.__checkpoint_directory = checkpoint_directory
+        self.__checkpoint_interval = checkpoint_interval
+        self.__aggregators = list(aggregators) if aggregators is not None else []
+        self.__merged_aggregators = None
+        assert emotional_probs_mode in LOOKUP_MODES, f"emotional_probs_mode must be one of {LOOKUP_MODES}"
+        self.__emotional_probs_mode = emotional_probs_mode
+        self.__emotional_probs_resolution = emotional_probs_resolution
+        self.__profile = profile
+        assert scheduler in SCHEDULERS, f"scheduler must be one of {SCHEDULERS}"
+        self.__scheduler = scheduler
+        assert num_shards == 1 or scheduler == "synchronous", "Only synchronous ticks can be sharded"
+        # Sharded runs are run one at a time, each using num_shards processes
+        self.__num_shards = num_shards
+        # Runs can be batched together as replicas (see replicas.py), which only supports the basic sequential runs
+        assert batch_size == 1 or (scheduler == "sequential" and checkpoint_directory is None and not profile), \
+            "Batched runs do not support synchronous ticks, checkpoints or profiling"
+        self.__batch_size = batch_size
+
+    def get_seed_sequence(self) -> np.random.SeedSequence:
+        """Returns the seed sequence that every run's generator is spawned from"""
+        return self.__seed_sequence
+
+    def get_aggregators(self) -> List[Aggregator] | None:
+        """Returns the aggregators of the last call to run(), merged over every run (None before the first run)"""
+        return self.__merged_aggregators
+
+    def run(self) -> List[dict]:
+        """Runs every run, and returns the summary of each (in run order)"""
+        # Spawned from a copy, so that calling run() again repeats the same runs
+        seed_sequences = np.random.SeedSequence(
+            self.__seed_sequence.entropy).spawn(self.__num_runs)
+        run_directory = None
+        if self.__trace_directory is not None:
+            # Checked before any run, rather than when the traces are merged
+            has_trace = os.path.exists(os.path.join(self.__trace_directory, METADATA_FILENAME))
+            assert self.__overwrite_trace or not has_trace, f"{self.__trace_directory} already contains a trace"
+            # Per-run traces are written next to the final trace, so merging only moves files
+            os.makedirs(self.__trace_directory, exist_ok=True)
+            run_directory = tempfile.mkdtemp(
+                prefix="runs_", dir=self.__trace_directory)
+        tasks = [dict(run_number=run_number, seed_sequence=seed_sequences[run_number], num_rounds=self.__num_rounds, num_people=self.__num_people,
+                      room_graph=self.__room_graph, action_filepath=self.__action_filepath, names_filepath=self.__names_filepath,
+                      trace_directory=None if run_directory is None else os.path.join(
+                          run_directory, f"run_{run_number:05d}"),
+                      chunk_size=self.__chunk_size, checkpoint_directory=self.__checkpoint_directory,
+                      checkpoint_interval=self.__checkpoint_interval, aggregators=self.__aggregators,
+                      emotional_probs_mode=self.__emotional_probs_mode, emotional_probs_resolution=self.__emotional_probs_resolution,
+                      profile=self.__profile, scheduler=self.__scheduler, num_shards=self.__num_shards) for run_number in range(self.__num_runs)]
+
+        if self.__batch_size > 1:
+            # Each task is a batch of consecutive runs
+            tasks = [dict(run_numbers=[task["run_number"] for task in batch_tasks], seed_sequences=[task["seed_sequence"] for task in batch_tasks],
+                          trace_directories=None if run_directory is None else [task["trace_directory"] for task in batch_tasks],
+                          **{name: batch_tasks[0][name] for name in ("num_rounds", "num_people", "room_graph", "action_filepath", "names_filepath",
+                                                                     "chunk_size", "aggregators", "emotional_probs_mode", "emotional_probs_resolution")})
+                     for batch_tasks in (tasks[start:start + self.__batch_size] for start in range(0, len(tasks), self.__batch_size))]
+        run_task = run_batch if self.__batch_size > 1 else run_single
+        if self.__num_workers == 1 or self.__num_shards > 1:
+            results = [run_task(**task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=self.__num_workers) as executor:
+                futures = [executor.submit(run_task, **task)
+                           for task in tasks]
+                results = [future.result() for future in futures]
+        if self.__batch_size > 1:
+            results = [result for batch_results in results for result in batch_results]
+
+        if run_directory is not None:
+            if has_trace:
+                remove_trace(self.__trace_directory)
+            merge_traces([result["trace_directory"]
+                         for result in results], self.__trace_directory)
+            shutil.rmtree(run_directory)
+            for result in results:
+                result["trace_directory"] = self.__trace_directory
+        self.__merged_aggregators = merge_aggregators(
+            [copy.deepcopy(self.__aggregators)] + [result["aggregators"] for result in results])
+        return results
+
+
+def main(argv: List[str] | None = None):
+    """Command line entry point (run `python simulation.py --help` for the options)"""
+    parser = argparse.ArgumentParser(
+        description="Run independent simulation runs in parallel, and write their merged trace.")
+    parser.add_argument("--num-runs", type=int, default=10)
+    parser.add_argument("--num-rounds", type=int, default=10)
+    parser.add_argument("--num-people", type=int, default=32)
+    parser.add_argument("--room-graph", default=None,
+                        help="JSON file mapping each room name to a list of adjacent room names (default: Hall, Kitchen & Lounge)")
+    parser.add_argument("--layout", default=None,
+                        help="generated room graph instead of --room-graph: corridor:<rooms>, grid:<rows>x<columns> or geometric:<rooms>:<radius>")
+    parser.add_argument("--actions", default=DEFAULT_ACTION_FILEPATH,
+                        help="action CSV file")
+    parser.add_argument("--names", default=DEFAULT_NAMES_FILEPATH,
+                        help="names CSV file")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--trace", default=None,
+                        help="directory to write the merged trace to (no trace is written if omitted)")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="replace a trace already in the --trace directory")
+    parser.add_argument("--checkpoints", default=None,
+                        help="directory to save each run's latest checkpoint to (and resume runs from, if they have one)")
+    parser.add_argument("--checkpoint-every", type=int, default=0,
+                        help="number of rounds between checkpoints")
+    parser.add_argument("--aggregate", default=None,
+                        help="JSON file to write summaries to (action counts per personality, conversation lengths, room occupancy & mean PAD per round)")
+    parser.add_argument("--emotional-probs", choices=LOOKUP_MODES, default="exact",
+                        help="how emotional action probabilities are computed: exactly, exactly with an LRU cache, or looked up on a precomputed PAD lattice")
+    parser.add_argument("--emotional-probs-resolution", type=int, default=21,
+                        help="lattice points per PAD dimension for the nearest & trilinear lookups")
+    parser.add_argument("--profile", default=None,
+                        help="JSON file to write each run's per-round phase times & event counters to")
+    parser.add_argument("--scheduler", choices=SCHEDULERS, default="sequential",
+                        help="run each round one person at a time (as in metacode.ipynb), or as a synchronous tick in which everyone acts at once")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="number of processes to split each run's rooms between (with --scheduler synchronous; runs are then run one at a time)")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="number of runs to step together as replicas in one process (faster for small populations)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    room_graph = None
+    if args.room_graph is not None:
+        with open(args.room_graph) as room_graph_file:
+            room_graph = json.load(room_graph_file)
+    elif args.layout is not None:
+        room_graph = make_room_layout(args.layout, seed=args.seed)
+
+    simulation = Simulation(num_runs=args.num_runs, num_rounds=args.num_rounds, num_people=args.num_people, room_graph=room_graph,
+                            action_filepath=args.actions, names_filepath=args.names, seed=args.seed, trace_directory=args.trace, num_workers=args.workers,
+                            checkpoint_directory=args.checkpoints, checkpoint_interval=args.checkpoint_every,
+                            aggregators=get_default_aggregators() if args.aggregate is not None else None,
+                            emotional_probs_mode=args.emotional_probs, emotional_probs_resolution=args.emotional_probs_resolution,
+                            profile=args.profile is not None, scheduler=args.scheduler, num_shards=args.shards, batch_size=args.batch_size,
+                            overwrite_trace=args.overwrite)
+    results = simulation.run()
+    print(f"Completed {len(results)} runs ({sum(result['num_turns'] for result in results)} turns)" +
+          (f", trace written to {args.trace}" if args.trace is not None else ""))
+    if args.aggregate is not None:
+        with open(args.aggregate, "w") as aggregate_file:
+            json.dump(get_results(simulation.get_aggregators()), aggregate_file)
+    if args.profile is not None:
+        with open(args.profile, "w") as profile_file:
+            json.dump([{"run_number": result["run_number"], "rounds": result["profile"]} for result in results], profile_file)
+
+
+if __name__ == "__main__":
+    main()
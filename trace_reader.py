@@ -0,0 +1,195 @@
+from __future__ import annotations
+import json
+import os
+import zipfile
+import numpy as np
+from typing import Dict, Iterator, List
+from trace_writer import ACTION_PROBS_COLUMN, read_trace_metadata
+
+# Reads traces (see trace_writer.py) without loading them: each chunk is an uncompressed .npz, so every column of a
+# chunk is a .npy file stored as-is inside the zip, and can be memory-mapped in place. Queries by run, round, person
+# and action use a sidecar index (index.npz, next to the trace's metadata.json), built on first use from the four
+# small id columns, and rebuilt whenever the trace has changed. For example, every turn where person 3 was in a
+# conversation in run 7:
+#   reader = TraceReader("logs/trace")
+#   rows = reader.select(run_number=7, person=3)
+#   rows = rows[reader.read_rows(rows, ["partner_before"])["partner_before"] >= 0]
+
+INDEX_FILENAME = "index.npz"
+INDEX_FORMAT_VERSION = 1
+
+
+def map_npz_members(filepath: str) -> Dict[str, np.memmap]:
+    """Returns a read-only memory map of every array in an uncompressed .npz file, by name"""
+    arrays = dict()
+    with zipfile.ZipFile(filepath) as zip_file, open(filepath, "rb") as npz_file:
+        for member in zip_file.infolist():
+            assert member.compress_type == zipfile.ZIP_STORED, f"{member.filename} in {filepath} is compressed"
+            # The member's data follows its local header (30 bytes, then the file name & extra field)
+            npz_file.seek(member.header_offset + 26)
+            name_length, extra_length = np.frombuffer(npz_file.read(4), dtype="<u2")
+            npz_file.seek(member.header_offset + 30 + int(name_length) + int(extra_length))
+            # The data is a .npy file: a header, then the raw array
+            version = np.lib.format.read_magic(npz_file)
+            read_array_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_array_header(npz_file)
+            name = member.filename[:-len(".npy")] if member.filename.endswith(".npy") else member.filename
+            if np.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(filepath, dtype=dtype, mode="r", offset=npz_file.tell(), shape=shape,
+                                         order="F" if fortran_order else "C")
+    return arrays
+
+
+class TraceReader:
+    """Memory-mapped, indexed access to the trace in a directory. Columns are returned as read-only views of the
+    chunk files where possible (a single chunk, or a whole column of a single-chunk trace), and selected rows are
+    only read from disk when asked for."""
+
+    def __init__(self, directory: str):
+        self.__directory = directory
+        self.__metadata = read_trace_metadata(directory)
+        self.__chunks = [map_npz_members(os.path.join(directory, chunk["file"])) for chunk in self.__metadata["chunks"]]
+        # The first row of each chunk, and the number of rows
+        self.__chunk_offsets = np.concatenate(([0], np.cumsum(
+            [chunk["num_rows"] for chunk in self.__metadata["chunks"]]))).astype(np.int64)
+        self.__index = None
+
+    def __len__(self) -> int:
+        return int(self.__chunk_offsets[-1])
+
+    def __repr__(self) -> str:
+        return f"TraceReader of {len(self)} rows in {len(self.__chunks)} chunks ({self.__directory})"
+
+    def get_directory(self) -> str:
+        """Returns the directory of the trace"""
+        return self.__directory
+
+    def get_metadata(self) -> dict:
+        """Returns the metadata of the trace (see TraceWriter)"""
+        return self.__metadata
+
+    def get_column_names(self) -> List[str]:
+        """Returns the names of the columns, including action_probs"""
+        return list(self.__metadata["columns"]) + [ACTION_PROBS_COLUMN]
+
+    def get_num_chunks(self) -> int:
+        """Returns the number of chunks"""
+        return len(self.__chunks)
+
+    def get_chunk_offsets(self) -> np.array:
+        """Returns the first row of each chunk, followed by the number of rows"""
+        return self.__chunk_offsets
+
+    def get_chunk_column(self, chunk_number: int, name: str) -> np.array:
+        """Returns one column of one chunk, as a read-only view of the chunk file (no data is read until it is used)"""
+        return self.__chunks[chunk_number][name]
+
+    def get_column(self, name: str) -> np.array:
+        """Returns a whole column: a read-only view of the chunk file if there is one chunk, and otherwise a copy"""
+        if len(self.__chunks) == 1:
+            return self.__chunks[0][name]
+        if not self.__chunks:
+            dtype = self.__metadata["action_probs_dtype"] if name == ACTION_PROBS_COLUMN else self.__metadata["columns"][name]
+            shape = (0, len(self.__metadata["action_names"])) if name == ACTION_PROBS_COLUMN else (0,)
+            return np.empty(shape, dtype=dtype)
+        return np.concatenate([chunk[name] for chunk in self.__chunks])
+
+    def iter_chunks(self, columns: List[str] | None = None, rows: np.array | None = None) -> Iterator[tuple]:
+        """Lazily yields (first row, columns) for each chunk in turn: read-only views of the chunk files, or if rows
+        (sorted row numbers, e.g. from select()) are given, only those rows, for the chunks that have any"""
+        columns = columns if columns is not None else self.get_column_names()
+        if rows is not None:
+            rows = np.asarray(rows, dtype=np.int64)
+            boundaries = np.searchsorted(rows, self.__chunk_offsets)
+        for chunk_number, chunk in enumerate(self.__chunks):
+            first_row = int(self.__chunk_offsets[chunk_number])
+            if rows is None:
+                yield first_row, {name: chunk[name] for name in columns}
+            elif boundaries[chunk_number] < boundaries[chunk_number + 1]:
+                chunk_rows = rows[boundaries[chunk_number]:boundaries[chunk_number + 1]] - first_row
+                yield first_row, {name: np.asarray(chunk[name][chunk_rows]) for name in columns}
+
+    def read_rows(self, rows: np.array, columns: List[str] | None = None) -> Dict[str, np.array]:
+        """Reads the given rows (sorted row numbers, e.g. from select()) of the given columns (default all) into memory"""
+        columns = columns if columns is not None else self.get_column_names()
+        chunk_columns = [chunk_columns for _, chunk_columns in self.iter_chunks(columns, rows)]
+        if not chunk_columns:
+            return {name: np.asarray(self.__chunks[0][name][:0]) if self.__chunks else self.get_column(name) for name in columns}
+        return {name: np.concatenate([columns_of_chunk[name] for columns_of_chunk in chunk_columns]) for name in columns}
+
+    # The sidecar index
+    def get_chunks_fingerprint(self) -> str:
+        """Returns a string identifying the current chunk files (their names, numbers of rows & modification times)"""
+        return json.dumps([[chunk["file"], chunk["num_rows"], os.stat(os.path.join(self.__directory, chunk["file"])).st_mtime_ns]
+                           for chunk in self.__metadata["chunks"]])
+
+    def get_index(self) -> Dict[str, np.array]:
+        """Returns the index (loading or building it on first use): every row sorted by (run, round, person) as
+        "rows" along with their sorted "run_numbers", "round_numbers" & "persons", and every row grouped by action as
+        "action_rows", where the rows of action a are action_rows[action_offsets[a]:action_offsets[a + 1]]"""
+        if self.__index is None:
+            index_filepath = os.path.join(self.__directory, INDEX_FILENAME)
+            index = None
+            if os.path.exists(index_filepath):
+                # The index is memory-mapped too
+                index = map_npz_members(index_filepath)
+                # An index of an earlier state of the trace (e.g. before more chunks were written) is rebuilt
+                if int(index["format_version"]) != INDEX_FORMAT_VERSION or str(index["chunks"]) != self.get_chunks_fingerprint():
+                    index = None
+            if index is None:
+                index = self.build_index()
+            self.__index = index
+        return self.__index
+
+    def build_index(self) -> Dict[str, np.array]:
+        """Builds the index from the id columns, and saves it next to the trace (see get_index())"""
+        run_numbers, round_numbers, persons, actions = [self.get_column(name).astype(np.int64) for name in (
+            "run_number", "round_number", "person", "action")]
+        rows = np.lexsort((persons, round_numbers, run_numbers))
+        action_rows = np.argsort(actions, kind="stable")
+        index = {
+            "format_version": np.array(INDEX_FORMAT_VERSION),
+            "chunks": np.array(self.get_chunks_fingerprint()),
+            "rows": rows,
+            "run_numbers": run_numbers[rows],
+            "round_numbers": round_numbers[rows],
+            "persons": persons[rows],
+            "action_rows": action_rows,
+            "action_offsets": np.concatenate(([0], np.cumsum(np.bincount(actions, minlength=len(self.__metadata["action_names"]))))).astype(np.int64),
+        }
+        # Written to a temporary file first, so that a reader never sees a partial index
+        index_filepath = os.path.join(self.__directory, INDEX_FILENAME)
+        temporary_filepath = f"{index_filepath}.{os.getpid()}.tmp"
+        with open(temporary_filepath, "wb") as index_file:
+            np.savez(index_file, **index)
+        os.replace(temporary_filepath, index_filepath)
+        return index
+
+    def select(self, run_number: int | None = None, round_number: int | None = None, person: int | None = None,
+               action: int | str | None = None) -> np.array:
+        """Returns the (sorted) numbers of the rows matching every given id (an action may also be given by name).
+        Leading keys of (run, round, person) are found by binary search in the index; the rest are filtered."""
+        index = self.get_index()
+        start, end = 0, len(index["rows"])
+        is_sorted = True
+        filters = []
+        for key, value in (("run_numbers", run_number), ("round_numbers", round_number), ("persons", person)):
+            if value is None:
+                # Keys after a missing key are not sorted within the range, so are filtered instead
+                is_sorted = False
+            elif is_sorted:
+                sorted_keys = index[key][start:end]
+                start, end = start + int(np.searchsorted(sorted_keys, value, side="left")), start + int(np.searchsorted(sorted_keys, value, side="right"))
+            else:
+                filters.append((key, value))
+        is_selected = np.ones(end - start, dtype=bool)
+        for key, value in filters:
+            is_selected &= index[key][start:end] == value
+        rows = np.sort(index["rows"][start:end][is_selected])
+        if action is not None:
+            action_id = self.__metadata["action_names"].index(action) if isinstance(action, str) else action
+            action_rows = index["action_rows"][index["action_offsets"][action_id]:index["action_offsets"][action_id + 1]]
+            rows = np.intersect1d(rows, action_rows, assume_unique=True)
+        return rows
@@ -0,0 +1,244 @@
+from __future__ import annotations
+import json
+import os
+import numpy as np
+from typing import Dict, List
+
+# Simulation traces are stored as a directory of fixed-size chunks, each an (uncompressed) .npz file
+# holding one typed array per column, plus a metadata.json describing the columns, and a chunks.jsonl manifest
+# with one line per chunk. Names of people, rooms and actions are stored once in the metadata, and referred to by
+# integer ids. The metadata is written once, when the trace is opened, and each chunk only appends a line to the
+# manifest, so writing a chunk costs the same however many people there are.
+
+TRACE_FORMAT_VERSION = 2
+# Version 1 traces kept the chunks in metadata.json, which was rewritten after every chunk
+READABLE_TRACE_FORMAT_VERSIONS = (1, 2)
+METADATA_FILENAME = "metadata.json"
+MANIFEST_FILENAME = "chunks.jsonl"
+PAD_DIMENSIONS = ("pleasure", "arousal", "dominance")
+
+# One row per turn. Person/partner ids are indices into person_names (-1 for no partner),
+# locations are indices into room_names and actions are indices into action_names.
+# The partner's PAD columns are NaN when there is no partner.
+TRACE_COLUMNS = {
+    "run_number": np.int32,
+    "round_number": np.int32,
+    "turn_number": np.int64,
+    "person": np.int32,
+    "action": np.int16,
+    "location_before": np.int32,
+    "location_after": np.int32,
+    "partner_before": np.int32,
+    "partner_after": np.int32,
+    **{f"{who}_{dimension}_{when}": np.float32 for who in ("person", "partner") for when in ("before", "after") for dimension in PAD_DIMENSIONS},
+}
+# The (rows x A) probabilities of every action for the turn's action selection (0 for unavailable actions)
+ACTION_PROBS_COLUMN = "action_probs"
+
+
+def get_chunk_filename(chunk_number: int) -> str:
+    """Returns the filename of the given chunk"""
+    return f"chunk_{chunk_number:05d}.npz"
+
+
+class TraceWriter:
+    """Streams per-turn simulation traces to disk as typed, columnar chunks.
+    Rows are buffered in preallocated arrays, and each full chunk is written out, so memory use stays flat."""
+
+    def __init__(self, directory: str, person_names: List[str], room_names: List[str], action_names: List[str], personality_vectors: np.array | None = None, chunk_size: int = 65536, overwrite: bool = False):
+        assert chunk_size > 0, "Chunk size must be positive"
+        self.__directory = directory
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(os.path.join(directory, METADATA_FILENAME)):
+            assert overwrite, f"{directory} already contains a trace"
+            remove_trace(directory)
+
+        self.__metadata = {
+            "format_version": TRACE_FORMAT_VERSION,
+            "columns": {name: np.dtype(dtype).str for name, dtype in TRACE_COLUMNS.items()},
+            "action_probs_dtype": np.dtype(np.float32).str,
+            "person_names": list(person_names),
+            "room_names": list(room_names),
+            "action_names": list(action_names),
+            "personality_vectors": None if personality_vectors is None else np.asarray(personality_vectors).tolist(),
+            "chunk_size": chunk_size,
+        }
+        # The manifest is created empty first, so the trace can be read (with no chunks) as soon as the metadata exists
+        open(os.path.join(directory, MANIFEST_FILENAME), "w").close()
+        write_trace_metadata(directory, self.__metadata)
+        self.__num_chunks = 0
+        self.__num_rows = 0
+
+        # The buffer for the chunk currently being filled
+        self.__chunk_size = chunk_size
+        self.__buffers = {name: np.empty(chunk_size, dtype=dtype)
+                          for name, dtype in TRACE_COLUMNS.items()}
+        self.__buffers[ACTION_PROBS_COLUMN] = np.zeros(
+            (chunk_size, len(action_names)), dtype=np.float32)
+        self.__num_buffered = 0
+        self.__closed = False
+
+    def __enter__(self) -> TraceWriter:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_directory(self) -> str:
+        """Returns the directory the trace is written to"""
+        return self.__directory
+
+    def get_num_rows(self) -> int:
+        """Returns the number of rows appended so far (written or buffered)"""
+        return self.__num_rows + self.__num_buffered
+
+    def append_turn(self, run_number: int, round_number: int, turn_number: int, person: int, action: int, location_before: int, location_after: int,
+                    person_emotional_state_before: np.array, person_emotional_state_after: np.array, partner_before: int = -1, partner_after: int = -1,
+                    partner_emotional_state_before: np.array | None = None, partner_emotional_state_after: np.array | None = None, action_probs: np.array | None = None):
+        """Appends a single turn"""
+        assert not self.__closed, "Trace writer is closed"
+        row = self.__num_buffered
+        buffers = self.__buffers
+        buffers["run_number"][row] = run_number
+        buffers["round_number"][row] = round_number
+        buffers["turn_number"][row] = turn_number
+        buffers["person"][row] = person
+        buffers["action"][row] = action
+        buffers["location_before"][row] = location_before
+        buffers["location_after"][row] = location_after
+        buffers["partner_before"][row] = partner_before
+        buffers["partner_after"][row] = partner_after
+        for who, when, emotional_state in (("person", "before", person_emotional_state_before), ("person", "after", person_emotional_state_after),
+                                           ("partner", "before", partner_emotional_state_before), ("partner", "after", partner_emotional_state_after)):
+            for i, dimension in enumerate(PAD_DIMENSIONS):
+                buffers[f"{who}_{dimension}_{when}"][row] = np.nan if emotional_state is None else emotional_state[i]
+        buffers[ACTION_PROBS_COLUMN][row] = 0 if action_probs is None else action_probs
+        self.__num_buffered += 1
+        if self.__num_buffered == self.__chunk_size:
+            self.flush()
+
+    def append_turns(self, columns: Dict[str, np.array]):
+        """Appends a batch of turns, given as equal-length arrays for every column (action_probs may be omitted)"""
+        assert not self.__closed, "Trace writer is closed"
+        assert set(TRACE_COLUMNS) <= set(columns), f"Missing columns: {set(TRACE_COLUMNS) - set(columns)}"
+        num_rows = len(columns["person"])
+        start = 0
+        while start < num_rows:
+            # Fill the current chunk as far as possible
+            count = min(num_rows - start, self.__chunk_size -
+                        self.__num_buffered)
+            rows = slice(self.__num_buffered, self.__num_buffered + count)
+            for name in TRACE_COLUMNS:
+                self.__buffers[name][rows] = columns[name][start:start + count]
+            if ACTION_PROBS_COLUMN in columns:
+                self.__buffers[ACTION_PROBS_COLUMN][rows] = columns[ACTION_PROBS_COLUMN][start:start + count]
+            else:
+                self.__buffers[ACTION_PROBS_COLUMN][rows] = 0
+            self.__num_buffered += count
+            start += count
+            if self.__num_buffered == self.__chunk_size:
+                self.flush()
+
+    def flush(self):
+        """Writes any buffered rows out as a new chunk (and adds it to the manifest)"""
+        if self.__num_buffered > 0:
+            chunk_filename = get_chunk_filename(self.__num_chunks)
+            with open(os.path.join(self.__directory, chunk_filename), "wb") as chunk_file:
+                np.savez(chunk_file, **{name: buffer[:self.__num_buffered]
+                         for name, buffer in self.__buffers.items()})
+            # Added after the chunk is written, so a partial trace can be read while the run continues
+            append_to_manifest(self.__directory, [{"file": chunk_filename, "num_rows": self.__num_buffered}])
+            self.__num_chunks += 1
+            self.__num_rows += self.__num_buffered
+            self.__num_buffered = 0
+
+    def close(self):
+        """Flushes any buffered rows, after which no more rows can be appended"""
+        if not self.__closed:
+            self.flush()
+            self.__closed = True
+
+
+def write_trace_metadata(directory: str, metadata: dict):
+    """Writes the (static) metadata of a trace"""
+    with open(os.path.join(directory, METADATA_FILENAME), "w") as metadata_file:
+        json.dump(metadata, metadata_file)
+
+
+def append_to_manifest(directory: str, chunks: List[dict]):
+    """Appends chunks (each {"file": ..., "num_rows": ...}) to the manifest of a trace, one line each"""
+    with open(os.path.join(directory, MANIFEST_FILENAME), "a") as manifest_file:
+        manifest_file.write("".join(json.dumps(chunk) + "\n" for chunk in chunks))
+
+
+def read_manifest(directory: str) -> List[dict]:
+    """Returns the chunks in the manifest of a trace (without a line still being written)"""
+    with open(os.path.join(directory, MANIFEST_FILENAME)) as manifest_file:
+        return [json.loads(line) for line in manifest_file.read().split("\n")[:-1]]
+
+
+def read_trace_metadata(directory: str) -> dict:
+    """Returns the metadata of the trace in the given directory, including its "chunks" and "num_rows" so far"""
+    with open(os.path.join(directory, METADATA_FILENAME)) as metadata_file:
+        metadata = json.load(metadata_file)
+    assert metadata["format_version"] in READABLE_TRACE_FORMAT_VERSIONS, f"Unsupported trace format version {metadata['format_version']}"
+    if metadata["format_version"] >= 2:
+        metadata["chunks"] = read_manifest(directory)
+        metadata["num_rows"] = sum(chunk["num_rows"] for chunk in metadata["chunks"])
+    return metadata
+
+
+def remove_trace(directory: str):
+    """Removes the chunks, manifest & metadata of the trace in the given directory"""
+    for chunk in read_trace_metadata(directory)["chunks"]:
+        os.remove(os.path.join(directory, chunk["file"]))
+    for filename in (MANIFEST_FILENAME, METADATA_FILENAME):
+        if os.path.exists(os.path.join(directory, filename)):
+            os.remove(os.path.join(directory, filename))
+
+
+def read_trace(directory: str) -> Dict[str, np.array]:
+    """Reads the whole trace in the given directory into memory, as a dict of column arrays"""
+    metadata = read_trace_metadata(directory)
+    chunks = []
+    for chunk in metadata["chunks"]:
+        with np.load(os.path.join(directory, chunk["file"])) as chunk_arrays:
+            chunks.append({name: chunk_arrays[name]
+                          for name in chunk_arrays.files})
+    if not chunks:
+        columns = {name: np.empty(0, dtype=dtype)
+                   for name, dtype in metadata["columns"].items()}
+        columns[ACTION_PROBS_COLUMN] = np.empty(
+            (0, len(metadata["action_names"])), dtype=metadata["action_probs_dtype"])
+        return columns
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+
+def merge_traces(input_directories: List[str], output_directory: str):
+    """Merges several traces (e.g. one per run) into a single trace, in the given order.
+    Chunk files are moved rather than copied, so the input traces are consumed."""
+    metadatas = [read_trace_metadata(directory)
+                 for directory in input_directories]
+    assert metadatas, "No traces to merge"
+    # Person ids only mean the same in every trace if the people are the same
+    for metadata in metadatas[1:]:
+        for key in ("columns", "action_probs_dtype", "person_names", "personality_vectors", "room_names", "action_names"):
+            assert metadata[key] == metadatas[0][key], f"Traces have different {key}"
+
+    os.makedirs(output_directory, exist_ok=True)
+    assert not os.path.exists(os.path.join(output_directory, METADATA_FILENAME)), f"{output_directory} already contains a trace"
+    merged_chunks = []
+    for directory, metadata in zip(input_directories, metadatas):
+        for chunk in metadata["chunks"]:
+            chunk_filename = get_chunk_filename(len(merged_chunks))
+            os.replace(os.path.join(directory, chunk["file"]),
+                       os.path.join(output_directory, chunk_filename))
+            merged_chunks.append({"file": chunk_filename, "num_rows": chunk["num_rows"]})
+        for filename in (MANIFEST_FILENAME, METADATA_FILENAME):
+            if os.path.exists(os.path.join(directory, filename)):
+                os.remove(os.path.join(directory, filename))
+    # The manifest is written before the metadata, so a reader never sees a partly merged trace
+    open(os.path.join(output_directory, MANIFEST_FILENAME), "w").close()
+    append_to_manifest(output_directory, merged_chunks)
+    merged_metadata = {key: value for key, value in metadatas[0].items() if key not in ("chunks", "num_rows")}
+    write_trace_metadata(output_directory, dict(merged_metadata, format_version=TRACE_FORMAT_VERSION))